@@ -41,5 +41,6 @@ modules_to_use = {
         ]
 }
 
-# The following demonstrates how parameters can be set for individual Modules:
+# The following demonstrates how parameters can be set for individual Modules.
+# Setting "profile": True (or "pyinstrument") for a Module will profile its run.
 special_config = {"NetworkCentralityCalculator": {"n_sub_images": -1}}
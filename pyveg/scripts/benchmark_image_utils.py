@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark the pixel-level functions in src/image_utils.py,
+comparing the numpy versions with the original pixel-by-pixel loops
+(kept here as reference implementations), on random binary images.
+"""
+
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from pyveg.src.image_utils import (
+    image_from_array,
+    invert_binary_image,
+    convert_to_bw,
+    image_all_same_colour,
+    compare_binary_images
+)
+
+
+def image_from_array_loop(input_array, output_size=None, sel_val=200):
+    """
+    Reference implementation of image_from_array.
+    """
+    size_x, size_y = input_array.shape
+    new_img = Image.new("RGB", (size_x, size_y))
+    for ix in range(size_x):
+        for iy in range(size_y):
+            val = int(input_array[ix, iy])
+            if val == sel_val:
+                new_img.putpixel((ix, iy), (0, val, val))
+            else:
+                new_img.putpixel((ix, iy), (val, val, val))
+    if output_size:
+        new_img = new_img.resize((output_size, output_size), Image.LANCZOS)
+    return new_img
+
+
+def invert_binary_image_loop(image):
+    """
+    Reference implementation of invert_binary_image.
+    """
+    new_img = Image.new("RGB", image.size)
+    pix = image.load()
+    for ix in range(image.size[0]):
+        for iy in range(image.size[1]):
+            if sum(pix[ix, iy]) == 0:
+                new_img.putpixel((ix, iy), (255, 255, 255))
+            else:
+                new_img.putpixel((ix, iy), (0, 0, 0))
+    return new_img
+
+
+def convert_to_bw_loop(input_image, threshold, invert=False):
+    """
+    Reference implementation of convert_to_bw.
+    """
+    pix = input_image.load()
+    new_img = Image.new("RGB", input_image.size)
+    for ix in range(input_image.size[0]):
+        for iy in range(input_image.size[1]):
+            p = pix[ix, iy]
+            try:
+                total = 0
+                for col in p:
+                    total += col
+            except:
+                total = p
+            if (invert and (total > threshold)) or \
+               ((not invert) and (total < threshold)):
+                new_img.putpixel((ix, iy), (255, 255, 255))
+            else:
+                new_img.putpixel((ix, iy), (0, 0, 0))
+    return new_img
+
+
+def image_all_same_colour_loop(image, colour=(255, 255, 255), threshold=0.99):
+    """
+    Reference implementation of image_all_same_colour.
+    """
+    num_total = image.size[0] * image.size[1]
+    num_different = 0
+    pix = image.load()
+    for ix in range(image.size[0]):
+        for iy in range(image.size[1]):
+            if pix[ix, iy] != colour:
+                num_different += 1
+                if 1.0 - float(num_different/num_total) < threshold:
+                    return False
+    return True
+
+
+def compare_binary_images_loop(image1, image2):
+    """
+    Reference implementation of compare_binary_images.
+    """
+    if not image1.size == image2.size:
+        return 0.
+    pix1 = image1.load()
+    pix2 = image2.load()
+    num_same = 0
+    num_total = image1.size[0] * image1.size[1]
+    for ix in range(image1.size[0]):
+        for iy in range(image1.size[1]):
+            if pix1[ix, iy] == pix2[ix, iy]:
+                num_same += 1
+    return float(num_same / num_total)
+
+
+def make_test_images(size, seed=0):
+    """
+    Return a random size x size binary array (values 0 or 255),
+    and two random binary RGB images.
+    """
+    rand = np.random.RandomState(seed)
+    binary_array = np.where(rand.rand(size, size) > 0.5, 255, 0)
+    images = []
+    for _ in range(2):
+        bw = np.where(rand.rand(size, size) > 0.5, 255, 0).astype(np.uint8)
+        images.append(Image.fromarray(np.repeat(bw[:, :, np.newaxis], 3, axis=2), "RGB"))
+    return binary_array, images[0], images[1]
+
+
+def get_benchmarks(size):
+    """
+    Return a dict {name: (numpy_function, loop_function)}, where
+    both functions take no arguments and run on size x size images.
+    """
+    binary_array, image1, image2 = make_test_images(size)
+    return {
+        "image_from_array": (lambda: image_from_array(binary_array),
+                             lambda: image_from_array_loop(binary_array)),
+        "invert_binary_image": (lambda: invert_binary_image(image1),
+                                lambda: invert_binary_image_loop(image1)),
+        "convert_to_bw": (lambda: convert_to_bw(image1, 470),
+                          lambda: convert_to_bw_loop(image1, 470)),
+        # threshold=0 so that the loop can't return early
+        "image_all_same_colour": (lambda: image_all_same_colour(image1, threshold=0),
+                                  lambda: image_all_same_colour_loop(image1, threshold=0)),
+        "compare_binary_images": (lambda: compare_binary_images(image1, image2),
+                                  lambda: compare_binary_images_loop(image1, image2))
+    }
+
+
+def time_function(func, repeats):
+    """
+    Return the fastest wall time in seconds of repeats calls to func.
+    """
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def run_benchmarks(size=1000, repeats=3, run_loops=True):
+    """
+    Time each function on size x size images, and return a dict
+    {name: {"numpy_s": <float>, "loop_s": <float or None>}}.
+    """
+    results = {}
+    for name, (numpy_func, loop_func) in get_benchmarks(size).items():
+        results[name] = {
+            "numpy_s": time_function(numpy_func, repeats),
+            "loop_s": time_function(loop_func, 1) if run_loops else None
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pixel-level image functions")
+    parser.add_argument("--size", help="size in pixels of square test images",
+                        type=int, default=1000)
+    parser.add_argument("--repeats", help="number of times to run numpy versions",
+                        type=int, default=3)
+    parser.add_argument("--skip_loops", help="don't time the pixel-by-pixel versions",
+                        action="store_true")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.size, args.repeats, not args.skip_loops)
+    print("{:<25} {:>12} {:>12} {:>10}".format("function", "numpy [s]", "loop [s]", "speedup"))
+    for name, result in results.items():
+        if result["loop_s"] is None:
+            print("{:<25} {:>12.5f}".format(name, result["numpy_s"]))
+        else:
+            print("{:<25} {:>12.5f} {:>12.5f} {:>10.1f}".format(
+                name, result["numpy_s"], result["loop_s"],
+                result["loop_s"] / result["numpy_s"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the stages of the subgraph centrality calculation in
+src/subgraph_centrality.py, for different sizes of sub-image, vegetation
+patterns, and 4- or 8-neighbour adjacency.
+
+Input images are simulated patterns from the PatternGenerator, at
+different rainfall values, plus binary images from the testdata directory.
+For each one, the wall time and peak memory (as seen by tracemalloc) of
+each stage of the calculation is written to a JSON file, so that
+results can be compared between runs.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from pyveg.src.pattern_generation import PatternGenerator
+from pyveg.src.subgraph_centrality import (
+    text_file_to_array,
+    get_signal_pixels,
+    calc_distance_matrix,
+    calc_adjacency_matrix,
+    calc_sparse_adjacency_matrix,
+    calc_sc_values_dense,
+    calc_and_sort_sc_indices,
+    fill_feature_vector,
+    subgraph_centrality
+)
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), "..", "testdata")
+DEFAULT_FIXTURES = [os.path.join(TESTDATA_DIR, "binary_labyrinths_50.csv"),
+                    os.path.join(TESTDATA_DIR, "binary_image.txt")]
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) and return its output, along with
+    a dict of the wall time in seconds and peak memory in bytes.
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    output = func(*args, **kwargs)
+    elapsed_time = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return output, {"time_s": elapsed_time, "peak_memory_bytes": peak_memory}
+
+
+def generate_pattern(size, rainfall, steps):
+    """
+    Use the PatternGenerator to simulate a size x size binary image.
+    """
+    pg = PatternGenerator()
+    pg.config["m"] = size
+    pg.configure()
+    pg.initialize()
+    pg.set_rainfall(rainfall)
+    pg.initial_conditions()
+    pg.set_random_starting_pattern()
+    pg.evolve_pattern(steps=steps)
+    return pg.make_binary()
+
+
+def resize_image(image, size):
+    """
+    Repeat the image if necessary, then crop it to size x size pixels.
+    """
+    reps = (-(-size // image.shape[0]), -(-size // image.shape[1]))
+    return np.tile(image, reps)[:size, :size]
+
+
+def benchmark_image(image, use_diagonal_neighbours, max_dense_pixels):
+    """
+    Time each stage of the subgraph centrality calculation on one image.
+    Stages that need an NxN matrix are skipped (and their result set to
+    None) if there are more than max_dense_pixels signal pixels.
+    """
+    stages = {}
+    signal_coords, stages["signal_pixels"] = measure(get_signal_pixels, image)
+    n_pix = len(signal_coords)
+    run_dense = n_pix <= max_dense_pixels
+    if run_dense:
+        (_, dist_matrix), stages["distance_matrix"] = measure(calc_distance_matrix,
+                                                              signal_coords)
+        _, stages["adjacency_dense"] = measure(calc_adjacency_matrix,
+                                               dist_matrix,
+                                               use_diagonal_neighbours)
+        del dist_matrix
+    else:
+        stages["distance_matrix"] = None
+        stages["adjacency_dense"] = None
+    adj_matrix, stages["adjacency_sparse"] = measure(calc_sparse_adjacency_matrix,
+                                                     signal_coords,
+                                                     use_diagonal_neighbours)
+    if run_dense:
+        _, stages["eigen_solve_dense"] = measure(calc_sc_values_dense, adj_matrix)
+    else:
+        stages["eigen_solve_dense"] = None
+    indices, stages["eigen_solve"] = measure(calc_and_sort_sc_indices, adj_matrix)
+    _, stages["expm_multiply"] = measure(calc_and_sort_sc_indices, adj_matrix,
+                                         "expm_multiply", signal_coords)
+    _, stages["euler_characteristic"] = measure(fill_feature_vector, indices,
+                                                signal_coords, adj_matrix)
+    _, stages["total"] = measure(subgraph_centrality, image, use_diagonal_neighbours)
+    return {
+        "n_signal_pixels": n_pix,
+        "signal_fraction": n_pix / image.size,
+        "stages": stages
+    }
+
+
+def get_images(sizes, rainfalls, steps, fixtures):
+    """
+    Generator yielding (name, size, image) for all the images to benchmark.
+    """
+    for size in sizes:
+        for rainfall in rainfalls:
+            yield "pattern_rainfall_{}mm".format(rainfall), size, \
+                generate_pattern(size, rainfall, steps)
+        for fixture in fixtures:
+            yield os.path.basename(fixture), size, \
+                resize_image(text_file_to_array(fixture), size)
+
+
+def run_benchmarks(sizes=[25, 50, 100, 200],
+                   rainfalls=[0.8, 1.4, 2.0],
+                   steps=1000,
+                   fixtures=DEFAULT_FIXTURES,
+                   max_dense_pixels=5000):
+    """
+    Run the benchmarks for all combinations of image and
+    use_diagonal_neighbours, and return a dict ready to write to JSON.
+    """
+    results = []
+    for name, size, image in get_images(sizes, rainfalls, steps, fixtures):
+        for use_diagonal_neighbours in [False, True]:
+            print("Benchmarking {} {}x{} use_diagonal_neighbours={}"\
+                  .format(name, size, size, use_diagonal_neighbours))
+            result = {
+                "image": name,
+                "size": size,
+                "use_diagonal_neighbours": use_diagonal_neighbours
+            }
+            result.update(benchmark_image(image,
+                                          use_diagonal_neighbours,
+                                          max_dense_pixels))
+            results.append(result)
+    return {
+        "metadata": {
+            "time": time.strftime("%Y-%m-%d_%H-%M-%S"),
+            "platform": platform.platform(),
+            "python_version": platform.python_version(),
+            "numpy_version": np.__version__,
+            "scipy_version": scipy.__version__,
+            "pattern_steps": steps,
+            "max_dense_pixels": max_dense_pixels
+        },
+        "results": results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subgraph centrality calculation")
+    parser.add_argument("--sizes", help="sizes in pixels of square sub-images",
+                        type=int, nargs="+", default=[25, 50, 100, 200])
+    parser.add_argument("--rainfall", help="rainfall values in mm for simulated patterns",
+                        type=float, nargs="+", default=[0.8, 1.4, 2.0])
+    parser.add_argument("--steps", help="number of time steps for simulated patterns",
+                        type=int, default=1000)
+    parser.add_argument("--input_txt", help="csv files of binary images to benchmark",
+                        nargs="+", default=DEFAULT_FIXTURES)
+    parser.add_argument("--max_dense_pixels",
+                        help="skip NxN matrix stages above this number of signal pixels",
+                        type=int, default=5000)
+    parser.add_argument("--output_json", help="filename for output json",
+                        default="sc_benchmark.json")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.rainfall, args.steps,
+                             args.input_txt, args.max_dense_pixels)
+    with open(args.output_json, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    print("Wrote benchmark results to {}".format(args.output_json))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Build and run pyveg pipelines for many locations at once, from one
+configuration file, sharing one scheduler, worker pool and concurrency
+limits between them.
+"""
+
+import os
+import time
+import argparse
+
+from pyveg.src.batch_runner import BatchRunner, read_sites
+from pyveg.scripts.run_pyveg_pipeline import (
+    load_config,
+    get_output_location,
+    cache_config,
+    build_pipeline_from_config
+)
+
+
+def build_batch(config_file, sites, from_cache=False):
+    """
+    Build a BatchRunner with one pipeline per location in sites, each
+    configured from config_file apart from the coordinates, with output in
+    <output_location>__<time>/<site_id>.
+    """
+    print("Configuring from cached config? {}".format(from_cache))
+    current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+    config = load_config(config_file)
+    output_location = get_output_location(config, config_file, from_cache, current_time)
+    if not from_cache:
+        cache_config(config_file, current_time)
+    batch = BatchRunner(config.name, output_location, config.output_location_type)
+    for site_id, coordinates in sites:
+        batch.add_site(site_id, build_pipeline_from_config(
+            config, batch.get_site_output_location(site_id), coordinates,
+            "{}_{}".format(config.name, site_id)))
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a pipeline for many locations")
+    parser.add_argument("--config_file", help="Path to config file", required=True)
+    parser.add_argument("--coordinate_ids", help="ids of locations in coordinates.py (default all)",
+                        nargs="+")
+    parser.add_argument("--coordinates_csv",
+                        help="csv file of locations, with columns latitude, longitude and optionally id")
+    parser.add_argument("--from_cache", help="Are we using a cached config file to resume an unfinished job?",
+                        action='store_true')
+    parser.add_argument("--max_parallel_sequences",
+                        help="Number of sequences to run at once over all locations, -1 for one per cpu",
+                        type=int, default=4)
+    parser.add_argument("--max_parallel_downloads",
+                        help="Number of dates to download at once over all locations, -1 for one per cpu",
+                        type=int, default=4)
+    parser.add_argument("--max_parallel_processing",
+                        help="Number of dates to process at once over all locations, -1 for one per cpu",
+                        type=int, default=-1)
+    parser.add_argument("--n_worker_processes",
+                        help="Number of processes for network centrality over all locations, -1 for one per cpu",
+                        type=int, default=-1)
+    parser.add_argument("--streaming",
+                        help="Pass each date through all the modules of a sequence as soon as it is downloaded",
+                        action='store_true')
+
+    args = parser.parse_args()
+    sites = read_sites(args.coordinate_ids, args.coordinates_csv)
+    batch = build_batch(args.config_file, sites, args.from_cache)
+    batch.max_parallel_sequences = args.max_parallel_sequences
+    batch.max_parallel_downloads = args.max_parallel_downloads
+    batch.max_parallel_processing = args.max_parallel_processing
+    batch.n_worker_processes = args.n_worker_processes
+    if args.streaming:
+        for pipeline in batch.pipelines.values():
+            for sequence in pipeline.sequences:
+                sequence.streaming = True
+    batch.configure()
+    summary = batch.run()
+    print("{} of {} locations succeeded, see {}".format(
+        summary["n_succeeded"], len(summary["sites"]),
+        os.path.join(batch.output_location, "batch_summary.json")))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,42 +27,73 @@ from pyveg.src.combiner_modules import VegAndWeatherJsonCombiner
 
 
 
-def build_pipeline(config_file, from_cache=False):
+def load_config(config_file):
     """
-    Load json config and instantiate modules
+    Import the config file as a module.
     """
-    print("Configuring from cached config? {}".format(from_cache))
-    current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-
     spec = importlib.util.spec_from_file_location("myconfig", config_file)
     config = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(config)
+    return config
 
-    # instantiate and setup the pipeline
-    p = Pipeline(config.name)
-    p.output_location = config.output_location
+
+def get_output_location(config, config_file, from_cache, current_time):
+    """
+    Add the time to the output location from the config, or if we are
+    resuming from a cached config, the time from its filename.
+    """
+    output_location = config.output_location
     if not from_cache:
-        p.output_location += '__' + current_time
+        output_location += '__' + current_time
     else:
         # use the time from the filename
         time_match = re.search("([\d]{4}-[\d]{2}-[\d]{2}_[\d]{2}-[\d]{2}-[\d]{2})",
                                os.path.basename(config_file))
         if time_match:
-            p.output_location += '__' + time_match.groups()[0]
+            output_location += '__' + time_match.groups()[0]
         else:
             print("Wasn't able to infer timestamp from config filename.",
                   "Will use original output_location from {}.".format(config_file))
-    p.output_location_type = config.output_location_type
-    p.coords = config.coordinates
-    p.date_range = config.date_range
+    return output_location
+
+
+def cache_config(config_file, current_time):
+    """
+    Before we run anything, save the current config to the configs dir,
+    so that an unfinished job can be resumed with --from_cache.
+    """
+    config_cache_dir = os.path.join(os.path.dirname(config_file),"cached_config")
+    os.makedirs(config_cache_dir, exist_ok=True)
+    cached_config_file = os.path.basename(config_file)[:-3] + \
+        '__' + current_time + ".py"
+
+    copyfile(config_file, os.path.join(config_cache_dir, cached_config_file))
+
+
+def build_pipeline(config_file, from_cache=False):
+    """
+    Load json config and instantiate modules
+    """
+    print("Configuring from cached config? {}".format(from_cache))
+    current_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+    config = load_config(config_file)
+    output_location = get_output_location(config, config_file, from_cache, current_time)
     if not from_cache:
-        # before we run anything, save the current config to the configs dir
-        config_cache_dir = os.path.join(os.path.dirname(config_file),"cached_config")
-        os.makedirs(config_cache_dir, exist_ok=True)
-        cached_config_file = os.path.basename(config_file)[:-3] + \
-            '__' + current_time + ".py"
+        cache_config(config_file, current_time)
+    return build_pipeline_from_config(config, output_location, config.coordinates)
 
-        copyfile(config_file, os.path.join(config_cache_dir, cached_config_file))
+
+def build_pipeline_from_config(config, output_location, coordinates, name=None):
+    """
+    Instantiate the pipeline, sequences and modules from the loaded config,
+    for the given output location and coordinates.
+    """
+    # instantiate and setup the pipeline
+    p = Pipeline(name if name else config.name)
+    p.output_location = output_location
+    p.output_location_type = config.output_location_type
+    p.coords = coordinates
+    p.date_range = config.date_range
 
     if config.output_location_type=="local" and not os.path.exists(p.output_location):
         os.makedirs(p.output_location, exist_ok=True)
@@ -88,8 +119,8 @@ def build_pipeline(config_file, from_cache=False):
     if len(config.collections_to_use) > 1:
         # now add the combiner module in its own sequence
         s = Sequence("combine")
-        # Combiner needs the previous sequences to finish (in case we ever try to
-        # parallelize further)
+        # Combiner needs the previous sequences to finish - the pipeline
+        # will start it as soon as they have.
         s.depends_on = config.collections_to_use
 
         for module_name in config.modules_to_use["combine"]:
@@ -102,12 +133,22 @@ def build_pipeline(config_file, from_cache=False):
     return p
 
 
-def configure_and_run_pipeline(pipeline):
+def configure_and_run_pipeline(pipeline, from_cache=False):
     """
     Call configure() run() on all sequences in the pipeline.
+    If from_cache is True, report how much work the run manifest shows
+    has already been done - modules will skip that.
+    At the end, write a report of the time and resources used by each
+    module to the output location, even if the run failed.
     """
     pipeline.configure()
-    pipeline.run()
+    if from_cache and pipeline.use_manifest:
+        print("Resuming using run manifest {}, with {} steps already completed"\
+              .format(pipeline.get_manifest_path(), len(pipeline.get_manifest())))
+    try:
+        pipeline.run()
+    finally:
+        print(pipeline.write_run_report())
 
 
 def main():
@@ -115,10 +156,20 @@ def main():
     parser.add_argument("--config_file", help="Path to config file", required=True)
     parser.add_argument("--from_cache", help="Are we using a cached config file to resume an unfinished job?",
                         action='store_true')
+    parser.add_argument("--max_parallel_sequences",
+                        help="Number of independent sequences (e.g. vegetation and weather) to run at once, -1 for all",
+                        type=int, default=1)
+    parser.add_argument("--streaming",
+                        help="Pass each date through all the modules of a sequence as soon as it is downloaded",
+                        action='store_true')
 
     args = parser.parse_args()
     pipeline = build_pipeline(args.config_file, args.from_cache)
-    configure_and_run_pipeline(pipeline)
+    pipeline.max_parallel_sequences = args.max_parallel_sequences
+    if args.streaming:
+        for sequence in pipeline.sequences:
+            sequence.streaming = True
+    configure_and_run_pipeline(pipeline, args.from_cache)
 
 
 if __name__ == "__main__":
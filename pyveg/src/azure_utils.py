@@ -1,6 +1,7 @@
 import os
 import io
 import json
+import threading
 
 import arrow
 import re
@@ -8,6 +9,7 @@ import tempfile
 from PIL import Image
 
 from pyveg.src.file_utils import split_filepath
+from pyveg.src.instrumentation import increment
 
 # load the azure configuration if we have the azure_config.py file
 try:
@@ -22,6 +24,25 @@ except:
 from azure.storage.blob import BlockBlobService, PublicAccess, ContainerPermissions
 from azure.common import AzureMissingResourceHttpError
 
+# one client, and so one pool of connections, for all the threads of a
+# process - see get_block_blob_service()
+_block_blob_service = None
+_block_blob_service_lock = threading.Lock()
+
+
+def get_block_blob_service():
+    """
+    Return the BlockBlobService for the configured storage account, creating
+    it the first time it is needed, so that e.g. all the pipelines in a
+    batch run share its connections rather than making new ones each call.
+    """
+    global _block_blob_service
+    with _block_blob_service_lock:
+        if _block_blob_service is None:
+            _block_blob_service = BlockBlobService(account_name=config["account_name"],
+                                                   account_key=config["account_key"])
+    return _block_blob_service
+
 
 def sanitize_container_name(orig_name):
     """
@@ -47,15 +68,13 @@ def check_container_exists(container_name, bbs=None):
     See if a container already exists for this account name.
     """
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     return bbs.exists(container_name)
 
 
 def create_container(container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     exists = check_container_exists(container_name, bbs)
     if not exists:
         bbs.create_container(container_name)
@@ -66,8 +85,7 @@ def check_blob_exists(blob_name, container_name, bbs=None):
     See if a blob already exists for this account name.
     """
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_names = bbs.list_blob_names(container_name)
     return blob_name in blob_names
 
@@ -75,8 +93,7 @@ def check_blob_exists(blob_name, container_name, bbs=None):
 
 def get_sas_token(container_name, token_duration=1, permissions="READ", bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     token_permission = ContainerPermissions.WRITE if permissions=="WRITE" \
                            else ContainerPermissions.READ
     duration = token_duration # days
@@ -94,14 +111,15 @@ def retrieve_blob(blob_name, container_name, destination="/tmp/", bbs=None):
     use the BlockBlobService to retrieve file from Azure, and place in destination folder.
     """
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                                   account_key=config["account_key"])
+        bbs = get_block_blob_service()
     local_filename = blob_name.split("/")[-1]
     try:
         bbs.get_blob_to_path(container_name,
                              blob_name,
                              os.path.join(destination,
                                           local_filename))
+        increment("azure_bytes_read",
+                  os.path.getsize(os.path.join(destination, local_filename)))
         return True, 'retrieved script OK'
     except(AzureMissingResourceHttpError):
         return False, 'failed to retrieve {} from {}'.format(blob_name,
@@ -111,8 +129,7 @@ def retrieve_blob(blob_name, container_name, destination="/tmp/", bbs=None):
 
 def list_directory(path, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
         pass
     output_names = []
     blob_names = bbs.list_blob_names(container_name)
@@ -151,8 +168,7 @@ def remove_container_name_from_blob_path(blob_path, container_name):
 
 def delete_blob(blob_name, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_exists = check_blob_exists(blob_name, container_name, bbs)
     if not blob_exists:
         return
@@ -162,9 +178,9 @@ def delete_blob(blob_name, container_name, bbs=None):
 
 def write_file_to_blob(file_path, blob_name, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     bbs.create_blob_from_path(container_name, blob_name, file_path)
+    increment("azure_bytes_written", os.path.getsize(file_path))
 
 
 def write_files_to_blob(path, container_name, blob_path = None, file_endings = [], bbs=None):
@@ -175,8 +191,7 @@ def write_files_to_blob(path, container_name, blob_path = None, file_endings = [
     """
 
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     filepaths_to_upload = []
     for root, dirs, files in os.walk(path):
         for filename in files:
@@ -206,23 +221,23 @@ def save_image(image, output_location, output_filename, container_name, format="
     probably others...
     """
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     output_path = os.path.join(output_location, output_filename)
     blob_name = remove_container_name_from_blob_path(output_path,
                                                      container_name)
     im_bytes = io.BytesIO()
     image.save(im_bytes, format=format)
     bbs.create_blob_from_bytes(container_name, blob_name, im_bytes.getvalue())
+    increment("azure_bytes_written", len(im_bytes.getvalue()))
 
 
 
 def read_image(blob_name, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_name = remove_container_name_from_blob_path(blob_name, container_name)
     img_bytes = bbs.get_blob_to_bytes(container_name, blob_name)
+    increment("azure_bytes_read", len(img_bytes.content))
     image = Image.open(io.BytesIO(img_bytes.content))
     return image
 
@@ -230,20 +245,21 @@ def read_image(blob_name, container_name, bbs=None):
 
 def save_json(data, blob_path, filename, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_name = os.path.join(blob_path, filename)
     blob_name = remove_container_name_from_blob_path(blob_name, container_name)
-    bbs.create_blob_from_text(container_name, blob_name, json.dumps(data))
+    json_text = json.dumps(data)
+    bbs.create_blob_from_text(container_name, blob_name, json_text)
+    increment("azure_bytes_written", len(json_text.encode()))
 
 
 
 def read_json(blob_name, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_name = remove_container_name_from_blob_path(blob_name, container_name)
     data_blob = bbs.get_blob_to_text(container_name, blob_name)
+    increment("azure_bytes_read", len(data_blob.content.encode()))
     data = json.loads(data_blob.content)
     return data
 
@@ -251,10 +267,10 @@ def read_json(blob_name, container_name, bbs=None):
 
 def get_blob_to_tempfile(filename, container_name, bbs=None):
     if not bbs:
-        bbs = BlockBlobService(account_name=config["account_name"],
-                               account_key=config["account_key"])
+        bbs = get_block_blob_service()
     blob_name = remove_container_name_from_blob_path(filename, container_name)
     td = tempfile.mkdtemp()
     output_name = os.path.join(td, os.path.basename(filename))
     bbs.get_blob_to_path(container_name, blob_name, output_name)
+    increment("azure_bytes_read", os.path.getsize(output_name))
     return output_name
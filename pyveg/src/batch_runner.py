@@ -0,0 +1,207 @@
+"""
+Run the pipelines for many locations in one process, sharing one scheduler,
+one pool of worker processes and the same concurrency limits between them,
+rather than running a separate process (each initialising Earth Engine,
+Azure clients and its own worker pools) per location.
+
+Each location gets a normal Pipeline, with its output in a subdirectory
+<site_id> of the batch output location, laid out as for a single run.
+"""
+
+import os
+import threading
+
+import pandas as pd
+
+from pyveg.coordinates import coordinate_store
+from pyveg.src.file_utils import save_json
+from pyveg.src.pyveg_pipeline import run_task_graph
+from pyveg.src.processor_modules import make_worker_pool
+try:
+    from pyveg.src import azure_utils
+except:
+    print("Azure utils could not be imported - is Azure SDK installed?")
+
+
+BATCH_SUMMARY_FILENAME = "batch_summary.json"
+
+
+def read_sites(coordinate_ids=None, coordinates_csv=None):
+    """
+    Get the locations to run on, either by their ids in the coordinate_store
+    of coordinates.py, or from a csv file with columns 'latitude' and
+    'longitude', and optionally 'id'.  If neither is given, use every
+    location in the coordinate_store.
+
+    Returns
+    =======
+    sites: list of tuples (site_id, (longitude, latitude))
+    """
+    if coordinates_csv:
+        sites_df = pd.read_csv(coordinates_csv, dtype={"id": str})
+        for column in ["latitude", "longitude"]:
+            if column not in sites_df.columns:
+                raise RuntimeError("{} needs a {} column".format(coordinates_csv, column))
+        if "id" in sites_df.columns:
+            sites_df = sites_df.set_index("id")
+        else:
+            sites_df.index = ["{:02d}".format(i) for i in range(len(sites_df))]
+    else:
+        sites_df = coordinate_store
+        if coordinate_ids:
+            unknown_ids = [i for i in coordinate_ids if i not in coordinate_store.index]
+            if unknown_ids:
+                raise RuntimeError("Unknown coordinate ids {}".format(unknown_ids))
+            sites_df = coordinate_store.loc[coordinate_ids]
+    if not sites_df.index.is_unique:
+        raise RuntimeError("Location ids must be unique")
+    # note (long, lat) GEE convention
+    return [(str(site_id), (row.longitude, row.latitude)) \
+            for site_id, row in sites_df.iterrows()]
+
+
+class BatchRunner(object):
+    """
+    Runs the Pipelines for several locations, with the sequences of all the
+    pipelines in one scheduler, so that at most max_parallel_sequences run at
+    once over the whole batch.  Downloads and image processing are limited
+    to max_parallel_downloads and max_parallel_processing dates at once over
+    the whole batch, and network centrality is calculated in one pool of
+    n_worker_processes worker processes.
+    A location failing doesn't stop the others.
+    """
+
+    def __init__(self, name, output_location, output_location_type="local"):
+        self.name = name
+        self.output_location = output_location
+        self.output_location_type = output_location_type
+        self.pipelines = {}
+        # -1 means one per cpu for these
+        self.max_parallel_sequences = 4
+        self.max_parallel_downloads = 4
+        self.max_parallel_processing = -1
+        self.n_worker_processes = -1
+        self.concurrency_limits = {}
+        self.is_configured = False
+
+
+    def get_site_output_location(self, site_id):
+        return os.path.join(self.output_location, site_id)
+
+
+    def add_site(self, site_id, pipeline):
+        """
+        Add the pipeline for one location, which should have its output
+        location set to get_site_output_location(site_id).
+        """
+        if site_id in self.pipelines:
+            raise RuntimeError("{}: already have a pipeline for location {}"\
+                               .format(self.name, site_id))
+        self.pipelines[site_id] = pipeline
+
+
+    def get_limit(self, value):
+        if value > 0:
+            return value
+        return os.cpu_count() or 1
+
+
+    def configure(self):
+        """
+        Configure all the pipelines, sharing the concurrency limits between them.
+        """
+        if not self.pipelines:
+            raise RuntimeError("{}: need to add some locations before calling configure()"\
+                               .format(self.name))
+        self.concurrency_limits = {
+            "download": threading.Semaphore(self.get_limit(self.max_parallel_downloads)),
+            "processing": threading.Semaphore(self.get_limit(self.max_parallel_processing))
+        }
+        for pipeline in self.pipelines.values():
+            pipeline.concurrency_limits = self.concurrency_limits
+            pipeline.configure()
+        self.is_configured = True
+
+
+    def get_tasks(self):
+        """
+        Return the sequences of all the pipelines, as a list of tasks
+        (key, function) in dependency order, and the dependency graph,
+        for run_task_graph.  Keys are "<site_id>/<sequence_name>".
+        """
+        tasks = []
+        graph = {}
+        for site_id, pipeline in self.pipelines.items():
+            for sequence_name, depends_on in pipeline.get_dependency_graph().items():
+                graph["{}/{}".format(site_id, sequence_name)] = \
+                    set("{}/{}".format(site_id, name) for name in depends_on)
+            for sequence in pipeline.get_run_order():
+                tasks.append(("{}/{}".format(site_id, sequence.name), sequence.run))
+        return tasks, graph
+
+
+    def run(self):
+        """
+        Run the sequences of all the pipelines, then write the run report of
+        each pipeline, and a summary of which locations succeeded.
+        Returns the summary.
+        """
+        if not self.is_configured:
+            raise RuntimeError("{}: need to call configure() before run()".format(self.name))
+        worker_pool = make_worker_pool(self.get_limit(self.n_worker_processes))
+        for pipeline in self.pipelines.values():
+            pipeline.worker_pool = worker_pool
+        tasks, graph = self.get_tasks()
+        try:
+            failures, not_run = run_task_graph(tasks, graph,
+                                               self.get_limit(self.max_parallel_sequences),
+                                               self.name, stop_on_failure=False)
+        finally:
+            worker_pool.close()
+            worker_pool.join()
+            for pipeline in self.pipelines.values():
+                pipeline.worker_pool = None
+                pipeline.save_manifest()
+                pipeline.write_run_report()
+        summary = self.get_summary(failures, not_run)
+        self.write_summary(summary)
+        return summary
+
+
+    def get_summary(self, failures, not_run):
+        """
+        Return a dict describing the outcome for each location.
+        """
+        sites = []
+        for site_id, pipeline in self.pipelines.items():
+            prefix = site_id + "/"
+            site_failures = {key[len(prefix):]: str(e) for key, e in failures.items() \
+                             if key.startswith(prefix)}
+            site_not_run = [key[len(prefix):] for key in not_run if key.startswith(prefix)]
+            sites.append({
+                "id": site_id,
+                "coordinates": list(pipeline.coords),
+                "output_location": pipeline.output_location,
+                "status": "failed" if site_failures else "succeeded",
+                "failed_sequences": site_failures,
+                "sequences_not_run": site_not_run
+            })
+        return {"name": self.name,
+                "n_succeeded": len([s for s in sites if s["status"] == "succeeded"]),
+                "n_failed": len([s for s in sites if s["status"] == "failed"]),
+                "sites": sites}
+
+
+    def write_summary(self, summary):
+        """
+        Save the summary to batch_summary.json in the batch output location.
+        """
+        if self.output_location_type == "local":
+            save_json(summary, self.output_location, BATCH_SUMMARY_FILENAME)
+        elif self.output_location_type == "azure":
+            container_name = azure_utils.sanitize_container_name(self.output_location)
+            azure_utils.create_container(container_name)
+            azure_utils.save_json(summary, container_name,
+                                  BATCH_SUMMARY_FILENAME, container_name)
+        else:
+            raise RuntimeError("Unknown location_type - must be 'local' or 'azure'")
@@ -0,0 +1,197 @@
+"""
+On-disk cache of subgraph centrality results, so that identical
+binary sub-images (e.g. all-black or all-white tiles over bare soil, or
+tiles that are re-processed) don't need the calculation to be redone.
+
+Results are stored in an SQLite database, keyed by a hash of the
+bit-packed binary image plus the parameters of the calculation.
+The least recently used entries are removed, in batches, when the number
+of entries goes above max_entries.
+
+Many worker processes may share one database, so lookups avoid writing:
+the last-used time of an entry is only updated if it is older than
+touch_interval seconds, and those updates are written in batches.
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+
+import numpy as np
+
+from .subgraph_centrality import subgraph_centrality
+
+
+# keep one open cache per database file for each process, so that
+# e.g. multiprocessing workers don't reconnect for every sub-image.
+_open_caches = {}
+
+# included in the cache keys, and increased whenever a change to the
+# calculation changes the feature vectors, so old results aren't reused.
+# 2: pixels with tied subgraph centrality are ordered by pixel index.
+SC_VERSION = 2
+
+
+def get_cache(db_path, max_entries=100000):
+    """
+    Return the FeatureVectorCache for this database file, creating it if
+    this process doesn't already have one open.
+    """
+    if db_path not in _open_caches:
+        _open_caches[db_path] = FeatureVectorCache(db_path, max_entries)
+    return _open_caches[db_path]
+
+
+class FeatureVectorCache(object):
+    """
+    Map hashes of binary images (and calculation parameters) to
+    subgraph centrality feature vectors.
+    """
+
+    def __init__(self, db_path, max_entries=100000, touch_interval=60.,
+                 touch_batch_size=100, evict_fraction=0.1):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        # only update last_used times older than this (in seconds)
+        self.touch_interval = touch_interval
+        # number of last_used updates to write at once
+        self.touch_batch_size = touch_batch_size
+        # when over max_entries, remove this fraction of them as well
+        self.evict_fraction = evict_fraction
+        self.pending_touches = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # several processes may share the database, so wait for locks
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS feature_vectors (
+            key TEXT PRIMARY KEY,
+            feature_vec BLOB NOT NULL,
+            last_used REAL NOT NULL
+        )""")
+        self.connection.execute("""
+        CREATE INDEX IF NOT EXISTS last_used_index
+        ON feature_vectors (last_used)
+        """)
+        self.connection.commit()
+        # running count of entries, which doesn't include entries added by
+        # other processes - the real count is checked before evicting.
+        self.n_entries = len(self)
+
+
+    @staticmethod
+    def make_key(image, threshold=255, **params):
+        """
+        Hash the binary version of the image (pixels >= threshold), its
+        shape, the threshold, and any other parameters of the calculation
+        (e.g. use_diagonal_neighbours, num_quantiles).
+        """
+        binary_image = np.asarray(image) >= threshold
+        hasher = hashlib.sha1()
+        hasher.update(np.packbits(binary_image).tobytes())
+        hasher.update(str(binary_image.shape).encode())
+        hasher.update(str(threshold).encode())
+        for k in sorted(params.keys()):
+            hasher.update("{}={}".format(k, params[k]).encode())
+        return hasher.hexdigest()
+
+
+    def get(self, key):
+        """
+        Return the cached feature vector, or None if it isn't there.
+        """
+        row = self.connection.execute(
+            "SELECT feature_vec, last_used FROM feature_vectors WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        now = time.time()
+        if now - row[1] > self.touch_interval:
+            self.pending_touches[key] = now
+            if len(self.pending_touches) >= self.touch_batch_size:
+                self.write_touches()
+                self.connection.commit()
+        return np.frombuffer(row[0], dtype=np.float64).copy()
+
+
+    def write_touches(self):
+        """
+        Update the last_used times of the entries used since the last call.
+        """
+        if self.pending_touches:
+            self.connection.executemany(
+                "UPDATE feature_vectors SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self.pending_touches.items()])
+            self.pending_touches = {}
+
+
+    def put(self, key, feature_vec):
+        """
+        Store a feature vector, then if we have more than max_entries,
+        remove the least recently used ones, along with evict_fraction of
+        max_entries more, so that eviction isn't needed on every put.
+        """
+        feature_vec = np.asarray(feature_vec, dtype=np.float64)
+        self.write_touches()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO feature_vectors VALUES (?, ?, ?)",
+            (key, feature_vec.tobytes(), time.time()))
+        self.n_entries += 1
+        if self.n_entries > self.max_entries:
+            self.n_entries = len(self)
+            if self.n_entries > self.max_entries:
+                n_evict = self.n_entries - self.max_entries \
+                    + int(self.max_entries * self.evict_fraction)
+                self.connection.execute("""
+                DELETE FROM feature_vectors WHERE key IN (
+                    SELECT key FROM feature_vectors ORDER BY last_used ASC LIMIT ?
+                )""", (n_evict,))
+                self.n_entries -= n_evict
+        self.connection.commit()
+
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM feature_vectors").fetchone()[0]
+
+
+    def close(self):
+        self.write_touches()
+        self.connection.commit()
+        self.connection.close()
+        if _open_caches.get(self.db_path) is self:
+            del _open_caches[self.db_path]
+
+
+def cached_subgraph_centrality(image, cache,
+                               use_diagonal_neighbours=False,
+                               num_quantiles=20,
+                               threshold=255):
+    """
+    Return the subgraph centrality feature vector for this image from the
+    cache if it is there, otherwise calculate it and add it to the cache.
+
+    Returns
+    =======
+    feature_vec: np.ndarray, as from subgraph_centrality
+    cache_hit: bool, True if the result came from the cache.
+    """
+    key = cache.make_key(image, threshold,
+                         use_diagonal_neighbours=use_diagonal_neighbours,
+                         num_quantiles=num_quantiles,
+                         sc_version=SC_VERSION)
+    feature_vec = cache.get(key)
+    if feature_vec is not None:
+        return feature_vec, True
+    feature_vec, _ = subgraph_centrality(image,
+                                         use_diagonal_neighbours,
+                                         num_quantiles,
+                                         threshold)
+    cache.put(key, feature_vec)
+    return np.asarray(feature_vec, dtype=np.float64), False
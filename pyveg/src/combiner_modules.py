@@ -112,7 +112,8 @@ class VegAndWeatherJsonCombiner(BaseModule):
                     veg_lists.append(j)
             
             date_path = os.path.join(self.input_veg_location, date_string)
-            if "SPLIT" not in self.list_directory(date_path, self.input_veg_location_type):
+            date_contents = self.list_directory(date_path, self.input_veg_location_type)
+            if "TILES" not in date_contents and "SPLIT" not in date_contents:
                 continue
             
             veg_time_point = self.combine_json_lists(veg_lists)
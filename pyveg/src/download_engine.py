@@ -0,0 +1,201 @@
+"""
+Download zipfiles from GEE (or any HTTP server) concurrently, over a pool
+of connections shared between threads, retrying with exponential backoff
+when the server is busy (HTTP 429), has an error (5xx), or the connection
+fails or times out.
+"""
+
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pyveg.src.file_utils import unzip_download
+from pyveg.src.instrumentation import increment
+
+
+# HTTP status codes worth trying again after a while
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class DownloadError(RuntimeError):
+    """
+    A download failed, and retrying won't help (e.g. 404), or the
+    retries have run out.
+    """
+    pass
+
+
+class DownloadEngine(object):
+    """
+    Downloads files with one requests.Session, so connections to the
+    server are reused, with at most max_parallel_downloads at once.
+    Can be shared between threads.
+
+    Parameters
+    ==========
+    max_parallel_downloads: int, max number of requests in flight at once,
+                            and the number of pooled connections.
+    max_retries: int, number of times to retry a failed download.
+    backoff_factor: float, the wait before retry n is a random time up to
+                    backoff_factor * 2**n seconds, capped at max_backoff
+                    (or what the server asks for in a Retry-After header).
+    max_backoff: float, longest wait in seconds between retries.
+    timeout: float, seconds to wait for the server to connect, and then
+             between bytes of the response.
+    """
+
+    def __init__(self, max_parallel_downloads=4, max_retries=5,
+                 backoff_factor=1., max_backoff=60., timeout=300):
+        self.max_parallel_downloads = max(1, max_parallel_downloads)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_parallel_downloads,
+                              pool_maxsize=self.max_parallel_downloads)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.download_slots = threading.Semaphore(self.max_parallel_downloads)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        self.session.close()
+
+
+    def get_backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number attempt (counting from 0) -
+        random between 0 and the exponential backoff ("full jitter"), so
+        that threads that failed together don't all retry together.
+        If the server gave a Retry-After time in seconds, wait at least that.
+        """
+        backoff = random.uniform(0, min(self.max_backoff,
+                                        self.backoff_factor * 2**attempt))
+        if retry_after is not None:
+            try:
+                backoff = max(backoff, min(self.max_backoff, float(retry_after)))
+            except ValueError:
+                # could be an HTTP date - just use our own backoff
+                pass
+        return backoff
+
+
+    def get(self, url):
+        """
+        GET the url, retrying if the server is busy or unavailable.
+
+        Returns
+        =======
+        response: requests.Response with status 200.
+
+        Raises
+        ======
+        DownloadError if the server returns a status that isn't worth
+        retrying, or the retries run out.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = self.try_get(url)
+            if response.status_code == 200:
+                return response
+            self.wait_before_retry(url, attempt, response.status_code,
+                                   response.headers.get("Retry-After"))
+        # try_get or wait_before_retry raise before we get here
+        raise DownloadError("Failed to download {}".format(url))
+
+
+    def try_get(self, url):
+        """
+        One GET request, raising DownloadError for a status that isn't
+        worth retrying.  Connection errors and timeouts give a response
+        with status_code None.
+        """
+        try:
+            with self.download_slots:
+                response = self.session.get(url, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print("Error downloading {}: {}".format(url, e))
+            response = requests.Response()
+            response.status_code = None
+            return response
+        if response.status_code != 200 and \
+           response.status_code not in RETRY_STATUS_CODES:
+            raise DownloadError("HTTP Error {} getting download link {}"\
+                                .format(response.status_code, url))
+        return response
+
+
+    def wait_before_retry(self, url, attempt, reason, retry_after=None):
+        """
+        Sleep before retrying url, or raise DownloadError if this was
+        the last attempt.
+        """
+        if attempt >= self.max_retries:
+            raise DownloadError("Failed to download {} after {} attempts ({})"\
+                                .format(url, attempt + 1, reason))
+        backoff = self.get_backoff(attempt, retry_after)
+        print("Download of {} failed ({}) - retrying in {:.1f}s"\
+              .format(url, reason, backoff))
+        increment("download_retries")
+        time.sleep(backoff)
+
+
+    def download_and_unzip(self, url, output_dir):
+        """
+        Download the zipfile at url and extract it into output_dir,
+        downloading again if the zipfile is corrupt (e.g. truncated).
+        Failed requests and corrupt zipfiles share the same max_retries.
+
+        Returns
+        =======
+        tif_filenames: list of strings, the full paths to unpacked tif files.
+        """
+        for attempt in range(self.max_retries + 1):
+            response = self.try_get(url)
+            if response.status_code != 200:
+                self.wait_before_retry(url, attempt, response.status_code,
+                                       response.headers.get("Retry-After"))
+                continue
+            tif_filenames = unzip_download(response.content, url, output_dir)
+            if tif_filenames is not None:
+                return tif_filenames
+            self.wait_before_retry(url, attempt, "bad zipfile")
+
+
+    @staticmethod
+    def get_url_dirs(n_urls, output_dir):
+        """
+        The subdirectories of output_dir that download_all extracts
+        each of n_urls zipfiles into, in the same order as the urls.
+        """
+        return [os.path.join(output_dir, str(i)) for i in range(n_urls)]
+
+
+    def download_all(self, urls, output_dir):
+        """
+        Download and extract zipfiles from all the urls at once, each into
+        its own subdirectory of output_dir (see get_url_dirs), so their
+        files don't clash.
+
+        Returns
+        =======
+        tif_filenames: list with the tif filenames for each url.
+        """
+        output_dirs = self.get_url_dirs(len(urls), output_dir)
+        if len(urls) == 1:
+            return [self.download_and_unzip(urls[0], output_dirs[0])]
+        with ThreadPoolExecutor(max_workers=self.max_parallel_downloads) as executor:
+            return list(executor.map(self.download_and_unzip, urls, output_dirs))
@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import dateparser
 import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 from geetools import cloud_mask
 import cv2 as cv
@@ -21,11 +22,12 @@ from pyveg.src.date_utils import (
     slice_time_period_into_n,
     slice_time_period
     )
-from pyveg.src.file_utils import download_and_unzip
+from pyveg.src.download_engine import DownloadEngine
 from pyveg.src.coordinate_utils import get_region_string
 from pyveg.src.gee_interface import apply_mask_cloud, add_NDVI
 
 from pyveg.src.pyveg_pipeline import BaseModule
+from pyveg.src import instrumentation
 
 # silence google API WARNING
 import logging
@@ -48,7 +50,11 @@ class BaseDownloader(BaseModule):
                          ("scale", [int]),
                          ("output_location", [str]),
                          ("output_location_type", [str]),
-                         ("replace_existing_files", [bool]) ]
+                         ("replace_existing_files", [bool]),
+                         ("n_threads", [int]),
+                         ("download_max_retries", [int]),
+                         ("download_timeout", [int, float]) ]
+        self.concurrency_group = "download"
         return
 
 
@@ -69,6 +75,12 @@ class BaseDownloader(BaseModule):
             self.output_location_type = "local"
         if not "replace_existing_files" in vars(self):
             self.replace_existing_files = False
+        if not "n_threads" in vars(self):
+            self.n_threads = 4 # number of dates to download at once, -1 means one per cpu
+        if not "download_max_retries" in vars(self):
+            self.download_max_retries = 5
+        if not "download_timeout" in vars(self):
+            self.download_timeout = 300 # seconds
 
         return
 
@@ -120,6 +132,7 @@ class BaseDownloader(BaseModule):
 
         dataset = image_coll.filterBounds(geom).filterDate(start_date,end_date)
         dataset_size = dataset.size().getInfo()
+        instrumentation.increment("gee_calls")
 
         if dataset_size == 0:
             print('No images found in this date rage, skipping.')
@@ -131,6 +144,7 @@ class BaseDownloader(BaseModule):
         for image in image_list:
             # get a URL from which we can download the resulting data
             try:
+                instrumentation.increment("gee_calls")
                 url = image.getDownloadURL(
                     {'region': region,
                      'scale': self.scale}
@@ -139,7 +153,7 @@ class BaseDownloader(BaseModule):
             except Exception as e:
                 print("Unable to get URL: {}".format(e))
 
-            logging.info(f'OK   >>> Found {dataset.size().getInfo()}/{dataset_size} valid images after cloud filtering.')
+        logging.info(f'OK   >>> Found {len(image_list)}/{dataset_size} valid images after cloud filtering.')
         return url_list
 
 
@@ -163,36 +177,117 @@ class BaseDownloader(BaseModule):
             return False
 
         # download files and unzip to temporary directory
-        tempdir = tempfile.TemporaryDirectory()
-        for download_url in download_urls:
-            download_and_unzip(download_url,
-                               tempdir.name)
-        print("Wrote zipfiles to {}".format(tempdir.name))
-        print("download_location is {}".format(download_location))
-        self.copy_to_output_location(tempdir.name, download_location, [".tif"])
+        with tempfile.TemporaryDirectory() as tempdir:
+            instrumentation.increment("downloads", len(download_urls))
+            engine = self.get_download_engine()
+            engine.download_all(download_urls, tempdir)
+            print("Wrote zipfiles to {}".format(tempdir))
+            print("download_location is {}".format(download_location))
+            # the zipfiles all have the same filenames - copy them in
+            # url order, so the files from the last url are kept.
+            for url_dir in engine.get_url_dirs(len(download_urls), tempdir):
+                self.copy_to_output_location(url_dir, download_location, [".tif"])
         return True
 
 
-    def run(self):
-        super().run()
+    def get_n_workers(self):
+        """
+        Number of dates to download at once - n_threads, or the
+        number of cpus if n_threads is -1 (or any value < 1).
+        """
+        if self.n_threads > 0:
+            return self.n_threads
+        return os.cpu_count() or 1
+
+
+    def get_download_engine(self):
+        """
+        Return the DownloadEngine for this run, which shares its connections
+        between all the dates being downloaded, creating it if needed.
+        """
+        if getattr(self, "download_engine", None) is None:
+            self.download_engine = DownloadEngine(self.get_n_workers(),
+                                                  self.download_max_retries,
+                                                  timeout=self.download_timeout)
+        return self.download_engine
+
+
+    def start_streaming(self):
+        self.get_download_engine()
+
+
+    def finish_streaming(self):
+        self.download_engine.close()
+        self.download_engine = None
+
+
+    def get_date_ranges(self):
+        """
+        Return a dict {mid_date: [start_date, end_date]} of the
+        date sub-ranges to download, one per time point.
+        """
         start_date, end_date = self.date_range
         date_ranges = slice_time_period(start_date,
                                         end_date,
                                         self.time_per_point)
+        return {find_mid_period(date_range[0], date_range[1]): date_range \
+                for date_range in date_ranges}
+
+
+    def list_dates(self):
+        return list(self.get_date_ranges().keys())
+
+
+    def get_output_dirs(self, date_string):
+        return [os.path.join(self.output_location, date_string, "RAW")]
+
+
+    def process(self, date_string):
+        """
+        Download the data for the date sub-range with mid-point date_string,
+        to <output_location>/<date_string>/RAW.
+        Returns True if there is data for this date, whether it was
+        downloaded now or already there.
+        """
+        location = os.path.join(self.output_location, date_string, "RAW")
+        if not self.replace_existing_files and \
+           self.check_for_existing_files(location, self.num_files_per_point):
+            return True
+        date_range = self.get_date_ranges()[date_string]
+        urls = self.prep_data(date_range)
+        print("{}: got URL {} for date range {}".format(self.name,
+                                                        urls,
+                                                        date_range))
+        return self.download_data(urls, location)
+
+
+    def run(self):
+        """
+        Prepare the URLs for, and download, up to n_threads dates at once.
+        If some dates fail, the others are still downloaded, then the
+        first exception is re-raised.
+        """
+        super().run()
+        self.start_streaming()
+        try:
+            date_strings = self.list_dates()
+            with ThreadPoolExecutor(max_workers=self.get_n_workers()) as executor:
+                futures = [executor.submit(self.run_date, date_string) \
+                           for date_string in date_strings]
+        finally:
+            self.finish_streaming()
         download_locations = []
-        for date_range in date_ranges:
-            mid_date = find_mid_period(date_range[0], date_range[1])
-            location = os.path.join(self.output_location, mid_date, "RAW")
-            if not self.replace_existing_files and \
-               self.check_for_existing_files(location, self.num_files_per_point):
-                continue
-            urls = self.prep_data(date_range)
-            print("{}: got URL {} for date range {}".format(self.name,
-                                                            urls,
-                                                            date_range))
-            downloaded_ok = self.download_data(urls, location)
-            if downloaded_ok:
-                download_locations.append(location)
+        failures = []
+        for date_string, future in zip(date_strings, futures):
+            if future.exception():
+                print("{}: download for {} failed: {}".format(self.name, date_string,
+                                                             future.exception()))
+                failures.append(future.exception())
+            elif future.result():
+                download_locations.append(os.path.join(self.output_location,
+                                                       date_string, "RAW"))
+        if failures:
+            raise failures[0]
         return download_locations
 
 
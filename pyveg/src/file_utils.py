@@ -33,17 +33,19 @@ def split_filepath(path):
 
 
 
-def download_and_unzip(url, output_tmpdir):
+def download_and_unzip(url, output_tmpdir, timeout=300):
     """
     Given a URL from GEE, download it (will be a zipfile) to
     a temporary directory, then extract archive to that same dir.
     Then find the base filename of the resulting .tif files (there
     should be one-file-per-band) and return that.
+    For many downloads, with retries, use download_engine.DownloadEngine.
 
     Parameters
     ==========
     url: str, URL of zipfile on GEE server.
     output_tmpdir: str, full path of directory into which to unpack zipfile.
+    timeout: float, seconds to wait for the server before giving up.
 
     Returns
     =======
@@ -52,13 +54,26 @@ def download_and_unzip(url, output_tmpdir):
 
     #print("Will download {} to {}".format(url, output_tmpdir))
     # GET the URL
-    r = requests.get(url)
+    r = requests.get(url, timeout=timeout)
     if not r.status_code == 200:
         raise RuntimeError(" HTTP Error getting download link {}".format(url))
+    return unzip_download(r.content, url, output_tmpdir)
+
+
+def unzip_download(content, url, output_tmpdir):
+    """
+    Save the contents of a zipfile downloaded from url to output_tmpdir,
+    and extract it there.
+
+    Returns
+    =======
+    tif_filenames: list of strings, the full paths to unpacked tif files,
+                   or None if the zipfile couldn't be read.
+    """
     os.makedirs(output_tmpdir, exist_ok=True)
     output_zipfile = os.path.join(output_tmpdir,"gee.zip")
     with open(output_zipfile, "wb") as outfile:
-        outfile.write(r.content)
+        outfile.write(content)
     ## catch zipfile-related exceptions here, and if they arise,
     ## write the name of the zipfile and the url to a logfile
     try:
@@ -66,9 +81,9 @@ def download_and_unzip(url, output_tmpdir):
             zip_obj.extractall(path=output_tmpdir)
     except(BadZipFile):
         with open(LOGFILE, "a") as logfile:
-            logfile.write("{}: {} {}\n".format(str(datetime.now()),
-                                               output_zipfile,
-                                               url))
+            logfile.write("{}: {} {}\n".format(str(datetime.datetime.now()),
+                                                output_zipfile,
+                                                url))
         return None
     tif_files = [filename for filename in os.listdir(output_tmpdir) \
                  if filename.endswith(".tif")]
@@ -22,8 +22,20 @@ matplotlib.use('PS')
 import matplotlib.pyplot as plt
 
 from .coordinate_utils import get_sub_image_coords
+from .tif_utils import WindowedTifReader, DEFAULT_BLOCK_ROWS
 from .file_utils import save_image
 
+def get_pixel_array(image):
+    """
+    Return the pixel values of a PIL Image as a numpy array of shape
+    (y, x) or (y, x, bands), with the same values as from image.load()
+    (so for 1-bit images, pixels are 0 or 255 rather than bool).
+    """
+    if image.mode == "1":
+        image = image.convert("L")
+    return np.asarray(image)
+
+
 def image_from_array(input_array, output_size=None, sel_val=200):
     """
     Convert a 2D numpy array of values into
@@ -31,19 +43,15 @@ def image_from_array(input_array, output_size=None, sel_val=200):
     the corresponding value in the array.
     If an output size is specified, rescale to this size.
     """
-    size_x, size_y = input_array.shape
-    new_img = Image.new("RGB", (size_x, size_y))
-    # count the number of distinct values in the array
-    for ix in range(size_x):
-        for iy in range(size_y):
-            val = int(input_array[ix, iy])
-
-            if val == sel_val:
-                new_img.putpixel((ix, iy), (0, val, val))
-            else:
-                new_img.putpixel((ix, iy), (val, val, val))
+    # int() of each value, with PIL clipping rgb values to 0-255
+    vals = np.trunc(np.asarray(input_array, dtype=np.float64))
+    # pixels equal to sel_val get red set to 0
+    red = np.where(vals == sel_val, 0, vals)
+    # array index [ix, iy] is the image x,y coordinate, so transpose
+    rgb_array = np.stack([red, vals, vals], axis=-1).transpose(1, 0, 2)
+    new_img = Image.fromarray(np.clip(rgb_array, 0, 255).astype(np.uint8), "RGB")
     if output_size:
-        new_img = new_img.resize((output_size, output_size), Image.ANTIALIAS)
+        new_img = new_img.resize((output_size, output_size), Image.LANCZOS)
     return new_img
 
 
@@ -62,63 +70,122 @@ def invert_binary_image(image):
     """
     Swap (255,255,255) with (0,0,0) for all pixels
     """
-    new_img = Image.new("RGB", image.size)
-    pix = image.load()
-    for ix in range(image.size[0]):
-        for iy in range(image.size[1]):
-            if sum(pix[ix, iy]) == 0:
-                new_img.putpixel((ix, iy), (255, 255, 255))
-            else:
-                new_img.putpixel((ix, iy), (0, 0, 0))
-    return new_img
+    pix = get_pixel_array(image)
+    total = pix.sum(axis=2, dtype=np.int64) if pix.ndim == 3 else pix
+    bw_array = np.where(total == 0, 255, 0).astype(np.uint8)
+    return Image.fromarray(np.repeat(bw_array[:, :, np.newaxis], 3, axis=2), "RGB")
+
+
+def get_work_array(pix):
+    """
+    Return an empty array the same shape as pix, to hold intermediate
+    values when rescaling it.  The dtype is the same as pix if that is
+    floating point (as it would be for each pixel value individually),
+    or float64 for integer arrays.
+    """
+    work_dtype = pix.dtype if np.issubdtype(pix.dtype, np.floating) else np.float64
+    return np.empty(pix.shape, dtype=work_dtype)
+
+
+def float_array_to_uint8(float_array):
+    """
+    Convert every value to int (truncating towards zero), and clip
+    to the range 0-255 as PIL does when setting rgb values, with NaN
+    set to 0.  float_array is modified in place.
+
+    Parameters
+    ==========
+    float_array: numpy array of floating point values
+
+    Returns
+    =======
+    uint8 numpy array with the same shape.
+    """
+    np.trunc(float_array, out=float_array)
+    np.nan_to_num(float_array, copy=False)
+    np.clip(float_array, 0, 255, out=float_array)
+    return float_array.astype(np.uint8)
 
 
 #def combine_tif(input_files, bands=["B4", "B3", "B2"]):
-def combine_tif(band_dict):
+def combine_tif(band_dict, block_rows=DEFAULT_BLOCK_ROWS):
     """
     Read tif files - one per specified band, and rescale and combine
     pixel values to r,g,b values betweek 0 and 255 in a combined output image.
+    The tif files are read block_rows rows at a time, so only the 8-bit
+    output image is held in memory in full.
 
     Parameters
     ==========
     band_dict: dict, format {'<r|g|b>': {'band': <band_name>, 'filename': <filename>}}
+    block_rows: int, number of rows of the tif files to read at a time.
 
     Returns
     =======
     new_img: PIL Image, 8-bit rgb image.
     """
-    for v in band_dict.values():
-        v["min_val"] = sys.maxsize
-        v["max_val"] = -1*sys.maxsize
-        v["pix_vals"] = []
-
     for col in band_dict.keys():
-        pix = cv.imread(band_dict[col]["filename"],cv.IMREAD_ANYDEPTH)
+        reader = WindowedTifReader(band_dict[col]["filename"])
         # find the minimum and maximum pixel values in the original scale
-        for ix in range(pix.shape[0]):
-            for iy in range(pix.shape[1]):
-                if pix[ix, iy] > band_dict[col]["max_val"]:
-                    band_dict[col]["max_val"] = pix[ix, iy]
-                elif pix[ix, iy] < band_dict[col]["min_val"]:
-                    band_dict[col]["min_val"] = pix[ix, iy]
-        band_dict[col]["pix_vals"] = pix
+        max_val, min_val = np.nan, np.nan
+        for _, block in reader.iter_row_blocks(block_rows):
+            max_val = np.fmax(max_val, np.fmax.reduce(block, axis=None))
+            min_val = np.fmin(min_val, np.fmin.reduce(block, axis=None))
+        band_dict[col]["max_val"] = max_val
+        band_dict[col]["min_val"] = min_val
+        band_dict[col]["reader"] = reader
     # Take the overall max of the three bands to be the value to scale down with.
     overall_max = max((band_dict[col]["max_val"] for col in ["r", "g", "b"]))
 
-    # create a new image where we will fill RGB pixel values from 0 to 255
-    def get_pix_val(ix, iy, col): return \
-        max(0, int(band_dict[col]["pix_vals"][ix, iy] * 255 / \
-                   #                   band_dict[col]["max_val"]
-                   (overall_max+1)
-                   ))
-    new_img = Image.new("RGB", pix.shape)
-    for ix in range(new_img.size[0]):
-        for iy in range(new_img.size[1]):
-            new_img.putpixel((ix, iy), tuple(get_pix_val(ix, iy, col)
-                                             for col in ["r", "g", "b"]))
+    # fill RGB pixel values from 0 to 255, block by block.
+    # Note that the image x,y coordinates are the array's row,column,
+    # so the image is the transpose of the array.
+    rgb_array = np.empty(reader.shape[::-1] + (3,), dtype=np.uint8)
+    for icol, col in enumerate(["r", "g", "b"]):
+        reader = band_dict[col].pop("reader")
+        for row_start, block in reader.iter_row_blocks(block_rows):
+            # same as int(pix * 255 / (overall_max+1)) for each pixel
+            buffer = get_work_array(block)
+            np.multiply(block, 255, out=buffer)
+            np.divide(buffer, overall_max+1, out=buffer)
+            rgb_array[:, row_start:row_start+len(block), icol] = \
+                float_array_to_uint8(buffer).T
+        reader.close()
+    new_img = Image.fromarray(rgb_array, "RGB")
     return new_img
 
 
+def scale_tif_to_array(input_filename, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Given only a single band, scale to range 0,255 and return as a
+    2D greyscale array, in the same orientation as the image from scale_tif
+    (i.e. ready for openCV functions or Image.fromarray).
+    The tif file is read block_rows rows at a time.
+
+    Parameters
+    ==========
+    input_filename: str, location of input image
+    block_rows: int, number of rows of the tif file to read at a time.
+
+    Returns
+    =======
+    grey_array: 2D uint8 numpy array.
+    """
+    reader = WindowedTifReader(input_filename)
+    # the image x,y coordinates are the array's row,column (i.e. transpose)
+    grey_array = np.empty(reader.shape[::-1], dtype=np.uint8)
+    for row_start, block in reader.iter_row_blocks(block_rows):
+        # global linear transform from [-1, 1] -> [0, 255]
+        # tested in issue #224
+        buffer = get_work_array(block)
+        np.add(block, 1, out=buffer)
+        np.divide(buffer, 2, out=buffer)
+        np.multiply(buffer, 255, out=buffer)
+        grey_array[:, row_start:row_start+len(block)] = float_array_to_uint8(buffer).T
+    reader.close()
+    return grey_array
+
+
 def scale_tif(input_filename):
     """
     Given only a single band, scale to range 0,255 and apply this
@@ -132,32 +199,9 @@ def scale_tif(input_filename):
     =======
     new_img: pillow Image.
     """
-    max_val = -1*sys.maxsize
-    min_val = sys.maxsize
-    # load the single band file and extract pixel data
-
-    pix = cv.imread(input_filename,cv.IMREAD_ANYDEPTH)
-    # find the minimum and maximum pixel values in the original scale
-    #print("Found image of size {}".format(im.size))
-    for ix in range(pix.shape[0]):
-        for iy in range(pix.shape[1]):
-            if pix[ix, iy] > max_val:
-                max_val = pix[ix, iy]
-            elif pix[ix, iy] < min_val:
-                min_val = pix[ix, iy]
-
-    # create a new image where we will fill RGB pixel values from 0 to 255
-
-    # global linear transform from [-1, 1] -> [0, 255]
-    # tested in issue #224
-    def get_pix_val(ix, iy): return \
-        int((pix[ix, iy] + 1 ) / 2 * 255)
-
-    new_img = Image.new("RGB", pix.shape)
-    for ix in range(new_img.size[0]):
-        for iy in range(new_img.size[1]):
-            new_img.putpixel((ix, iy), tuple(get_pix_val(ix, iy)
-                                             for col in ["r", "g", "b"]))
+    grey_array = scale_tif_to_array(input_filename)
+    rgb_array = np.repeat(grey_array[:, :, np.newaxis], 3, axis=2)
+    new_img = Image.fromarray(rgb_array, "RGB")
     return new_img
 
 
@@ -200,17 +244,104 @@ def plot_band_values(input_filebase, bands=["B4", "B3", "B2"]):
     plt.show()
 
 
+def get_tile_view(image_array, n_pix_x, n_pix_y=None,
+                  stride_x=None, stride_y=None):
+    """
+    Divide an image array into tiles of fixed pixel size without copying,
+    by returning a read-only strided view into the array.
+
+    Parameters
+    ==========
+    image_array: numpy array of shape (y, x[, c])
+    n_pix_x, n_pix_y: int, size of tiles in pixels.  If n_pix_y is not
+                      given, tiles are square.
+    stride_x, stride_y: int, distance in pixels between the starts of
+                        neighbouring tiles.  Default is the tile size,
+                        i.e. no overlap.
+
+    Returns
+    =======
+    tiles: numpy array view of shape (ny, nx, n_pix_y, n_pix_x[, c]),
+           where tiles[iy, ix] is the tile in row iy, column ix.
+    """
+    if not n_pix_y:
+        n_pix_y = n_pix_x
+    if not stride_x:
+        stride_x = n_pix_x
+    if not stride_y:
+        stride_y = n_pix_y
+    ysize, xsize = image_array.shape[:2]
+    ny = max(0, (ysize - n_pix_y) // stride_y + 1)
+    nx = max(0, (xsize - n_pix_x) // stride_x + 1)
+    row_stride, col_stride = image_array.strides[:2]
+    return np.lib.stride_tricks.as_strided(
+        image_array,
+        shape=(ny, nx, n_pix_y, n_pix_x) + image_array.shape[2:],
+        strides=(stride_y*row_stride, stride_x*col_stride,
+                 row_stride, col_stride) + image_array.strides[2:],
+        writeable=False)
+
+
+def iter_tiles(image_array, n_pix_x, n_pix_y=None,
+               region_size=None, coords=None,
+               stride_x=None, stride_y=None):
+    """
+    Generator yielding the tiles of an image array one at a time, as views
+    from get_tile_view, in the same order as crop_image_npix (i.e. looping
+    over y inside a loop over x).
+
+    If region_size and coords (the [long,lat] of the image centre) are
+    given, the coordinates of each tile are calculated as in
+    get_sub_image_coords, or from the tile's central pixel if the tiles
+    overlap.
+
+    Yields
+    ======
+    (ix, iy, tile, tile_coords): tile_coords is None if no coordinates
+                                 were given.
+    """
+    tiles = get_tile_view(image_array, n_pix_x, n_pix_y, stride_x, stride_y)
+    ny, nx, n_pix_y, n_pix_x = tiles.shape[:4]
+    overlapping = (stride_x and stride_x != n_pix_x) or \
+                  (stride_y and stride_y != n_pix_y)
+    sub_image_coords = []
+    if not overlapping:
+        sub_image_coords = get_sub_image_coords(coords, region_size, nx, ny)
+    elif coords and region_size:
+        ysize, xsize = image_array.shape[:2]
+        left_start = coords[0] - region_size/2
+        top_start = coords[1] + region_size/2
+        for ix in range(nx):
+            for iy in range(ny):
+                sub_image_coords.append(
+                    (left_start + (ix*stride_x + n_pix_x/2) * region_size / xsize,
+                     top_start - (iy*stride_y + n_pix_y/2) * region_size / ysize)
+                )
+    for ix in range(nx):
+        for iy in range(ny):
+            tile_coords = sub_image_coords[ix*ny+iy] if sub_image_coords else None
+            yield ix, iy, tiles[iy, ix], tile_coords
+
+
 def crop_image_npix(input_image, n_pix_x, n_pix_y=None,
                     region_size=None, coords=None):
     """
     Divide an image into smaller sub-images with fixed pixel size.
     If region_size and coordinates are provided, we want to return the
     coordinates of the sub-images along with the sub-images themselves.
+    The input can be a PIL Image, or a numpy array of shape (y, x[, c]),
+    in which case the sub-images are views into the array (see iter_tiles).
     """
     # if n_pix_y not specified, assume we want equal x,y
     if not n_pix_y:
         n_pix_y = n_pix_x
 
+    if isinstance(input_image, np.ndarray):
+        return [(tile, tile_coords) if tile_coords else tile \
+                for _, _, tile, tile_coords in iter_tiles(input_image,
+                                                          n_pix_x, n_pix_y,
+                                                          region_size, coords)]
+
     xsize, ysize = input_image.size
     x_parts = int(xsize // n_pix_x)
     y_parts = int(ysize // n_pix_y)
@@ -227,7 +358,7 @@ def crop_image_npix(input_image, n_pix_x, n_pix_y=None,
             # depending on whether we have been given coordinates,
             # return a list of images, or a list of (image,coords) tuples.
             if sub_image_coords:
-                sub_images.append((region, sub_image_coords[ix*x_parts+iy]))
+                sub_images.append((region, sub_image_coords[ix*y_parts+iy]))
             else:
                 sub_images.append(region)
 
@@ -261,23 +392,15 @@ def convert_to_bw(input_image, threshold, invert=False):
     Given an RGB input, apply a threshold to each pixel.
     If pix(r,g,b)>threshold, set to 255,255,255, if <threshold, set to 0,0,0
     """
-    pix = input_image.load()
-    new_img = Image.new("RGB", input_image.size)
-    for ix in range(input_image.size[0]):
-        for iy in range(input_image.size[1]):
-            p = pix[ix, iy]
-            try:
-                total = 0
-                for col in p:
-                    total += col
-            except:
-                total = p
-            if (invert and (total > threshold)) or \
-               ((not invert) and (total < threshold)):
-                new_img.putpixel((ix, iy), (255, 255, 255))
-            else:
-                new_img.putpixel((ix, iy), (0, 0, 0))
-    return new_img
+    pix = get_pixel_array(input_image)
+    # sum of r,g,b (or just the value, for single-band images)
+    total = pix.sum(axis=2, dtype=np.int64) if pix.ndim == 3 else pix
+    if invert:
+        is_white = total > threshold
+    else:
+        is_white = total < threshold
+    bw_array = np.where(is_white, 255, 0).astype(np.uint8)
+    return Image.fromarray(np.repeat(bw_array[:, :, np.newaxis], 3, axis=2), "RGB")
 
 
 def crop_and_convert_to_bw(input_filename, output_dir, threshold=470, num_x=50, num_y=50):
@@ -374,20 +497,28 @@ def image_file_all_same_colour(image_filename, colour=(255, 255, 255), threshold
     return is_same_colour
 
 
+def count_pixels_equal(pix, colour):
+    """
+    Count the pixels in an array from get_pixel_array that are equal
+    to colour, which is a tuple for multi-band images or a single
+    value for single-band images.
+    """
+    if pix.ndim == 2:
+        if np.ndim(colour) != 0:
+            return 0
+        return int(np.count_nonzero(pix == colour))
+    if np.ndim(colour) != 1 or len(colour) != pix.shape[2]:
+        return 0
+    return int(np.count_nonzero(np.all(pix == np.asarray(colour), axis=2)))
+
+
 def image_all_same_colour(image, colour=(255, 255, 255), threshold=0.99):
     """
     Return true if all (or nearly all) pixels are same colour
     """
     num_total = image.size[0] * image.size[1]
-    num_different = 0
-    pix = image.load()
-    for ix in range(image.size[0]):
-        for iy in range(image.size[1]):
-            if pix[ix, iy] != colour:
-                num_different += 1
-                if 1.0 - float(num_different/num_total) < threshold:
-                    return False
-    return True
+    num_different = num_total - count_pixels_equal(get_pixel_array(image), colour)
+    return not (1.0 - float(num_different/num_total) < threshold)
 
 
 def compare_binary_image_files(filename1, filename2):
@@ -408,15 +539,16 @@ def compare_binary_images(image1, image2):
     """
     if not image1.size == image2.size:
         return 0.
-    pix1 = image1.load()
-    pix2 = image2.load()
-    num_same = 0
+    pix1 = get_pixel_array(image1)
+    pix2 = get_pixel_array(image2)
     num_total = image1.size[0] * image1.size[1]
-    for ix in range(image1.size[0]):
-        for iy in range(image1.size[1]):
-            if pix1[ix, iy] == pix2[ix, iy]:
-                num_same += 1
-    return float(num_same / num_total)
+    # images with different numbers of bands have no pixels the same
+    if pix1.shape != pix2.shape:
+        return 0.
+    same = (pix1 == pix2)
+    if same.ndim == 3:
+        same = np.all(same, axis=2)
+    return float(np.count_nonzero(same) / num_total)
 
 
 # ---------------------------------------------------------------------
@@ -525,19 +657,23 @@ def adaptive_threshold(img):
 def process_and_threshold(img, r=3):
     """
     Perform histogram equalisation, adaptive thresholding, and median
-    filtering on an input PIL Image. Return the result converted
-    back to a PIL Image.
+    filtering on an input image.  If the input is a PIL Image, return the
+    result converted back to a PIL Image, otherwise it should be a 2D
+    uint8 numpy array, and the result is returned as a numpy array.
 
-    @param img input PIL Image object
-    @return processed PIL Image
+    @param img input PIL Image object or 2D numpy array
+    @return processed PIL Image or 2D numpy array
     """
-
-    img = pillow_to_numpy(img)
+    is_pil_image = not isinstance(img, np.ndarray)
+    if is_pil_image:
+        img = pillow_to_numpy(img)
     img = hist_eq(img)
     img = adaptive_threshold(img)
     img = median_filter(img, r)
 
-    return numpy_to_pillow(img)
+    if is_pil_image:
+        return numpy_to_pillow(img)
+    return img
 # ---------------------------------------------------------------------
 
 
@@ -575,3 +711,56 @@ def check_image_ok(rgb_image, black_pix_threshold=0.05):
         return False
     else:
         return True
+
+
+def get_black_pixel_mask(image_array):
+    """
+    Boolean array of shape (..., y, x), True where all the bands
+    of an image array of shape (..., y, x, 3), or a greyscale array of
+    shape (..., y, x), are zero, i.e. the pixel has been masked.
+    """
+    image_array = np.asarray(image_array)
+    if image_array.ndim >= 3 and image_array.shape[-1] == 3:
+        return (image_array == 0).all(axis=-1)
+    return image_array == 0
+
+
+def screen_tiles(rgb_array, n_pix_x, n_pix_y=None, black_pix_threshold=0.05):
+    """
+    Batched version of check_image_ok, for all the non-overlapping
+    n_pix_x x n_pix_y tiles of a full-size RGB image at once.  The black
+    pixels are counted in one pass over the image, then summed per tile
+    by reshaping to the tile grid.
+
+    Parameters
+    ----------
+    rgb_array : numpy array of shape (y, x, 3)
+    n_pix_x, n_pix_y : int, size of tiles in pixels (square if n_pix_y not given)
+    black_pix_threshold : float, tiles with this fraction of black pixels or
+                          more are rejected
+
+    Returns
+    ----------
+    accept : numpy array of bool, one per tile in the same order as iter_tiles
+    black_fractions : numpy array of float, the fraction of black pixels per tile
+    """
+    if not n_pix_y:
+        n_pix_y = n_pix_x
+    black = get_black_pixel_mask(rgb_array)
+    ny = black.shape[0] // n_pix_y
+    nx = black.shape[1] // n_pix_x
+    n_black_pix = black[:ny*n_pix_y, :nx*n_pix_x]\
+        .reshape(ny, n_pix_y, nx, n_pix_x).sum(axis=(1, 3))
+    # iter_tiles loops over y inside a loop over x
+    black_fractions = (n_black_pix / (n_pix_x*n_pix_y)).T.ravel()
+    return black_fractions < black_pix_threshold, black_fractions
+
+
+def screen_tile_stack(rgb_stack, black_pix_threshold=0.05):
+    """
+    As screen_tiles, but for a stack of RGB tiles of shape
+    (n_tiles, ny_pix, nx_pix, 3) that has already been split up.
+    """
+    black = get_black_pixel_mask(rgb_stack)
+    black_fractions = black.reshape(len(black), -1).mean(axis=1)
+    return black_fractions < black_pix_threshold, black_fractions
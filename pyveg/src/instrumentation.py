@@ -0,0 +1,376 @@
+"""
+Instrumentation of pipeline runs, to see where the time goes.
+
+A RunMetrics object, held by the Pipeline, records a Measurement for each
+module run, and for each date a module processes, with:
+  - wall time and CPU time,
+  - peak resident memory of the process (and of its worker processes),
+  - bytes read and written by the process, and to/from Azure,
+  - counters such as the number of GEE API calls, zipfiles downloaded,
+    tiles processed and cache hits.
+
+Counters are incremented with increment(), from anywhere in the code, and
+are added to the innermost measurement running in the current thread, so
+e.g. azure_utils doesn't need to know which module it is working for.
+
+Note that CPU time, memory and bytes read/written are for the whole process,
+so overlap between measurements that run at the same time (e.g. concurrent
+sequences, or streaming).  thread_cpu_time_s is for the measuring thread only.
+"""
+
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+
+# counters shown in the text report, in this order
+COUNTERS = ["gee_calls", "downloads", "tiles_processed", "cache_hits",
+            "azure_bytes_read", "azure_bytes_written"]
+
+# the stack of measurements running in each thread
+_current = threading.local()
+
+# held while a ModuleProfiler is running - only one profiler can be active
+# in a process at once (from Python 3.12), and before that profiles of
+# modules running at the same time would be mixed up.
+_profiling_lock = threading.Lock()
+
+
+def increment(counter, amount=1):
+    """
+    Add amount to a counter of the innermost measurement running in this
+    thread.  Does nothing if there isn't one.
+    """
+    stack = getattr(_current, "stack", None)
+    if stack:
+        stack[-1].increment(counter, amount)
+
+
+def get_cpu_times():
+    """
+    Return (process CPU time, CPU time of this thread), in seconds.
+    The process time includes worker processes that have finished.
+    """
+    cpu_time = time.process_time()
+    if resource:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time += children.ru_utime + children.ru_stime
+    return cpu_time, time.thread_time()
+
+
+def get_peak_rss_mb():
+    """
+    Return (peak RSS of this process, peak RSS of the largest finished
+    worker process) in MB, or (None, None) if not available.
+    """
+    if not resource:
+        return None, None
+    # ru_maxrss is in bytes on macOS, kB elsewhere
+    scale = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale, 1))
+
+
+def get_io_bytes():
+    """
+    Return (bytes read, bytes written) by this process so far, including
+    files, pipes and network, or (None, None) if not available (only Linux
+    has /proc/self/io).
+    """
+    try:
+        with open("/proc/self/io") as infile:
+            counts = dict(line.split(": ") for line in infile.read().splitlines())
+        return int(counts["rchar"]), int(counts["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Measurement(object):
+    """
+    Resources used by one module run, or by one module processing one date.
+    """
+
+    def __init__(self, sequence, module, date_string=None):
+        self.sequence = sequence
+        self.module = module
+        self.date = date_string
+        self.counters = {}
+        self.skipped = False
+        self.lock = threading.Lock()
+        self.results = {}
+
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu, self.start_thread_cpu = get_cpu_times()
+        self.start_read, self.start_written = get_io_bytes()
+
+
+    def stop(self):
+        cpu_time, thread_cpu_time = get_cpu_times()
+        bytes_read, bytes_written = get_io_bytes()
+        peak_rss_mb, peak_child_rss_mb = get_peak_rss_mb()
+        self.results = {
+            "wall_time_s": round(time.perf_counter() - self.start_wall, 4),
+            "cpu_time_s": round(cpu_time - self.start_cpu, 4),
+            "thread_cpu_time_s": round(thread_cpu_time - self.start_thread_cpu, 4),
+            "peak_rss_mb": peak_rss_mb,
+            "peak_child_rss_mb": peak_child_rss_mb,
+            "io_bytes_read": None if bytes_read is None \
+                else bytes_read - self.start_read,
+            "io_bytes_written": None if bytes_written is None \
+                else bytes_written - self.start_written
+        }
+
+
+    def to_dict(self):
+        output = {"sequence": self.sequence,
+                  "module": self.module,
+                  "start_time": self.start_time}
+        if self.date:
+            output["date"] = self.date
+            output["skipped"] = self.skipped
+        output.update(self.results)
+        with self.lock:
+            output["counters"] = dict(self.counters)
+        return output
+
+
+
+class RunMetrics(object):
+    """
+    Collect the measurements for all the modules of a pipeline, and
+    summarize them in a report.  Can be shared between threads.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.module_measurements = []
+        self.date_measurements = []
+        self.profiles = {}
+        self.start_time = time.time()
+
+
+    def measure(self, sequence, module, date_string=None):
+        """
+        Return a context manager measuring the resources used by a module,
+        or by a module for one date, within the with block.
+        """
+        return _Measuring(self, Measurement(sequence, module, date_string))
+
+
+    def add(self, measurement):
+        with self.lock:
+            if measurement.date:
+                self.date_measurements.append(measurement)
+            else:
+                self.module_measurements.append(measurement)
+
+
+    def add_profile(self, sequence, module, profile_text):
+        with self.lock:
+            self.profiles[(sequence, module)] = profile_text
+
+
+    def summarize_modules(self):
+        """
+        Return a list of dicts, one per module run, with the resources
+        used by the module, and its counters totalled over all dates.
+        """
+        with self.lock:
+            module_measurements = list(self.module_measurements)
+            date_measurements = list(self.date_measurements)
+        summaries = []
+        for measurement in module_measurements:
+            summary = measurement.to_dict()
+            dates = [m.to_dict() for m in date_measurements \
+                     if (m.sequence, m.module) == (measurement.sequence,
+                                                   measurement.module)]
+            summary["n_dates"] = len(dates)
+            summary["n_dates_skipped"] = len([d for d in dates if d["skipped"]])
+            for date in dates:
+                for counter, value in date["counters"].items():
+                    summary["counters"][counter] = \
+                        summary["counters"].get(counter, 0) + value
+            summaries.append(summary)
+        return summaries
+
+
+    def get_report(self):
+        """
+        Return the whole report as a dict, that can be saved as json.
+        """
+        with self.lock:
+            date_measurements = list(self.date_measurements)
+        return {"pipeline": self.name,
+                "start_time": self.start_time,
+                "wall_time_s": round(time.time() - self.start_time, 4),
+                "modules": self.summarize_modules(),
+                "dates": [m.to_dict() for m in date_measurements]}
+
+
+    def get_text_report(self):
+        """
+        Return a summary table of the resources used by each module.
+        """
+        def fmt(value, scale=1):
+            return "-" if value is None else "{:.1f}".format(value * scale)
+
+        report = self.get_report()
+        columns = ["sequence/module", "dates", "wall [s]", "cpu [s]",
+                   "peak RSS [MB]", "read [MB]", "written [MB]"] + COUNTERS
+        rows = []
+        for module in report["modules"]:
+            rows.append(["{}/{}".format(module["sequence"], module["module"]),
+                         "{} ({} skipped)".format(module["n_dates"],
+                                                  module["n_dates_skipped"]),
+                         fmt(module["wall_time_s"]),
+                         fmt(module["cpu_time_s"]),
+                         fmt(module["peak_rss_mb"]),
+                         fmt(module["io_bytes_read"], 1e-6),
+                         fmt(module["io_bytes_written"], 1e-6)] \
+                        + [str(module["counters"].get(c, 0)) for c in COUNTERS])
+        widths = [max(len(row[i]) for row in [columns] + rows) \
+                  for i in range(len(columns))]
+        lines = ["Run report for pipeline {}, total wall time {:.1f} s"\
+                 .format(self.name, report["wall_time_s"]), ""]
+        for row in [columns] + rows:
+            lines.append("  ".join(value.ljust(width) if i == 0 else value.rjust(width) \
+                                   for i, (value, width) in enumerate(zip(row, widths))))
+        with self.lock:
+            profiles = dict(self.profiles)
+        for (sequence, module), profile_text in profiles.items():
+            lines += ["", "Profile of {}/{}:".format(sequence, module), profile_text]
+        return "\n".join(lines) + "\n"
+
+
+
+class _Measuring(object):
+    """
+    Context manager for a Measurement, making it the innermost measurement
+    for this thread while it runs.
+    """
+
+    def __init__(self, run_metrics, measurement):
+        self.run_metrics = run_metrics
+        self.measurement = measurement
+
+
+    def __enter__(self):
+        if not hasattr(_current, "stack"):
+            _current.stack = []
+        _current.stack.append(self.measurement)
+        self.measurement.start()
+        return self.measurement
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.measurement.stop()
+        _current.stack.remove(self.measurement)
+        self.run_metrics.add(self.measurement)
+        return False
+
+
+
+class ModuleProfiler(object):
+    """
+    Profile the code run in the current thread, with cProfile, or with
+    pyinstrument if that is installed and profiler is "pyinstrument".
+    Only one module can be profiled at once - if another one is already
+    being profiled (e.g. in a concurrent sequence), start() does nothing
+    and returns False.
+    """
+
+    def __init__(self, profiler="cprofile"):
+        if profiler == "pyinstrument" and Profiler is None:
+            print("pyinstrument not installed - using cProfile instead")
+            profiler = "cprofile"
+        if profiler not in ["cprofile", "pyinstrument"]:
+            raise RuntimeError("Unknown profiler {} - must be 'cprofile' or 'pyinstrument'"\
+                               .format(profiler))
+        self.profiler_name = profiler
+        self.profiler = cProfile.Profile() if profiler == "cprofile" else Profiler()
+        self.is_running = False
+
+
+    def start(self):
+        """
+        Start profiling, returning True if it started.
+        """
+        if not _profiling_lock.acquire(blocking=False):
+            print("Another module is already being profiled - not profiling this one")
+            return False
+        try:
+            if self.profiler_name == "cprofile":
+                self.profiler.enable()
+            else:
+                self.profiler.start()
+        except (ValueError, RuntimeError) as e:
+            # e.g. a profiler outside pyveg is already active
+            _profiling_lock.release()
+            print("Unable to start profiler: {}".format(e))
+            return False
+        self.is_running = True
+        return True
+
+
+    def stop(self):
+        if not self.is_running:
+            return
+        try:
+            if self.profiler_name == "cprofile":
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+        finally:
+            self.is_running = False
+            _profiling_lock.release()
+
+
+    def get_text(self, n_lines=30):
+        """
+        Return the profile as text, for cProfile the n_lines functions
+        with the highest cumulative time.
+        """
+        if self.profiler_name == "pyinstrument":
+            return self.profiler.output_text()
+        output = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(n_lines)
+        return output.getvalue()
+
+
+    def save(self, filepath):
+        """
+        Save the profile, as pstats data for cProfile (view with e.g.
+        snakeviz) or html for pyinstrument.  Returns the path written.
+        """
+        if self.profiler_name == "cprofile":
+            filepath += ".prof"
+            self.profiler.dump_stats(filepath)
+        else:
+            filepath += ".html"
+            with open(filepath, "w") as outfile:
+                outfile.write(self.profiler.output_html())
+        return filepath
@@ -0,0 +1,158 @@
+"""
+Manifest of the work done by a pipeline, so that an interrupted run can
+be resumed exactly, without counting files in output directories.
+
+For each (sequence, module, date) that has been completed, the manifest
+records whether the date produced output for the next module, a hash
+of the configuration of the module (and the modules before it in the
+sequence), and the paths, sizes and modification times (and optionally
+checksums) of the output files.
+
+The manifest is an SQLite database, keyed on (sequence, module, date),
+so checking whether some work has already been done is a single lookup.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+MANIFEST_FILENAME = "run_manifest.sqlite"
+
+
+def calc_file_checksum(filepath, block_size=1 << 20):
+    """
+    Return the sha1 hex digest of a file, reading block_size bytes at a time.
+    """
+    hasher = hashlib.sha1()
+    with open(filepath, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def describe_artefacts(directories, checksums=False):
+    """
+    List all the files under the given local directories.
+    Checksumming means reading all the files, so is only done if asked for.
+
+    Returns
+    =======
+    artefacts: list of dicts {"path": <str>, "size": <int>, "mtime": <float>},
+               plus "sha1": <str> if checksums is True
+    """
+    artefacts = []
+    for directory in directories:
+        for root, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                filepath = os.path.join(root, filename)
+                stat = os.stat(filepath)
+                artefact = {"path": filepath,
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime}
+                if checksums:
+                    artefact["sha1"] = calc_file_checksum(filepath)
+                artefacts.append(artefact)
+    return artefacts
+
+
+class RunManifest(object):
+    """
+    Record of the (sequence, module, date) combinations that a pipeline
+    has completed.  Can be shared between the threads of a pipeline.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # sequences and streaming modules run in different threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS completed (
+            sequence TEXT NOT NULL,
+            module TEXT NOT NULL,
+            date TEXT NOT NULL,
+            has_output INTEGER NOT NULL,
+            config_hash TEXT NOT NULL,
+            artefacts TEXT NOT NULL,
+            completed_time REAL NOT NULL,
+            PRIMARY KEY (sequence, module, date)
+        )""")
+        self.connection.commit()
+
+
+    def get(self, sequence, module, date_string):
+        """
+        Return the entry for this (sequence, module, date) as a dict, or
+        None if it hasn't been completed.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT has_output, config_hash, artefacts, completed_time " \
+                "FROM completed WHERE sequence = ? AND module = ? AND date = ?",
+                (sequence, module, date_string)).fetchone()
+        if row is None:
+            return None
+        return {"has_output": bool(row[0]),
+                "config_hash": row[1],
+                "artefacts": json.loads(row[2]),
+                "completed_time": row[3]}
+
+
+    def is_complete(self, sequence, module, date_string, config_hash):
+        """
+        Check whether this (sequence, module, date) has been completed
+        with the same configuration.
+        """
+        entry = self.get(sequence, module, date_string)
+        return entry is not None and entry["config_hash"] == config_hash
+
+
+    def mark_complete(self, sequence, module, date_string, config_hash,
+                      has_output=True, artefacts=[]):
+        """
+        Record that this (sequence, module, date) has been completed.
+
+        Parameters
+        ==========
+        config_hash: str, as from BaseModule.get_config_hash()
+        has_output: bool, whether there is output for the next module
+        artefacts: list of dicts describing the output files,
+                   as from describe_artefacts
+        """
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sequence, module, date_string, int(bool(has_output)),
+                 config_hash, json.dumps(artefacts), time.time()))
+            self.connection.commit()
+
+
+    def copy_to(self, db_path):
+        """
+        Write a consistent copy of the manifest to db_path, e.g. to
+        upload it while other threads may still be adding to it.
+        """
+        copy_connection = sqlite3.connect(db_path)
+        try:
+            with self.lock:
+                self.connection.backup(copy_connection)
+        finally:
+            copy_connection.close()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM completed").fetchone()[0]
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
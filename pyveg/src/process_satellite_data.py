@@ -29,9 +29,11 @@ from .subgraph_centrality import (
     subgraph_centrality,
     feature_vector_metrics,
 )
+from .cache_utils import get_cache, cached_subgraph_centrality
 
 
-def process_sub_image(i, sub, sub_rgb, sub_ndvi, output_subdir, date):
+def process_sub_image(i, sub, sub_rgb, sub_ndvi, output_subdir, date, cache_location=None,
+                      cache_max_entries=100000):
     """
     function to be used by multiprocessing Pool, called for every sub-image.
 
@@ -47,12 +49,17 @@ def process_sub_image(i, sub, sub_rgb, sub_ndvi, output_subdir, date):
        tuple containing the ndvi sub-image, and a tuple of long,lat coords.
     output_subdir: str
        subdirectory into which sub-image png files will be saved.
+    cache_location: str, optional
+       path to the subgraph centrality cache database, or None to not
+       use the cache.
+    cache_max_entries: int, optional
+       the number of entries to keep in the cache, removing the least
+       recently used ones above this.
 
     Returns
     -------
-    nc_results: list of dictionaries
-               list of length n_sub_images with each entry containing a
-               dictionary with coordinates, dates, feature_vec.
+    cache_hit: bool, or None if the sub-image was rejected.
+       True if the network centrality result came from the cache.
     """
     # sub will be a tuple (image, coords) - unpack it here
     sub_image, sub_coords = sub
@@ -90,7 +97,13 @@ def process_sub_image(i, sub, sub_rgb, sub_ndvi, output_subdir, date):
 
     # run network centrality
     image_array = pillow_to_numpy(sub_image)
-    feature_vec, _ = subgraph_centrality(image_array)
+    cache_hit = False
+    if cache_location:
+        feature_vec, cache_hit = cached_subgraph_centrality(image_array,
+                                                            get_cache(cache_location,
+                                                                      cache_max_entries))
+    else:
+        feature_vec, _ = subgraph_centrality(image_array)
     nc_result = feature_vector_metrics(feature_vec)
 
     nc_result['longitude'] = round(sub_coords[0], 4)
@@ -107,10 +120,12 @@ def process_sub_image(i, sub, sub_rgb, sub_ndvi, output_subdir, date):
     save_json(nc_result, os.path.join(output_subdir,"tmp_json"), f"network_centrality_sub{i}.json")
     n_processed = len(os.listdir(os.path.join(output_subdir,"tmp_json")))
     print(f'Processed {n_processed} sub-images...', end='\r')
+    return cache_hit
 
 
 def run_network_centrality(output_dir, img_thresh, img_rgb, ndvi_img, coords, date_range, region_size, 
-                           sub_image_size=[50,50], n_sub_images=-1, n_threads=4):
+                           sub_image_size=[50,50], n_sub_images=-1, n_threads=4,
+                           cache_location=None, cache_max_entries=100000):
     """
     !! SVS: Suggest that this function should be moved to the subgraph_centrality.py module
 
@@ -141,6 +156,12 @@ def run_network_centrality(output_dir, img_thresh, img_rgb, ndvi_img, coords, da
     n_threads: int, optional
         The number of threads to use for parallel processing of sub-images.
         Default is 4.
+    cache_location: str, optional
+        Path to an SQLite file used to cache subgraph centrality results
+        (see cache_utils.py).  Default is None, meaning no cache.
+    cache_max_entries: int, optional
+        The number of entries to keep in the cache, removing the least
+        recently used ones above this.  Default is 100000.
 
     Returns
     ----------
@@ -180,10 +201,16 @@ def run_network_centrality(output_dir, img_thresh, img_rgb, ndvi_img, coords, da
     with Pool(processes=n_threads) as pool:
 
         # prepare the arguments for the process_sub_image function
-        arguments=[(i, sub, sub_images_rgb[i], sub_images_ndvi[i], output_subdir, date_range_midpoint) \
+        arguments=[(i, sub, sub_images_rgb[i], sub_images_ndvi[i], output_subdir,
+                    date_range_midpoint, cache_location, cache_max_entries) \
                    for i,sub in enumerate(sub_images)]
 
-        pool.starmap(process_sub_image, arguments)
+        cache_hits = pool.starmap(process_sub_image, arguments)
+
+    if cache_location:
+        n_hits = sum(1 for hit in cache_hits if hit is True)
+        n_misses = sum(1 for hit in cache_hits if hit is False)
+        print(f'\nSubgraph centrality cache for {date_range_midpoint}: {n_hits} hits, {n_misses} misses')
 
     # re-combine the results from all sub-images
     nc_results = consolidate_json_to_list(os.path.join(output_subdir, 'tmp_json'),
@@ -7,10 +7,12 @@ import os
 import re
 import shutil
 import tempfile
+from collections import OrderedDict
 
 import cv2 as cv
 
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory, resource_tracker, get_start_method
+from multiprocessing.pool import ThreadPool
 
 from pyveg.src.image_utils import *
 from pyveg.src.file_utils import *
@@ -18,8 +20,13 @@ from pyveg.src.coordinate_utils import *
 from pyveg.src.subgraph_centrality import (
     subgraph_centrality,
     feature_vector_metrics,
+    feature_vector_metrics_batch
 )
+from pyveg.src.cache_utils import get_cache, cached_subgraph_centrality
+from pyveg.src.tile_store import make_tile_stack, save_tile_store, get_tile_store
+from pyveg.src.tif_utils import calc_tif_mean
 from pyveg.src import azure_utils
+from pyveg.src import instrumentation
 
 from pyveg.src.pyveg_pipeline import BaseModule
 
@@ -36,6 +43,7 @@ class ProcessorModule(BaseModule):
             ("output_location_type", [str]),
             ("num_files_per_point", [int])
         ]
+        self.concurrency_group = "processing"
 
 
     def get_image(self, image_location):
@@ -51,6 +59,9 @@ class ProcessorModule(BaseModule):
 
 
     def save_image(self, image, output_location, output_filename, verbose=True):
+        # arrays are only converted to PIL Images here, when encoding
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
         if self.output_location_type == "local":
             # use the file_utils function
             save_image(image, output_location, output_filename, verbose)
@@ -64,6 +75,164 @@ class ProcessorModule(BaseModule):
                                .format(self.output_location_type))
 
 
+    def save_tile_store(self, tile_stack, tile_info, output_location,
+                        filename_base, metadata={}):
+        """
+        Save a stack of sub-images as a tile store (.npy and .json files).
+        """
+        if self.output_location_type == "local":
+            # use the tile_store function
+            save_tile_store(tile_stack, tile_info, output_location,
+                            filename_base, metadata)
+        elif self.output_location_type == "azure":
+            tmpdir = tempfile.mkdtemp()
+            save_tile_store(tile_stack, tile_info, tmpdir,
+                            filename_base, metadata)
+            self.copy_to_output_location(tmpdir, output_location)
+            shutil.rmtree(tmpdir)
+        else:
+            raise RuntimeError("Unknown output location type {}"\
+                               .format(self.output_location_type))
+
+
+    def find_tile_store(self, date_string, image_type):
+        """
+        Look in the TILES subdirectory for this date for the tile store
+        of this image type (e.g. 'BWNDVI').
+
+        Returns
+        =======
+        (npy_path, json_path): paths on the local filesystem, or
+                               None if there is no tile store.
+        """
+        input_path = os.path.join(self.input_location, date_string, "TILES")
+        date_path = os.path.join(self.input_location, date_string)
+        if "TILES" not in self.list_directory(date_path, self.input_location_type):
+            return None
+        for filename in self.list_directory(input_path, self.input_location_type):
+            if filename.endswith("_{}.npy".format(image_type)):
+                npy_path = self.get_file(os.path.join(input_path, filename),
+                                         self.input_location_type)
+                json_path = self.get_file(os.path.join(input_path,
+                                                       filename[:-4]+".json"),
+                                          self.input_location_type)
+                return npy_path, json_path
+        return None
+
+
+    def get_full_rgb_array(self, date_string):
+        """
+        Read the full-size RGB image for this date from the PROCESSED
+        subdirectory, as a numpy array, or return None if there isn't one.
+        """
+        date_path = os.path.join(self.input_location, date_string)
+        if "PROCESSED" not in self.list_directory(date_path, self.input_location_type):
+            return None
+        input_path = os.path.join(date_path, "PROCESSED")
+        for filename in self.list_directory(input_path, self.input_location_type):
+            if filename.endswith("_RGB.png"):
+                rgb_image = self.get_image(os.path.join(input_path, filename))
+                return np.asarray(rgb_image.convert("RGB"))
+        return None
+
+
+    def screen_sub_images(self, date_string, tile_shape, n_tiles, load_rgb_stack):
+        """
+        Batched quality screen for all the sub-images of this date.
+        The fraction of black (i.e. masked) pixels in each sub-image is
+        calculated in one pass over the full-size RGB image if there is one,
+        or otherwise over the stack of RGB sub-images from load_rgb_stack().
+
+        Parameters
+        ==========
+        date_string: str, format YYYY-MM-DD
+        tile_shape: (ny_pix, nx_pix), the size of the sub-images
+        n_tiles: int, the number of sub-images
+        load_rgb_stack: function returning an array of RGB sub-images
+                        of shape (n_tiles, ny_pix, nx_pix, 3), or None.
+
+        Returns
+        =======
+        accept: numpy array of bool, True for sub-images that pass the screen.
+        black_fractions: numpy array of float, or None if there were no RGB images.
+        """
+        accept, black_fractions = None, None
+        rgb_array = self.get_full_rgb_array(date_string)
+        if rgb_array is not None:
+            accept, black_fractions = screen_tiles(rgb_array, tile_shape[1],
+                                                   tile_shape[0], 0.05)
+        if black_fractions is None or len(black_fractions) != n_tiles:
+            rgb_stack = load_rgb_stack()
+            if rgb_stack is not None:
+                accept, black_fractions = screen_tile_stack(rgb_stack, 0.05)
+            else:
+                accept, black_fractions = np.ones(n_tiles, dtype=bool), None
+        n_accepted = int(accept.sum())
+        print("{}: {} of {} sub-images for {} passed the quality check ({:.1f}%)"\
+              .format(self.name, n_accepted, n_tiles, date_string,
+                      100. * n_accepted / max(1, n_tiles)))
+        return accept, black_fractions
+
+
+    def list_dates(self):
+        """
+        Return the sorted "YYYY-MM-DD" subdirectories of the input location,
+        or list_of_dates if that has been set.
+        """
+        if "list_of_dates" in vars(self):
+            return self.list_of_dates
+        return sorted([date_string for date_string in \
+                       self.list_directory(self.input_location, self.input_location_type) \
+                       if re.search("^([\d]{4}-[\d]{2}-[\d]{2})", date_string)])
+
+
+    def has_sub_images(self, date_string):
+        """
+        Check whether there is a TILES or SPLIT subdirectory for this date.
+        """
+        date_path = os.path.join(self.input_location, date_string)
+        date_contents = self.list_directory(date_path, self.input_location_type)
+        return "TILES" in date_contents or "SPLIT" in date_contents
+
+
+    def screen_png_sub_images(self, date_string, image_type):
+        """
+        List the png sub-images of this image type (e.g. 'BWNDVI') in the
+        SPLIT subdirectory for this date, and return the filenames of
+        those that pass the quality screen, in sub-image order.
+        """
+        input_path = os.path.join(self.input_location, date_string, "SPLIT")
+        suffix = "_{}.png".format(image_type)
+        filenames = [filename for filename in \
+                     self.list_directory(input_path, self.input_location_type) \
+                     if filename.endswith(suffix) and re.match("sub[\d]+_", filename)]
+        if len(filenames) == 0:
+            return []
+        # filenames are sub<i>_<long>_<lat>_<type>.png, where i is the tile index
+        filenames.sort(key=lambda filename: int(re.match("sub([\d]+)_", filename).group(1)))
+        tile_shape = np.asarray(self.get_image(os.path.join(input_path,
+                                                            filenames[0]))).shape[:2]
+        load_rgb_stack = lambda: np.stack([
+            np.asarray(self.get_image(os.path.join(
+                input_path, filename[:-len(suffix)]+"_RGB.png")).convert("RGB")) \
+            for filename in filenames])
+        accept, _ = self.screen_sub_images(date_string, tile_shape,
+                                           len(filenames), load_rgb_stack)
+        return [filename for filename, ok in zip(filenames, accept) if ok]
+
+
+    def load_png_stack(self, input_path, filenames):
+        """
+        Read png sub-images into one array of shape (n_images, ny_pix, nx_pix[, 3]).
+        """
+        arrays = [pillow_to_numpy(self.get_image(os.path.join(input_path, filename))) \
+                  for filename in filenames]
+        # greyscale sub-images saved as RGB are 2D unless they are all black
+        if any(array.ndim == 2 for array in arrays):
+            arrays = [array if array.ndim == 2 else array[:, :, 0] for array in arrays]
+        return np.stack(arrays)
+
+
     def set_default_parameters(self):
         """
         Set some basic defaults.  Note that these might get overriden
@@ -89,8 +258,10 @@ class VegetationImageProcessor(ProcessorModule):
     1) Full-size RGB image
     2) Full-size NDVI image (greyscale)
     3) Full-size black+white NDVI image (after processing, thresholding, ...)
-    4) Many 50x50 pixel sub-images of RGB image
-    5) Many 50x50 pixel sub-images of black+white NDVI image.
+    4) Tile stores in the TILES subdirectory, containing many 50x50 pixel
+       sub-images of the RGB, NDVI and black+white NDVI images.
+       If save_sub_image_pngs is set, these are also saved as png
+       files in the SPLIT subdirectory.
 
     """
     def __init__(self, name=None):
@@ -98,7 +269,8 @@ class VegetationImageProcessor(ProcessorModule):
         self.params += [
                         ("region_size", [float]),
                         ("RGB_bands", [list]),
-                        ("split_RGB_images", [bool])
+                        ("split_RGB_images", [bool]),
+                        ("save_sub_image_pngs", [bool])
         ]
 
 
@@ -114,6 +286,8 @@ class VegetationImageProcessor(ProcessorModule):
             self.RGB_bands = ["B4","B3","B2"]
         if not "split_RGB_images" in vars(self):
             self.split_RGB_images = True
+        if not "save_sub_image_pngs" in vars(self):
+            self.save_sub_image_pngs = False
         # in PROCESSED dir we expect RGB. NDVI, BWNDVI
         self.num_files_per_point = 3
 
@@ -174,11 +348,13 @@ class VegetationImageProcessor(ProcessorModule):
                                   image_type,
                                   npix=50):
         """
-        Split the full-size image into lots of small sub-images
+        Split the full-size image into lots of small sub-images, and
+        save them as a tile store in the TILES subdirectory, and
+        optionally also as png files in the SPLIT subdirectory.
 
         Parameters:
         ===========
-        image: pillow Image
+        image: pillow Image, or numpy array of shape (y, x[, c])
         date_string: str, format YYYY-MM-DD
         coords_string: str, format long_lat
         image_type: str, typically 'RGB' or 'BWNDVI'
@@ -190,16 +366,30 @@ class VegetationImageProcessor(ProcessorModule):
         """
 
         coords = [float(coord) for coord in coords_string.split("_")]
-        sub_images = crop_image_npix(image, npix,
-                                     region_size=self.region_size,
-                                     coords = coords)
+        # tiles are views into one array, only converted to PIL when saved
+        image_array = np.asarray(image)
+
+        tile_stack, tile_info = make_tile_stack(image_array, npix,
+                                                region_size=self.region_size,
+                                                coords=coords)
+        instrumentation.increment("tiles_processed", len(tile_stack))
+        self.save_tile_store(tile_stack, tile_info,
+                             os.path.join(self.output_location, date_string, "TILES"),
+                             f'{date_string}_{coords_string}_{image_type}',
+                             metadata={"date": date_string,
+                                       "coords": coords,
+                                       "region_size": self.region_size,
+                                       "image_type": image_type})
+        if not self.save_sub_image_pngs:
+            return True
 
+        sub_images = iter_tiles(image_array, npix,
+                                region_size=self.region_size,
+                                coords=coords)
         output_location = os.path.dirname(self.construct_image_savepath(date_string,
                                                                    coords_string,
                                                                    'SUB_'+image_type))
-        for i, sub in enumerate(sub_images):
-            # sub will be a tuple (image, coords) - unpack it here
-            sub_image, sub_coords = sub
+        for i, (_, _, sub_image, sub_coords) in enumerate(sub_images):
             output_filename = f'sub{i}_'
             output_filename += "{0:.3f}_{1:.3f}".format(sub_coords[0],
                                                            sub_coords[1])
@@ -286,16 +476,18 @@ class VegetationImageProcessor(ProcessorModule):
         ndvi_tif = self.get_file(os.path.join(input_filepath,
                                               "download.NDVI.tif"),
                                  self.input_location_type)
-        ndvi_image = scale_tif(ndvi_tif)
+        # keep the NDVI and thresholded images as greyscale arrays,
+        # only converting to PIL Images when saving.
+        ndvi_array = scale_tif_to_array(ndvi_tif)
         ndvi_filepath = self.construct_image_savepath(date_string,
                                                       coords_string,
                                                       'NDVI')
-        self.save_image(ndvi_image,
+        self.save_image(ndvi_array,
                         os.path.dirname(ndvi_filepath),
                         os.path.basename(ndvi_filepath))
 
         # preprocess and threshold the NDVI image
-        processed_ndvi = process_and_threshold(ndvi_image)
+        processed_ndvi = process_and_threshold(ndvi_array)
         ndvi_bw_filepath = self.construct_image_savepath(date_string,
                                                          coords_string,
                                                          'BWNDVI')
@@ -304,7 +496,7 @@ class VegetationImageProcessor(ProcessorModule):
                         os.path.basename(ndvi_bw_filepath))
 
         # split and save sub-images
-        self.split_and_save_sub_images(ndvi_image,
+        self.split_and_save_sub_images(ndvi_array,
                                        date_string,
                                        coords_string,
                                        "NDVI")
@@ -317,25 +509,30 @@ class VegetationImageProcessor(ProcessorModule):
         return True
 
 
+    def get_output_dirs(self, date_string):
+        return [os.path.join(self.output_location, date_string, subdir) \
+                for subdir in ["PROCESSED", "TILES", "SPLIT"]]
+
+
+    def process(self, date_string):
+        """
+        Process the tif files in the RAW subdirectory for one date.
+        Returns True if everything was processed and saved OK.
+        """
+        date_path = os.path.join(self.input_location, date_string, "RAW")
+        if len(self.list_directory(date_path, self.input_location_type)) == 0:
+            return False
+        return self.process_single_date(date_path)
+
+
     def run(self):
         """"
         Function to run the module.  Loop over all date-sub-ranges and
         call process_single_date() on each of them.
         """
         super().run()
-        date_subdirs = sorted(self.list_directory(self.input_location,
-                                                  self.input_location_type))
-        for date_subdir in date_subdirs:
-            if not re.search("^([\d]{4}-[\d]{2}-[\d]{2})", date_subdir):
-                print("{}: Directory name {} not in YYYY-MM-DD format"\
-                      .format(self.name, date_subdir))
-                continue
-            date_path = os.path.join(self.input_location, date_subdir, "RAW")
-            if len(self.list_directory(date_path, self.input_location_type)) == 0:
-                continue
-            processed_ok = self.process_single_date(date_path)
-            if not processed_ok:
-                continue
+        for date_string in self.list_dates():
+            self.run_date(date_string)
 
 
 class WeatherImageToJSON(ProcessorModule):
@@ -376,13 +573,10 @@ class WeatherImageToJSON(ProcessorModule):
         for filename in self.list_directory(input_location, self.input_location_type):
             if filename.endswith(".tif"):
                 name_variable = (filename.split('.'))[1]
-                variable_array = cv.imread(self.get_file(os.path.join(input_location,
-                                                                      filename),
-                                                         self.input_location_type),
-                                           cv.IMREAD_ANYDEPTH)
-
-                metrics_dict[name_variable] = variable_array.mean()\
-                                                            .astype(np.float64)
+                # read the tif a block of rows at a time
+                metrics_dict[name_variable] = calc_tif_mean(
+                    self.get_file(os.path.join(input_location, filename),
+                                  self.input_location_type))
         self.save_json(metrics_dict, "weather_data.json",
                        os.path.join(self.output_location,
                                     date_string,
@@ -391,51 +585,107 @@ class WeatherImageToJSON(ProcessorModule):
         return True
 
 
+    def get_output_dirs(self, date_string):
+        return [os.path.join(self.output_location, date_string, "JSON", "WEATHER")]
+
+
+    def process(self, date_string):
+        processed_ok = self.process_one_date(date_string)
+        if not processed_ok:
+            raise RuntimeError("{}: problem processing {}".format(self.name, date_string))
+        return True
+
+
     def run(self):
         super().run()
         # sub-directories of our input directory should be dates.
-        time_series_data = {}
-        date_strings = self.list_directory(self.input_location, self.input_location_type)
-        date_strings.sort()
-        for date_string in date_strings:
-           processed_ok = self.process_one_date(date_string)
-           if not processed_ok:
-               raise RuntimeError("{}: problem processing {}".format(self.name, date_string))
+        for date_string in self.list_dates():
+            self.run_date(date_string)
         return True
 
 
 
 #######################################################################
-def process_sub_image(i, input_filepath, output_location, date_string, coords_string):
+def call_with_args(func_and_args):
     """
-    Read file and run network centrality
+    Call func(*args) - for use with Pool.imap_unordered, which only
+    passes one argument to the function.
     """
+    func, args = func_and_args
+    return func(*args)
 
-    # open BWNDVI image
-    sub_image = Image.open(input_filepath)
-    image_array = pillow_to_numpy(sub_image)
 
-    # run network centrality
-    feature_vec, _ = subgraph_centrality(image_array)
+def make_worker_pool(n_workers):
+    """
+    Start a pool of n_workers worker processes, that can be passed tiles
+    in shared memory.
+    Works with any start method.  The workers need to share the parent's
+    resource tracker, otherwise each one would "clean up" (unlink) the
+    shared memory blocks it attached to when it exits.  With "spawn" and
+    "forkserver" multiprocessing passes the tracker to the workers, but
+    with "fork" it has to be running before the workers are forked.
+    """
+    if get_start_method() == "fork":
+        resource_tracker.ensure_running()
+    return Pool(processes=n_workers)
+
+
+# max number of shared memory blocks a worker process keeps attached to -
+# a pool shared between pipelines (e.g. by the BatchRunner) can be given
+# tiles from several blocks at once
+MAX_ATTACHED_MEMORY = 8
 
-    # format coords
-    coords = [round(float(c), 4) for c in coords_string.split("_")]
+# shared memory blocks that this (worker) process has attached to,
+# least recently used first
+_attached_memory = OrderedDict()
 
-    # store results in a dict
-    nc_result = feature_vector_metrics(feature_vec)
-    nc_result['feature_vec'] = list(feature_vec)
-    nc_result['date'] = date_string
-    nc_result['latitude'] = coords[1]
-    nc_result['longitude'] = coords[0]
 
-    # save individual result for sub-image to tmp json, will combine later.
-    save_json(nc_result, output_location,
-              f"network_centrality_sub{i}.json", verbose=False)
+def get_shared_array(shm_name, shape, dtype):
+    """
+    Return a numpy array using the named shared memory block, attaching
+    to it if this process hasn't already.  Once more than
+    MAX_ATTACHED_MEMORY blocks are attached, the least recently used is
+    closed, as the parent process will generally have unlinked it.
+    """
+    if shm_name in _attached_memory:
+        _attached_memory.move_to_end(shm_name)
+    else:
+        _attached_memory[shm_name] = shared_memory.SharedMemory(name=shm_name)
+        while len(_attached_memory) > MAX_ATTACHED_MEMORY:
+            _attached_memory.popitem(last=False)[1].close()
+    return np.ndarray(shape, dtype=dtype, buffer=_attached_memory[shm_name].buf)
+
 
-    # count and print how many sub-images we have done.
-    n_processed = len(os.listdir(output_location))
-    print(f'Processed {n_processed} sub-images...', end='\r')
-    return True
+def process_shared_tile(i, shm_name, shape, dtype,
+                        cache_location=None, cache_max_entries=100000):
+    """
+    Run network centrality on BWNDVI tile i of the stack of tiles in
+    shared memory.
+    If cache_location is given, look up (and store) the feature vector in
+    the subgraph centrality cache there.
+
+    Returns
+    =======
+    record: numpy structured array with one element, with fields
+            'index', 'cache_hit' and 'feature_vec'.
+    """
+    image_array = np.array(get_shared_array(shm_name, shape, dtype)[i])
+
+    # run network centrality
+    cache_hit = False
+    if cache_location:
+        cache = get_cache(cache_location, cache_max_entries)
+        feature_vec, cache_hit = cached_subgraph_centrality(image_array, cache)
+    else:
+        feature_vec, _ = subgraph_centrality(image_array)
+
+    record = np.zeros(1, dtype=[("index", np.int64),
+                                ("cache_hit", np.bool_),
+                                ("feature_vec", np.float64, (len(feature_vec),))])
+    record["index"] = i
+    record["cache_hit"] = cache_hit
+    record["feature_vec"] = feature_vec
+    return record
 
 
 class NetworkCentralityCalculator(ProcessorModule):
@@ -450,7 +700,11 @@ class NetworkCentralityCalculator(ProcessorModule):
         super().__init__(name)
         self.params += [
             ("n_threads", [int]),
-            ("n_sub_images", [int])
+            ("pool_chunksize", [int]),
+            ("n_sub_images", [int]),
+            ("use_sc_cache", [bool]),
+            ("sc_cache_location", [str]),
+            ("sc_cache_max_entries", [int])
         ]
 
     def set_default_parameters(self):
@@ -459,28 +713,168 @@ class NetworkCentralityCalculator(ProcessorModule):
         or by calling configure().
         """
         super().set_default_parameters()
-        self.n_threads = 4
+        if not "n_threads" in vars(self):
+            self.n_threads = 4 # -1 means one per cpu
+        if not "pool_chunksize" in vars(self):
+            self.pool_chunksize = -1 # choose from number of sub-images
         if not "n_sub_images" in vars(self):
             self.n_sub_images = -1 # do all-sub-images
+        if not "use_sc_cache" in vars(self):
+            self.use_sc_cache = False
+        if not "sc_cache_location" in vars(self):
+            # empty string means use get_sc_cache_location() default
+            self.sc_cache_location = ""
+        if not "sc_cache_max_entries" in vars(self):
+            self.sc_cache_max_entries = 100000
+
+
+    def get_sc_cache_location(self):
+        """
+        Return the path of the subgraph centrality cache database, or None
+        if we are not using the cache.  The cache is always on the local
+        filesystem - if output is to Azure, it goes in the temp directory.
+        """
+        if not self.use_sc_cache:
+            return None
+        if self.sc_cache_location:
+            return self.sc_cache_location
+        if self.output_location_type == "local":
+            return os.path.join(self.output_location, "CACHE", "sc_cache.sqlite")
+        return os.path.join(tempfile.gettempdir(), "pyveg_sc_cache.sqlite")
+
+
+    def get_n_workers(self):
+        """
+        Number of worker processes to use - n_threads, or the
+        number of cpus if n_threads is -1 (or any value < 1).
+        """
+        if self.n_threads > 0:
+            return self.n_threads
+        return os.cpu_count() or 1
+
+
+    def get_chunksize(self, n_tasks):
+        """
+        Number of sub-images to send to a worker at a time - pool_chunksize,
+        or if that is -1, enough for ~4 chunks per worker (as Pool.map does).
+        """
+        if self.pool_chunksize > 0:
+            return self.pool_chunksize
+        return max(1, n_tasks // (4 * self.get_n_workers()))
+
 
+    def make_pool(self):
+        """
+        Start a pool of get_n_workers() worker processes.
+        """
+        return make_worker_pool(self.get_n_workers())
+
+
+    def get_shared_worker_pool(self):
+        """
+        Return the pipeline's pool of worker processes, if it has one
+        (e.g. shared between all the locations in a batch run), or None.
+        """
+        if self.parent is None:
+            return None
+        return getattr(self.parent.parent, "worker_pool", None)
+
+
+    def map_sub_images(self, process_func, arguments):
+        """
+        Call process_func(*args) for each set of args in arguments, using
+        the worker pool that lives for the duration of run() if there is
+        one, or otherwise a temporary pool.
+        Generator yielding the results in the order they finish, not the
+        order of arguments.
+        """
+        tasks = [(process_func, args) for args in arguments]
+        chunksize = self.get_chunksize(len(tasks))
+        if getattr(self, "pool", None) is not None:
+            yield from self.pool.imap_unordered(call_with_args, tasks, chunksize)
+            return
+        with self.make_pool() as pool:
+            yield from pool.imap_unordered(call_with_args, tasks, chunksize)
+
+
+    def load_tile_store_tiles(self, date_string):
+        """
+        If there is a tile store for this date, return the BWNDVI tiles
+        that pass the quality screen, as a list of arrays, and a list
+        of their coordinate strings.  Otherwise return None.
+        """
+        bwndvi_paths = self.find_tile_store(date_string, "BWNDVI")
+        if not bwndvi_paths:
+            return None
+        tile_store = get_tile_store(*bwndvi_paths)
+        rgb_paths = self.find_tile_store(date_string, "RGB")
+        accept, _ = self.screen_sub_images(
+            date_string, tile_store.metadata["tile_shape"][:2], len(tile_store),
+            lambda: get_tile_store(*rgb_paths)[:] if rgb_paths else None)
+        indices = np.flatnonzero(accept)
+        return [tile_store[i] for i in indices], \
+            [tile_store.get_coords_string(i) for i in indices]
+
+
+    def load_png_tiles(self, date_string):
+        """
+        Read the BWNDVI png files in the SPLIT directory for this date
+        that pass the quality screen, and return them as a list of arrays,
+        and a list of their coordinate strings.
+        """
+        input_path = os.path.join(self.input_location, date_string, "SPLIT")
+        print("input path is {}".format(input_path))
+
+        # list all the "BWNDVI" sub-images that pass the quality screen
+        input_files = self.screen_png_sub_images(date_string, "BWNDVI")
+        # if we only want a subset of sub-images, truncate the list here
+        if self.n_sub_images > 0:
+            input_files = input_files[:self.n_sub_images]
+        if len(input_files) == 0:
+            return [], []
+        tiles = list(self.load_png_stack(input_path, input_files))
+        return tiles, [find_coords_string(filename) for filename in input_files]
 
 
-    def check_sub_image(self, ndvi_filename, input_path):
+    def calc_feature_vectors(self, tiles, cache_location):
         """
-        Check the RGB sub-image corresponding to this NDVI image
-        looks OK.
+        Copy the tiles into one shared memory block, and have the worker
+        processes run network centrality on each of them, so that neither
+        the tiles nor the results need to go via files.
+
+        Returns
+        =======
+        feature_vecs: list of feature vectors, in the same order as tiles
+        n_hits: int, number of feature vectors that came from the cache
         """
-        rgb_filename = re.sub("BWNDVI","RGB",ndvi_filename)
-        rgb_img = Image.open(self.get_file(os.path.join(input_path, rgb_filename),
-                                           self.input_location_type))
-        img_ok = check_image_ok(rgb_img, 0.05)
-        return img_ok
+        tile_stack = np.ascontiguousarray(np.stack(tiles))
+        shm = shared_memory.SharedMemory(create=True, size=max(1, tile_stack.nbytes))
+        try:
+            shared_stack = np.ndarray(tile_stack.shape, dtype=tile_stack.dtype,
+                                      buffer=shm.buf)
+            shared_stack[:] = tile_stack
+            del shared_stack
+            arguments = [(i, shm.name, tile_stack.shape, tile_stack.dtype.str,
+                          cache_location, self.sc_cache_max_entries) \
+                         for i in range(len(tile_stack))]
+            feature_vecs = [None] * len(tile_stack)
+            n_hits = 0
+            for n_processed, record in enumerate(self.map_sub_images(process_shared_tile,
+                                                                     arguments)):
+                feature_vecs[int(record["index"][0])] = record["feature_vec"][0]
+                n_hits += int(record["cache_hit"][0])
+                print("Processed {} sub-images...".format(n_processed+1), end="\r")
+        finally:
+            shm.close()
+            shm.unlink()
+        return feature_vecs, n_hits
 
 
     def process_single_date(self, date_string):
         """
-        Each date will have a subdirectory called 'SPLIT' with ~400 BWNDVI
-        sub-images.
+        Each date will have a subdirectory called 'TILES' containing a tile
+        store with ~400 BWNDVI sub-images, or a subdirectory called
+        'SPLIT' with ~400 BWNDVI sub-image png files.
         """
         # see if there is already a network_centralities.json file in
         # the output location - if so, skip
@@ -489,59 +883,83 @@ class NetworkCentralityCalculator(ProcessorModule):
            self.check_for_existing_files(output_location, 1):
             return True
 
-        input_path = os.path.join(self.input_location, date_string, "SPLIT")
-        all_input_files = self.list_directory(input_path, self.input_location_type)
-        print("input path is {}".format(input_path))
-
-        # list all the "BWNDVI" sub-images where RGB image passes quality check
-        input_files = [filename for filename in all_input_files \
-                       if "BWNDVI" in filename and \
-                       self.check_sub_image(filename, input_path)]
-        if len(input_files) == 0:
+        cache_location = self.get_sc_cache_location()
+        tiles = self.load_tile_store_tiles(date_string)
+        if tiles is None:
+            tiles = self.load_png_tiles(date_string)
+        tiles, coords_strings = tiles
+        if len(tiles) == 0:
             print("{}: No sub-images for date {}".format(self.name,
                                                          date_string))
             return
         else:
-            print("{} found {} sub-images".format(self.name, len(input_files)))
-        tmp_json_dir = tempfile.mkdtemp()
+            print("{} found {} sub-images".format(self.name, len(tiles)))
 
         # if we only want a subset of sub-images, truncate the list here
         if self.n_sub_images > 0:
-            input_files = input_files[:self.n_sub_images]
-
-        # create a multiprocessing pool to handle each sub-image in parallel
-        with Pool(processes=self.n_threads) as pool:
-            # prepare the arguments for the process_sub_image function
-            arguments=[(i,
-                        self.get_file(os.path.join(input_path,filename),
-                                      self.input_location_type),
-                        tmp_json_dir,
-                        date_string,
-                        find_coords_string(filename)) \
-                   for i, filename in enumerate(input_files)]
-            pool.starmap(process_sub_image, arguments)
-        # put all the output json files for subimages together into one for this date
-        print("\n Consolidating json from all subimages")
-        all_subimages = consolidate_json_to_list(tmp_json_dir)
+            tiles = tiles[:self.n_sub_images]
+            coords_strings = coords_strings[:self.n_sub_images]
+
+        # use the pool of worker processes to handle each sub-image in parallel
+        feature_vecs, n_hits = self.calc_feature_vectors(tiles, cache_location)
+        instrumentation.increment("tiles_processed", len(feature_vecs))
+        instrumentation.increment("cache_hits", n_hits)
+        if cache_location:
+            print("\n{}: subgraph centrality cache for {}: {} hits, {} misses"\
+                  .format(self.name, date_string, n_hits, len(feature_vecs)-n_hits))
+
+        # calculate the metrics for all sub-images at once
+        all_metrics = feature_vector_metrics_batch(np.stack(feature_vecs))
+        all_subimages = []
+        for feature_vec, metrics, coords_string in zip(feature_vecs, all_metrics,
+                                                       coords_strings):
+            coords = [round(float(c), 4) for c in coords_string.split("_")]
+            nc_result = {name: float(metrics[name]) for name in all_metrics.dtype.names}
+            nc_result['feature_vec'] = feature_vec.tolist()
+            nc_result['date'] = date_string
+            nc_result['latitude'] = coords[1]
+            nc_result['longitude'] = coords[0]
+            all_subimages.append(nc_result)
         self.save_json(all_subimages, "network_centralities.json",
                        output_location,
                        self.output_location_type)
-        shutil.rmtree(tmp_json_dir)
         return True
 
 
+    def get_output_dirs(self, date_string):
+        return [os.path.join(self.output_location, date_string, "JSON", "NC")]
+
+
+    def process(self, date_string):
+        if not self.has_sub_images(date_string):
+            return False
+        return self.process_single_date(date_string)
+
+
+    def start_streaming(self):
+        # keep the same worker processes for all dates, using the
+        # pipeline's pool if there is one
+        self.pool = self.get_shared_worker_pool()
+        self.owns_pool = self.pool is None
+        if self.owns_pool:
+            self.pool = self.make_pool()
+
+
+    def finish_streaming(self):
+        if self.owns_pool:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+
     def run(self):
         super().run()
-        if "list_of_dates" in vars(self):
-            date_strings = self.list_of_dates
-        else:
-            date_strings = sorted(self.list_directory(self.input_location,
-                                                      self.input_location_type))
-        for date_string in date_strings:
-            date_path = os.path.join(self.input_location, date_string)
-            if "SPLIT" not in self.list_directory(date_path, self.input_location_type):
-                continue
-            self.process_single_date(date_string)
+        self.start_streaming()
+        try:
+            for date_string in self.list_dates():
+                self.run_date(date_string)
+        finally:
+            self.finish_streaming()
 
 
 
@@ -556,7 +974,8 @@ class NDVICalculator(ProcessorModule):
     def __init__(self, name=None):
         super().__init__(name)
         self.params += [
-            ("n_sub_images", [int])
+            ("n_sub_images", [int]),
+            ("n_threads", [int])
         ]
 
 
@@ -568,60 +987,122 @@ class NDVICalculator(ProcessorModule):
         super().set_default_parameters()
         if not "n_sub_images" in vars(self):
             self.n_sub_images = -1 # do all-sub-images
+        if not "n_threads" in vars(self):
+            self.n_threads = 1 # number of dates to process at once, -1 means one per cpu
 
 
-    def check_sub_image(self, ndvi_filename, input_path):
+    def process_sub_image_array(self, ndvi_image_array, bwndvi_image_array,
+                                date_string, coords_string):
         """
-        Check the RGB sub-image corresponding to this NDVI image
-        looks OK.
+        Calculate mean NDVI from arrays of the NDVI and BWNDVI sub-images,
+        both with and without masking out non-vegetation pixels.
         """
-        rgb_filename = re.sub("NDVI","RGB",ndvi_filename)
-        rgb_img = self.get_image(os.path.join(input_path, rgb_filename))
+        return self.process_tile_stacks(ndvi_image_array[np.newaxis],
+                                        bwndvi_image_array[np.newaxis],
+                                        date_string, [coords_string])[0]
 
-        img_ok = check_image_ok(rgb_img, 0.05)
-        return img_ok
 
+    def process_tile_stacks(self, ndvi_stack, bwndvi_stack, date_string,
+                            coords_strings):
+        """
+        Calculate mean NDVI for every tile in a stack of NDVI tiles at once,
+        both with and without masking out non-vegetation pixels, as
+        given by the corresponding stack of BWNDVI tiles.
+        Returns a list of dicts, one per tile.
+        """
+        ndvi_stack = np.asarray(ndvi_stack)
+        instrumentation.increment("tiles_processed", len(ndvi_stack))
+        pix_axes = tuple(range(1, ndvi_stack.ndim))
+        n_pix = np.prod(ndvi_stack.shape[1:])
+        # sums of integer pixel values are exact, so these are the same as .mean()
+        ndvi_sums = ndvi_stack.sum(axis=pix_axes, dtype=np.float64)
+        ndvi_means = np.round(ndvi_sums / n_pix, 4)
 
-    def process_sub_image(self, ndvi_filepath, date_string, coords_string):
+        # use the BWDVI to mask the NDVI and calculate the average pixel value of veg pixels
+        veg_mask = (np.asarray(bwndvi_stack) == 0)
+        n_veg_pix = veg_mask.sum(axis=pix_axes)
+        veg_sums = np.where(veg_mask, ndvi_stack, 0).sum(axis=pix_axes, dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ndvi_veg_means = np.where(n_veg_pix > 0, veg_sums / n_veg_pix, np.nan)
+
+        ndvi_results = []
+        for ndvi_mean, ndvi_veg_mean, coords_string in zip(ndvi_means,
+                                                           ndvi_veg_means,
+                                                           coords_strings):
+            # format coords
+            coords = [round(float(c), 4) for c in coords_string.split("_")]
+
+            # store results in a dict
+            ndvi_result = {}
+            ndvi_result['date'] = date_string
+            ndvi_result['latitude'] = coords[1]
+            ndvi_result['longitude'] = coords[0]
+            ndvi_result['ndvi'] = ndvi_mean
+            ndvi_result['ndvi_veg'] = ndvi_veg_mean
+            ndvi_results.append(ndvi_result)
+        return ndvi_results
+
+
+    def process_tiles(self, date_string):
         """
-        Calculate mean and standard deviation of NDVI in a sub-image,
-        both with and without masking out non-vegetation pixels.
+        Calculate NDVI results for all the tiles in the NDVI tile store for
+        this date, where the RGB tile passes the quality check.
+        Returns None if there is no tile store.
         """
+        ndvi_paths = self.find_tile_store(date_string, "NDVI")
+        bwndvi_paths = self.find_tile_store(date_string, "BWNDVI")
+        if not (ndvi_paths and bwndvi_paths):
+            return None
+        ndvi_store = get_tile_store(*ndvi_paths)
+        bwndvi_store = get_tile_store(*bwndvi_paths)
+        rgb_paths = self.find_tile_store(date_string, "RGB")
+        accept, _ = self.screen_sub_images(
+            date_string, ndvi_store.metadata["tile_shape"][:2], len(ndvi_store),
+            lambda: get_tile_store(*rgb_paths)[:] if rgb_paths else None)
+
+        indices = np.flatnonzero(accept)
+        print("{} found {} sub-images".format(self.name, len(indices)))
+        # if we only want a subset of sub-images, truncate the list here
+        if self.n_sub_images > 0:
+            indices = indices[:self.n_sub_images]
 
-        # open NDVI images
-        ndvi_sub_image = self.get_image(ndvi_filepath)
-        ndvi_image_array = pillow_to_numpy(ndvi_sub_image)
-        bwndvi_sub_image = self.get_image(ndvi_filepath.replace('NDVI', 'BWNDVI'))
-        bwndvi_image_array = pillow_to_numpy(bwndvi_sub_image)
+        return self.process_tile_stacks(ndvi_store[indices], bwndvi_store[indices],
+                                        date_string,
+                                        [ndvi_store.get_coords_string(i) for i in indices])
 
-        # get average NDVI across the whole image (in case there is no patterned veg)
-        ndvi_mean = round(ndvi_image_array.mean(), 4)
 
-        # use the BWDVI to mask the NDVI and calculate the average pixel value of veg pixels
-        veg_mask = (bwndvi_image_array == 0)
-        if veg_mask.sum() > 0:
-            ndvi_veg_mean = ndvi_image_array[veg_mask].mean()
-        else:
-            ndvi_veg_mean = np.NaN
+    def process_png_files(self, date_string):
+        """
+        Calculate NDVI results for the NDVI png files in the SPLIT
+        directory for this date, where the RGB sub-image passes the
+        quality check.
+        """
+        input_path = os.path.join(self.input_location, date_string, "SPLIT")
+        print("input path is {}".format(input_path))
 
-        # format coords
-        coords = [round(float(c), 4) for c in coords_string.split("_")]
+        # list all the "NDVI" sub-images that pass the quality screen
+        input_files = self.screen_png_sub_images(date_string, "NDVI")
 
-        # store results in a dict
-        ndvi_result = {}
-        ndvi_result['date'] = date_string
-        ndvi_result['latitude'] = coords[1]
-        ndvi_result['longitude'] = coords[0]
-        ndvi_result['ndvi'] = ndvi_mean
-        ndvi_result['ndvi_veg'] = ndvi_veg_mean
+        print("{} found {} sub-images".format(self.name, len(input_files)))
+        # if we only want a subset of sub-images, truncate the list here
+        if self.n_sub_images > 0:
+            input_files = input_files[:self.n_sub_images]
+        if len(input_files) == 0:
+            return []
 
-        return ndvi_result
+        bwndvi_files = [filename.replace("NDVI", "BWNDVI") for filename in input_files]
+        return self.process_tile_stacks(self.load_png_stack(input_path, input_files),
+                                        self.load_png_stack(input_path, bwndvi_files),
+                                        date_string,
+                                        [find_coords_string(filename) \
+                                         for filename in input_files])
 
 
     def process_single_date(self, date_string):
         """
-        Each date will have a subdirectory called 'SPLIT' with ~400 NDVI
-        sub-images.
+        Each date will have a subdirectory called 'TILES' containing a tile
+        store with ~400 NDVI sub-images, or a subdirectory called 'SPLIT'
+        with ~400 NDVI sub-image png files.
         """
         # see if there is already a ndvi.json file in
         # the output location - if so, skip
@@ -630,31 +1111,13 @@ class NDVICalculator(ProcessorModule):
            self.check_for_existing_files(output_location, 1):
             return True
 
-        input_path = os.path.join(self.input_location, date_string, "SPLIT")
-        all_input_files = self.list_directory(input_path, self.input_location_type)
-        print("input path is {}".format(input_path))
-
-        # list all the "NDVI" sub-images where RGB image passes quality check
-        input_files = [filename for filename in all_input_files \
-                       if "_NDVI" in filename and \
-                       self.check_sub_image(filename, input_path)]
-
-        if len(input_files) == 0:
+        ndvi_vals = self.process_tiles(date_string)
+        if ndvi_vals is None:
+            ndvi_vals = self.process_png_files(date_string)
+        if len(ndvi_vals) == 0:
             print("{}: No sub-images for date {}".format(self.name,
                                                          date_string))
             return
-        else:
-            print("{} found {} sub-images".format(self.name, len(input_files)))
-        # if we only want a subset of sub-images, truncate the list here
-        if self.n_sub_images > 0:
-            input_files = input_files[:self.n_sub_images]
-
-        ndvi_vals = []
-        for ndvi_file in input_files:
-            coords_string = find_coords_string(ndvi_file)
-            ndvi_dict = self.process_sub_image(os.path.join(input_path, ndvi_file),
-                                               date_string, coords_string)
-            ndvi_vals.append(ndvi_dict)
 
         self.save_json(ndvi_vals, "ndvi_values.json",
                        output_location,
@@ -663,16 +1126,36 @@ class NDVICalculator(ProcessorModule):
         return True
 
 
+    def get_n_workers(self):
+        """
+        Number of dates to process at once - n_threads, or the
+        number of cpus if n_threads is -1 (or any value < 1).
+        """
+        if self.n_threads > 0:
+            return self.n_threads
+        return os.cpu_count() or 1
+
+
+    def get_output_dirs(self, date_string):
+        return [os.path.join(self.output_location, date_string, "JSON", "NDVI")]
+
+
+    def process(self, date_string):
+        if not self.has_sub_images(date_string):
+            return False
+        return self.process_single_date(date_string)
+
 
     def run(self):
         super().run()
-        if "list_of_dates" in vars(self):
-            date_strings = self.list_of_dates
-        else:
-            date_strings = sorted(self.list_directory(self.input_location,
-                                                      self.input_location_type))
-        for date_string in date_strings:
-            date_path = os.path.join(self.input_location, date_string)
-            if "SPLIT" not in self.list_directory(date_path, self.input_location_type):
-                continue
-            self.process_single_date(date_string)
+        date_strings = [date_string for date_string in self.list_dates() \
+                        if self.has_sub_images(date_string)]
+        n_workers = min(self.get_n_workers(), len(date_strings))
+        if n_workers <= 1:
+            for date_string in date_strings:
+                self.run_date(date_string)
+            return
+        # the work for each date is numpy reductions and file reads, which
+        # release the GIL, so threads are enough to process dates in parallel
+        with ThreadPool(processes=n_workers) as pool:
+            pool.map(self.run_date, date_strings)
@@ -15,14 +15,32 @@ the results of the different SEQUENCES into one output file.
 
 import os
 import json
+import queue
+import hashlib
+import tempfile
+import threading
+import contextlib
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from pyveg.src.file_utils import save_json
+from pyveg.src.manifest import RunManifest, MANIFEST_FILENAME, describe_artefacts
+from pyveg.src.instrumentation import RunMetrics, ModuleProfiler
 try:
     from pyveg.src import azure_utils
 except:
     print("Azure utils could not be imported - is Azure SDK installed?")
 
+# module parameters that don't change the results for a date, so
+# aren't included in the config hash recorded in the run manifest
+CONFIG_HASH_EXCLUDE = ["input_location", "input_location_type",
+                       "output_location", "output_location_type",
+                       "replace_existing_files", "date_range",
+                       "n_threads", "pool_chunksize",
+                       "download_max_retries", "download_timeout"]
+
+RUN_REPORT_FILENAME = "run_report"
+
 class Pipeline(object):
     """
     A Pipeline contains all the Sequences we want to run on a particular
@@ -37,6 +55,25 @@ class Pipeline(object):
         self.date_range = None
         self.output_location = None
         self.output_location_type = None
+        # number of sequences to run at once, -1 means no limit
+        self.max_parallel_sequences = 1
+        # record completed work in a manifest in the output location
+        self.use_manifest = True
+        self.manifest = None
+        self.manifest_lock = threading.Lock()
+        self.manifest_upload_lock = threading.Lock()
+        self.manifest_dir = None
+        # redo dates that had no output (e.g. no images found) when resuming
+        self.retry_dates_without_output = True
+        # record checksums of output files in the manifest (reads all of them)
+        self.manifest_checksums = False
+        # time and resources used by each module, for the run report
+        self.run_metrics = RunMetrics(name)
+        # {concurrency group: semaphore} limiting how many modules of each
+        # group process a date at once - can be shared between pipelines
+        self.concurrency_limits = {}
+        # pool of worker processes for modules to use instead of their own
+        self.worker_pool = None
         self.is_configured = False
 
 
@@ -61,6 +98,7 @@ class Pipeline(object):
         output += "date_range:  {}\n".format(self.date_range)
         output += "output_location:  {}\n".format(self.output_location)
         output += "output_location_type:  {}\n".format(self.output_location_type)
+        output += "max_parallel_sequences:  {}\n".format(self.max_parallel_sequences)
         output += "\n ------- Sequences ----------\n\n"
         for s in self.sequences:
             output += s.__repr__()
@@ -77,6 +115,84 @@ class Pipeline(object):
                 return sequence
 
 
+    def get_manifest_path(self):
+        """
+        The manifest goes in the output location if that is local.  SQLite
+        needs a local file, so for Azure a working copy goes in a new
+        temporary directory, and is uploaded to the container by save_manifest().
+        """
+        if self.output_location_type == "local":
+            return os.path.join(self.output_location, MANIFEST_FILENAME)
+        if self.manifest_dir is None:
+            self.manifest_dir = tempfile.mkdtemp()
+        return os.path.join(self.manifest_dir, MANIFEST_FILENAME)
+
+
+    def get_manifest(self):
+        """
+        Return the RunManifest for this pipeline, opening it the first time
+        it is needed, or None if use_manifest is False.
+        For Azure, the manifest from an earlier run is first downloaded from
+        the container, so a run can be resumed from any machine.
+        """
+        if not self.use_manifest:
+            return None
+        with self.manifest_lock:
+            if self.manifest is None:
+                manifest_path = self.get_manifest_path()
+                if self.output_location_type == "azure":
+                    retrieved, message = azure_utils.retrieve_blob(
+                        MANIFEST_FILENAME, self.output_location,
+                        os.path.dirname(manifest_path))
+                    if not retrieved:
+                        print("{}: no run manifest in {} - starting a new one"\
+                              .format(self.name, self.output_location))
+                self.manifest = RunManifest(manifest_path)
+        return self.manifest
+
+
+    def save_manifest(self):
+        """
+        For Azure, upload a copy of the manifest to the container, so that
+        it isn't lost with the temporary directory.  Does nothing for local
+        output, as the manifest is already in the output location.
+        """
+        if self.output_location_type != "azure" or self.manifest is None:
+            return
+        # one upload at a time, so an older copy can't overwrite a newer one
+        with self.manifest_upload_lock:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                tmp_path = os.path.join(tmpdir, MANIFEST_FILENAME)
+                self.manifest.copy_to(tmp_path)
+                azure_utils.write_file_to_blob(tmp_path, MANIFEST_FILENAME,
+                                               self.output_location)
+
+
+    def write_run_report(self):
+        """
+        Save the time and resources used by each module, as json and as a
+        text table, to run_report.json and run_report.txt in the output
+        location.  Returns the text table.
+        """
+        report = self.run_metrics.get_report()
+        text_report = self.run_metrics.get_text_report()
+        if self.output_location_type == "local":
+            save_json(report, self.output_location, RUN_REPORT_FILENAME+".json")
+            with open(os.path.join(self.output_location,
+                                   RUN_REPORT_FILENAME+".txt"), "w") as outfile:
+                outfile.write(text_report)
+        elif self.output_location_type == "azure":
+            azure_utils.save_json(report, self.output_location,
+                                  RUN_REPORT_FILENAME+".json", self.output_location)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                tmp_path = os.path.join(tmpdir, RUN_REPORT_FILENAME+".txt")
+                with open(tmp_path, "w") as outfile:
+                    outfile.write(text_report)
+                azure_utils.write_file_to_blob(tmp_path, RUN_REPORT_FILENAME+".txt",
+                                               self.output_location)
+        return text_report
+
+
     def configure(self):
         """
         Configure all the sequences in this pipeline.
@@ -102,12 +218,146 @@ class Pipeline(object):
         self.is_configured = True
 
 
-    def run(self):
+    def get_dependency_graph(self):
         """
-        run all the sequences in this pipeline
+        Return a dict {sequence_name: set of names of the sequences it
+        depends on}, checking that all the dependencies exist and that
+        there are no circular dependencies.
         """
+        sequence_names = [sequence.name for sequence in self.sequences]
+        graph = {}
         for sequence in self.sequences:
-            sequence.run()
+            for dependency in sequence.depends_on:
+                if dependency not in sequence_names:
+                    raise RuntimeError("{}: sequence {} depends on unknown sequence {}"\
+                                       .format(self.name, sequence.name, dependency))
+            graph[sequence.name] = set(sequence.depends_on)
+        self.get_run_order(graph)
+        return graph
+
+
+    def get_run_order(self, graph=None):
+        """
+        Return the sequences in an order where each one comes after all
+        the sequences it depends on, otherwise keeping the order in which
+        they were added.
+        """
+        if graph is None:
+            graph = self.get_dependency_graph()
+        run_order = []
+        finished = set()
+        remaining = list(self.sequences)
+        while remaining:
+            ready = [sequence for sequence in remaining \
+                     if graph[sequence.name] <= finished]
+            if not ready:
+                raise RuntimeError("{}: circular dependencies between sequences {}"\
+                                   .format(self.name,
+                                           [sequence.name for sequence in remaining]))
+            run_order.append(ready[0])
+            finished.add(ready[0].name)
+            remaining.remove(ready[0])
+        return run_order
+
+
+    def run(self):
+        """
+        run all the sequences in this pipeline, running up to
+        max_parallel_sequences at once, each as soon as all the
+        sequences it depends on have finished.
+        """
+        graph = self.get_dependency_graph()
+        max_parallel = self.max_parallel_sequences
+        if max_parallel < 1:
+            max_parallel = len(self.sequences)
+        try:
+            if max_parallel <= 1:
+                for sequence in self.get_run_order(graph):
+                    sequence.run()
+            else:
+                self.run_concurrently(graph, max_parallel)
+        finally:
+            self.save_manifest()
+
+
+    def run_concurrently(self, graph, max_parallel):
+        """
+        Run sequences in a pool of max_parallel threads, as soon as their
+        dependencies are satisfied.  Sequences spend most of their time
+        waiting on downloads, file I/O or their own worker processes, so
+        threads are enough to overlap them.
+        If a sequence fails, no more sequences are started, and once the
+        running ones have finished the first exception is re-raised.
+        """
+        tasks = [(sequence.name, sequence.run) for sequence in self.get_run_order(graph)]
+        run_task_graph(tasks, graph, max_parallel, self.name)
+
+
+
+def run_task_graph(tasks, graph, max_parallel, name, stop_on_failure=True):
+    """
+    Run tasks (typically Sequence.run) in a pool of max_parallel threads,
+    each as soon as all the tasks it depends on have finished.
+
+    Parameters
+    ==========
+    tasks: list of (key, function) tuples, in the order to start them
+           when several are ready.  Each task must come after the tasks
+           it depends on.
+    graph: dict {key: set of keys of the tasks it depends on}
+    max_parallel: int, max number of tasks to run at once
+    name: str, used in progress messages
+    stop_on_failure: bool, if True, when a task fails no more tasks are
+                     started, and once the running ones have finished the
+                     first exception is re-raised.  If False, only the tasks
+                     depending on a failed one are not run.
+
+    Returns
+    =======
+    failures: dict {key: exception} for the tasks that failed
+    not_run: list of keys of the tasks that weren't run because of failures
+    """
+    pending = list(tasks)
+    finished = set()
+    not_run = []
+    running = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            if not stop_on_failure:
+                # tasks are in dependency order, so one pass finds all
+                # the tasks that can now never run
+                for key, func in list(pending):
+                    if graph[key] & (set(failures) | set(not_run)):
+                        print("{}: not running sequence {} as one it depends on failed"\
+                              .format(name, key))
+                        pending.remove((key, func))
+                        not_run.append(key)
+            ready = [(key, func) for key, func in pending if graph[key] <= finished]
+            while ready and not (failures and stop_on_failure) \
+                  and len(running) < max_parallel:
+                key, func = ready.pop(0)
+                pending.remove((key, func))
+                print("{}: starting sequence {}".format(name, key))
+                running[executor.submit(func)] = key
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                if future.exception():
+                    print("{}: sequence {} failed: {}"\
+                          .format(name, key, future.exception()))
+                    failures[key] = future.exception()
+                else:
+                    print("{}: finished sequence {}".format(name, key))
+                    finished.add(key)
+    not_run += [key for key, _ in pending]
+    if failures and stop_on_failure:
+        if not_run:
+            print("{}: not running sequences {}".format(name, not_run))
+        raise next(iter(failures.values()))
+    return failures, not_run
 
 
 
@@ -127,6 +377,10 @@ class Sequence(object):
         self.parent = None
         self.output_location = None
         self.output_location_type = None
+        # if True, push each date through all the modules as soon as it is ready
+        self.streaming = False
+        # max number of dates waiting between one module and the next when streaming
+        self.stream_queue_size = 2
         self.is_configured = False
 
 
@@ -185,8 +439,84 @@ class Sequence(object):
 
 
     def run(self):
+        if self.streaming:
+            if self.can_stream():
+                self.run_streaming()
+                return
+            print("{}: not all modules support streaming - running one module at a time"\
+                  .format(self.name))
+        for module in self.modules:
+            with module.instrument():
+                module.run()
+
+
+    def can_stream(self):
+        """
+        Streaming needs every module to process one date at a time.
+        """
+        return len(self.modules) > 0 and \
+            all(module.supports_streaming() for module in self.modules)
+
+
+    def run_streaming(self):
+        """
+        Run every module at once, each in its own thread, with each date
+        passed on to the next module as soon as the previous one has
+        processed it, via a queue of at most stream_queue_size dates.
+        So e.g. images for one date can be processed while the next date
+        is downloading.
+        The first module decides which dates there are.  Dates for which
+        a module's process() returns False are not passed on.
+        If any module fails, the others stop taking new dates, and the
+        first exception is re-raised.
+        """
         for module in self.modules:
-            module.run()
+            if not module.is_configured:
+                raise RuntimeError("Module {} needs to be configured before running"\
+                                   .format(module.name))
+        # None is put on a queue to show there are no more dates
+        queues = [queue.Queue(maxsize=max(1, self.stream_queue_size)) \
+                  for _ in self.modules[1:]]
+        failures = []
+
+        def run_stage(i, module):
+            in_queue = queues[i-1] if i > 0 else None
+            out_queue = queues[i] if i < len(queues) else None
+            finished_input = in_queue is None
+            try:
+                with module.instrument():
+                    module.start_streaming()
+                    try:
+                        dates = module.list_dates() if i == 0 else iter(in_queue.get, None)
+                        for date_string in dates:
+                            if failures:
+                                break
+                            if module.run_date(date_string) and out_queue:
+                                out_queue.put(date_string)
+                        else:
+                            finished_input = True
+                    finally:
+                        module.finish_streaming()
+            except Exception as e:
+                print("{}: module {} failed: {}".format(self.name, module.name, e))
+                failures.append(e)
+            finally:
+                # let the next module finish, and don't leave the previous one
+                # blocked on a full queue
+                if out_queue:
+                    out_queue.put(None)
+                while not finished_input:
+                    finished_input = in_queue.get() is None
+
+        threads = [threading.Thread(target=run_stage, args=(i, module),
+                                    name="{}_{}".format(self.name, module.name)) \
+                   for i, module in enumerate(self.modules)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0]
 
 
     def __repr__(self):
@@ -232,6 +562,10 @@ class BaseModule(object):
             self.name = self.__class__.__name__
         self.params = []
         self.parent = None
+        # set to True, "cprofile" or "pyinstrument" to profile this module's run
+        self.profile = False
+        # e.g. "download", for the pipeline's concurrency_limits
+        self.concurrency_group = None
         self.is_configured = False
 
 
@@ -290,6 +624,193 @@ class BaseModule(object):
         pass
 
 
+    def supports_streaming(self):
+        """
+        Modules can be run in a streaming Sequence if they implement
+        list_dates() (needed for the first module only) and process().
+        """
+        return type(self).process is not BaseModule.process
+
+
+    def list_dates(self):
+        """
+        Return the list of dates (as "YYYY-MM-DD" strings) this module would
+        process when run.
+        """
+        raise RuntimeError("{}: module doesn't support streaming".format(self.name))
+
+
+    def process(self, date_string):
+        """
+        Do this module's work for one date, for a streaming Sequence.
+        Return True if there is output for the next module for this date.
+        """
+        raise RuntimeError("{}: module doesn't support streaming".format(self.name))
+
+
+    def get_output_dirs(self, date_string):
+        """
+        Return the list of directories that process() writes to for this
+        date, so that their contents can be recorded in the run manifest.
+        """
+        return []
+
+
+    def get_manifest(self):
+        """
+        Return the RunManifest of the Pipeline this module is part of,
+        or None if there isn't one.
+        """
+        sequence = self.parent
+        if sequence is None or getattr(sequence, "parent", None) is None:
+            return None
+        return sequence.parent.get_manifest()
+
+
+    def get_config_hash(self):
+        """
+        Hash the values of this module's parameters, along with the config
+        hash of the previous module in the sequence, as that produces this
+        module's input.  So changing the configuration of one module
+        invalidates the manifest entries for it and the modules after it.
+        """
+        config = {param: vars(self).get(param) for param, _ in self.params \
+                  if param not in CONFIG_HASH_EXCLUDE}
+        hasher = hashlib.sha1()
+        hasher.update(self.__class__.__name__.encode())
+        hasher.update(json.dumps(config, sort_keys=True, default=str).encode())
+        if self.parent and self in self.parent.modules:
+            index = self.parent.modules.index(self)
+            if index > 0:
+                hasher.update(self.parent.modules[index-1].get_config_hash().encode())
+        return hasher.hexdigest()
+
+
+    def get_run_metrics(self):
+        """
+        Return the RunMetrics of the Pipeline this module is part of,
+        or None if there isn't one.
+        """
+        sequence = self.parent
+        if sequence is None or getattr(sequence, "parent", None) is None:
+            return None
+        return sequence.parent.run_metrics
+
+
+    def limit_concurrency(self):
+        """
+        Return the semaphore from the pipeline's concurrency_limits for this
+        module's concurrency_group, so that (e.g. in a batch run over many
+        locations) only so many downloads etc. happen at once.
+        Returns a null context manager if there is no limit.
+        """
+        sequence = self.parent
+        if sequence is None or getattr(sequence, "parent", None) is None:
+            return contextlib.nullcontext()
+        limit = sequence.parent.concurrency_limits.get(self.concurrency_group)
+        return limit if limit is not None else contextlib.nullcontext()
+
+
+    def measure(self, date_string=None):
+        """
+        Return a context manager measuring the time and resources used by
+        this module (for one date, if date_string is given) in the with block.
+        """
+        run_metrics = self.get_run_metrics()
+        if run_metrics is None:
+            return contextlib.nullcontext()
+        return run_metrics.measure(self.parent.name, self.name, date_string)
+
+
+    @contextlib.contextmanager
+    def instrument(self):
+        """
+        Measure a whole run of this module, and profile it if self.profile
+        is set (e.g. from the special_config of the config file).
+        """
+        profiler = None
+        if self.profile:
+            profiler = ModuleProfiler("cprofile" if self.profile is True else self.profile)
+        with self.measure():
+            if profiler and not profiler.start():
+                profiler = None
+            try:
+                yield
+            finally:
+                if profiler:
+                    profiler.stop()
+                    self.save_profile(profiler)
+
+
+    def save_profile(self, profiler):
+        """
+        Save a profile of this module's run to the 'profiles' subdirectory
+        of the output location, and add it to the run report.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile_path = profiler.save(os.path.join(tmpdir, self.name))
+            self.copy_to_output_location(tmpdir,
+                                         os.path.join(self.output_location, "profiles"))
+        print("{}: saved profile {}".format(self.name, os.path.basename(profile_path)))
+        run_metrics = self.get_run_metrics()
+        if run_metrics:
+            run_metrics.add_profile(self.parent.name, self.name, profiler.get_text())
+
+
+    def run_date(self, date_string):
+        """
+        Call process() for one date, unless the run manifest shows it has
+        already been done with the same configuration, and record it in
+        the manifest once it has been.  Dates that were done but had no
+        output are done again, unless the pipeline's
+        retry_dates_without_output is False.
+        The time and resources used are recorded for the run report.
+        Returns True if there is output for the next module for this date.
+        """
+        with self.measure(date_string) as measurement:
+            manifest = self.get_manifest()
+            if manifest is None:
+                with self.limit_concurrency():
+                    return self.process(date_string)
+            pipeline = self.parent.parent
+            config_hash = self.get_config_hash()
+            if not vars(self).get("replace_existing_files", False):
+                entry = manifest.get(self.parent.name, self.name, date_string)
+                if entry and entry["config_hash"] == config_hash and \
+                   (entry["has_output"] or not pipeline.retry_dates_without_output):
+                    print("{}: {} already done according to the run manifest - skipping"\
+                          .format(self.name, date_string))
+                    if measurement:
+                        measurement.skipped = True
+                    return entry["has_output"]
+            with self.limit_concurrency():
+                has_output = bool(self.process(date_string))
+            if self.output_location_type == "local":
+                artefacts = describe_artefacts(self.get_output_dirs(date_string),
+                                               pipeline.manifest_checksums)
+            else:
+                artefacts = [{"path": path} for path in self.get_output_dirs(date_string)]
+            manifest.mark_complete(self.parent.name, self.name, date_string,
+                                   config_hash, has_output, artefacts)
+            pipeline.save_manifest()
+            return has_output
+
+
+    def start_streaming(self):
+        """
+        Called before the first call to process() in a streaming Sequence,
+        e.g. to set up resources that run() would use for all dates.
+        """
+        pass
+
+
+    def finish_streaming(self):
+        """
+        Called after the last call to process() in a streaming Sequence.
+        """
+        pass
+
+
     def run(self):
         if not self.is_configured:
             raise RuntimeError("Module {} needs to be configured before running".format(self.name))
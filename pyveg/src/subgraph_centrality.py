@@ -14,19 +14,50 @@ Estrada et.al. "Subgraph Centrality in Complex Networks"
 https://arxiv.org/pdf/cond-mat/0504730.pdf
 """
 
+import math
+from functools import lru_cache
 import numpy as np
 from PIL import Image
-from scipy import spatial
+from scipy import spatial, sparse
+from scipy.sparse.linalg import expm_multiply
+from scipy.sparse.csgraph import connected_components
 import argparse
 import igraph
 
 from .image_utils import image_from_array, image_file_to_array
 
 
+# "forward" offsets to the 4- or 8- neighbours of a pixel, keyed by
+# use_diagonal_neighbours (the "backward" ones are found by symmetry).
+NEIGHBOUR_OFFSETS = {
+    False: np.array([(0, 1), (1, 0)]),
+    True: np.array([(0, 1), (1, 0), (1, 1), (1, -1)])
+}
+
+# numpy dtypes for the "precision" option of subgraph_centrality:
+# (dense adjacency matrix, sparse adjacency matrix, eigen-solve)
+PRECISION_DTYPES = {
+    "float64": (np.float64, np.float64, np.float64),
+    "float32": (np.bool_, np.float32, np.float32)
+}
+
+# names of the metrics calculated by feature_vector_metrics
+FEATURE_VECTOR_METRICS = ["slope", "offset", "offset50", "mean", "std"]
+
+
 def make_graph(adj_matrix):
     """
     Use igraph to create a graph from our adjacency matrix
     """
+    if sparse.issparse(adj_matrix):
+        # build directly from the non-zero elements, so we never need
+        # a dense copy of the matrix.  Like Graph.Adjacency, every
+        # neighbour pair gives two directed edges.
+        rows, cols = adj_matrix.nonzero()
+        graph = igraph.Graph(n=adj_matrix.shape[0],
+                             edges=list(zip(rows.tolist(), cols.tolist())),
+                             directed=True)
+        return graph
     graph = igraph.Graph.Adjacency((adj_matrix>0).tolist())
     return graph
 
@@ -44,6 +75,29 @@ def calc_euler_characteristic(pix_indices, graph):
     return V-E
 
 
+def calc_euler_characteristics(pix_indices, adj_matrix, n_pix_values):
+    """
+    Calculate the Euler characteristic V-E of the sub-graphs made of the
+    first n_pix pixels of pix_indices, for each n_pix in n_pix_values.
+    As these sub-graphs are nested, we find, for every edge, the position
+    in pix_indices at which both of its ends are present, and count how
+    many edges have been closed at each value of n_pix.
+    """
+    n = adj_matrix.shape[0]
+    # position of each pixel in the ordered list
+    rank = np.empty(n, dtype=np.int64)
+    rank[pix_indices] = np.arange(len(pix_indices))
+    # count each edge once, ignoring any diagonal elements
+    edges = sparse.triu(sparse.coo_matrix(adj_matrix), k=1)
+    edges_closed_at = np.maximum(rank[edges.row], rank[edges.col])
+    # n_edges[k] is the number of edges among the first k pixels
+    n_edges = np.concatenate([[0],
+                              np.cumsum(np.bincount(edges_closed_at,
+                                                    minlength=n))])
+    n_pix_values = np.asarray(n_pix_values, dtype=np.int64)
+    return n_pix_values - n_edges[n_pix_values]
+
+
 def write_csv(feature_vec, output_filename):
     """
     Write the feature vector to a 1-line csv
@@ -84,11 +138,12 @@ def crop_image_array(input_image, x_range, y_range):
 def fill_sc_pixels(sel_pixels, orig_image, val=200):
     """
     Given an original 2D array where all the elements are 0 (background)
-    or 255 (signal), fill in a selected subset of signal pixels as 123 (grey).
+    or 255 (signal), fill in a selected subset of signal pixels, given
+    as an (N,2) array of coordinates, with val (default 200, grey).
     """
     new_image = np.copy(orig_image)
-    for pix in sel_pixels:
-        new_image[pix] = 200
+    sel_pixels = np.asarray(sel_pixels, dtype=int).reshape(-1, 2)
+    new_image[sel_pixels[:, 0], sel_pixels[:, 1]] = val
     return new_image
 
 
@@ -117,15 +172,13 @@ def get_signal_pixels(input_array, threshold=255, lower_threshold=True, invert_y
     """
     Find coordinates of all pixels within the image that are > or <
     the threshold ( require < threshold if lower_threshold==True)
+    Returns an (N,2) array of [x,y] coordinates.
     NOTE - if invert_y is set, we make the second coordinate negative, for reasons.
     """
-    y_sign = -1 if invert_y else 1
-    # find all the "white" pixels
-    signal_x_y = np.where(input_array>=threshold)
-
-    # convert ([x1, x2, ...], [y1,y2,...]) to ([x1,y1],...)
-    signal_coords = [(signal_x_y[0][i], y_sign*signal_x_y[1][i]) \
-                    for i in range(len(signal_x_y[0]))]
+    # find all the "white" pixels, as an array [[x1,y1],[x2,y2],...]
+    signal_coords = np.argwhere(input_array>=threshold)
+    if invert_y:
+        signal_coords = invert_y_coord(signal_coords)
     return signal_coords
 
 
@@ -133,7 +186,7 @@ def invert_y_coord(coord_list):
     """
     Convert [(x1,y1),(x2,y2),...] to [(x1,-y1),(x2,-y2),...]
     """
-    return [(x,-1*y) for (x,y) in coord_list]
+    return np.asarray(coord_list).reshape(-1, 2) * np.array([1, -1])
 
 
 def calc_distance_matrix(signal_coords):
@@ -182,53 +235,295 @@ def feature_vector_metrics(feature_vector,output_csv=None):
     return feature_vec_metrics
 
 
+def feature_vector_metrics_batch(feature_vectors):
+    """
+    Vectorised version of feature_vector_metrics, for an array of
+    feature vectors with shape (n_vectors, vector_length).
+    Returns a structured array with one field per metric.
+    """
+    feature_vectors = np.asarray(feature_vectors, dtype=np.float64)
+    if feature_vectors.ndim != 2 or feature_vectors.shape[1] == 0:
+        raise RuntimeError("Expected a 2D array of non-empty feature vectors")
+    vector_length = feature_vectors.shape[1]
+    metrics = np.zeros(len(feature_vectors),
+                       dtype=[(name, np.float64) for name in FEATURE_VECTOR_METRICS])
+    metrics["offset"] = feature_vectors[:, -1] - feature_vectors[:, 0]
+    metrics["slope"] = metrics["offset"] / vector_length
+    metrics["offset50"] = feature_vectors[:, -1] - feature_vectors[:, vector_length//2]
+    metrics["mean"] = feature_vectors.mean(axis=1)
+    metrics["std"] = feature_vectors.std(axis=1)
+    return metrics
+
 
 def calc_adjacency_matrix(distance_matrix,
-                          include_diagonal_neighbours=False):
+                          include_diagonal_neighbours=False,
+                          dtype=np.float64):
     """
     Return a symmetric matrix of
     (n-pixels-over-threshold)x(n-pixel-over-threshold)
     where each element ij is 0 or 1 depending on whether the distance between
     pixel i and pixel j is < or > neighbour_threshold.
+    Use dtype=np.bool_ for a matrix 8 times smaller than the float64 default.
     """
 
-    # prepare empty array
-    adj_matrix = np.zeros(distance_matrix.shape)
-    # get 2xM array where M is the number of elements of
-    # the distance matrix that satisfy the "neighbour threshold" criterion.
-    # i.e. the x,y coordinates of all "neighbours" in the distance matrix.
+    # boolean mask of the elements of the distance matrix that satisfy
+    # the "neighbour threshold" criterion.
     if not include_diagonal_neighbours:
-        neighbour_x_y = np.where(distance_matrix==1)
+        neighbours = (distance_matrix==1)
     else:
-        neighbour_x_y = np.where((distance_matrix>0) & (distance_matrix < 2))
+        neighbours = (distance_matrix>0) & (distance_matrix < 2)
 
+    adj_matrix = neighbours.astype(dtype, copy=False)
+    return adj_matrix
 
-    # loop over coordinates of neighbours in distance matrix
-    for i in range(len(neighbour_x_y[0])):
-        adj_matrix[neighbour_x_y[0][i]][neighbour_x_y[1][i]] = 1
 
+def calc_sparse_adjacency_matrix(signal_coords,
+                                 include_diagonal_neighbours=False,
+                                 dtype=np.float64):
+    """
+    Return the same symmetric 0/1 adjacency matrix as calc_adjacency_matrix,
+    but as a scipy.sparse CSR matrix, built directly from the pixel
+    coordinates without calculating the NxN distance matrix.
+    Signal pixels lie on a regular grid, so neighbours are found by
+    shifting the coordinates by one pixel in each direction and
+    looking up which shifted positions are also signal pixels.
+    """
+    coords = np.asarray(signal_coords, dtype=int).reshape(-1, 2)
+    n = len(coords)
+    if n == 0:
+        return sparse.csr_matrix((0, 0), dtype=dtype)
+    # put the coordinates onto a grid starting at (0,0) - they might be
+    # negative if get_signal_pixels was called with invert_y.
+    coords = coords - coords.min(axis=0)
+    grid_shape = tuple(coords.max(axis=0) + 1)
+    # grid holding the index of each signal pixel, or -1 for background
+    index_grid = np.full(grid_shape, -1, dtype=np.int64)
+    index_grid[coords[:, 0], coords[:, 1]] = np.arange(n)
+
+    # only need "forward" offsets - the matrix is symmetrised below
+    rows = []
+    cols = []
+    for offset in NEIGHBOUR_OFFSETS[bool(include_diagonal_neighbours)]:
+        shifted = coords + offset
+        in_grid = (shifted[:, 0] >= 0) & (shifted[:, 0] < grid_shape[0]) & \
+                  (shifted[:, 1] >= 0) & (shifted[:, 1] < grid_shape[1])
+        pix = np.where(in_grid)[0]
+        neighbours = index_grid[shifted[pix, 0], shifted[pix, 1]]
+        is_signal = neighbours >= 0
+        rows.append(pix[is_signal])
+        cols.append(neighbours[is_signal])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    data = np.ones(2*len(rows), dtype=dtype)
+    adj_matrix = sparse.csr_matrix((data,
+                                    (np.concatenate([rows, cols]),
+                                     np.concatenate([cols, rows]))),
+                                   shape=(n, n), dtype=dtype)
     return adj_matrix
 
 
-def calc_and_sort_sc_indices(adjacency_matrix):
+def calc_sc_values_dense(adjacency_matrix, dtype=np.float64):
     """
-    Given an input adjacency matrix, calculate eigenvalues and eigenvectors,
-    calculate the subgraph centrality (ref: <== ADD REF), then sort.
+    Calculate the subgraph centrality of every pixel exactly, from the
+    eigenvalues and eigenvectors of the (dense) adjacency matrix.
+    The eigen-solve is done in dtype (np.float32 halves the memory).
+    The input matrix is never modified.
     """
+    if sparse.issparse(adjacency_matrix):
+        adjacency_matrix = adjacency_matrix.toarray()
+    adjacency_matrix = np.asarray(adjacency_matrix, dtype=dtype)
 
     # get eigenvalues
     am_lambda, am_phi = np.linalg.eigh(adjacency_matrix)
 
     # calculate the subgraph centrality (SC)
     phi2_explambda = np.dot(am_phi * am_phi, np.exp(am_lambda))
+    return phi2_explambda
+
+
+@lru_cache(maxsize=None)
+def calc_path_sc_values(n):
+    """
+    Closed-form subgraph centrality of the n nodes, in order, of a path
+    graph (which includes isolated pixels and pairs).  The eigenvalues are
+    2cos(k.pi/(n+1)), with eigenvectors sqrt(2/(n+1)) sin(j.k.pi/(n+1)).
+    The result is cached, so treat it as read-only.
+    """
+    k = np.arange(1, n+1)
+    am_lambda = 2 * np.cos(k * np.pi / (n+1))
+    am_phi = np.sqrt(2 / (n+1)) * np.sin(np.outer(k, k) * np.pi / (n+1))
+    sc_values = np.dot(am_phi * am_phi, np.exp(am_lambda))
+    sc_values.flags.writeable = False
+    return sc_values
+
+
+def order_path_nodes(adj_matrix, nodes):
+    """
+    Given a CSR adjacency matrix and the nodes of a connected component
+    that is a path, return the nodes in order from one end to the other.
+    """
+    if len(nodes) <= 2:
+        return nodes
+    degrees = np.diff(adj_matrix.indptr)[nodes]
+    previous = -1
+    current = nodes[degrees == 1][0]
+    ordered_nodes = [current]
+    for _ in range(len(nodes)-1):
+        neighbours = adj_matrix.indices[adj_matrix.indptr[current]:
+                                        adj_matrix.indptr[current+1]]
+        next_node = neighbours[neighbours != previous][0]
+        previous, current = current, next_node
+        ordered_nodes.append(current)
+    return np.array(ordered_nodes)
+
+
+def calc_sc_values_eigh(adjacency_matrix, per_component=True, dtype=np.float64):
+    """
+    Calculate the subgraph centrality of every pixel exactly.
+    The adjacency matrix is block-diagonal in the connected components
+    of the image, so (if per_component is True) we diagonalise each
+    component separately, and use the cached closed-form values for
+    components that are paths (isolated pixels, pairs, lines).
+    dtype is passed on to calc_sc_values_dense.
+    """
+    if not per_component:
+        return calc_sc_values_dense(adjacency_matrix, dtype)
+
+    adj_matrix = sparse.csr_matrix(adjacency_matrix)
+    n = adj_matrix.shape[0]
+    sc_values = np.zeros(n)
+    if n == 0:
+        return sc_values
+    n_components, labels = connected_components(adj_matrix, directed=False)
+    degrees = np.diff(adj_matrix.indptr)
+
+    # group the node indices by component label
+    sorted_nodes = np.argsort(labels, kind="stable")
+    boundaries = np.cumsum(np.bincount(labels, minlength=n_components))[:-1]
+    for nodes in np.split(sorted_nodes, boundaries):
+        n_nodes = len(nodes)
+        n_edges = degrees[nodes].sum() // 2
+        if n_edges == n_nodes - 1 and degrees[nodes].max() <= 2:
+            # a path - use the closed-form values
+            sc_values[order_path_nodes(adj_matrix, nodes)] = \
+                calc_path_sc_values(n_nodes)
+        else:
+            sub_matrix = adj_matrix[nodes][:, nodes]
+            sc_values[nodes] = calc_sc_values_dense(sub_matrix, dtype)
+    return sc_values
+
+
+def get_probing_distance(max_degree, tolerance):
+    """
+    Find the smallest lattice distance p such that the summed contribution
+    of all pixels at least p steps away to an element of diag(exp(A)),
+    which is bounded by sum_{k>=p} max_degree^k / k!, is below tolerance.
+    """
+    if max_degree == 0:
+        return 1
+    # start from the full series and subtract terms until the tail is small
+    tail = math.exp(max_degree)
+    term = 1.
+    p = 0
+    while tail > tolerance:
+        tail -= term
+        p += 1
+        term *= max_degree / p
+    return max(p, 1)
+
+
+def calc_sc_values_probing(adjacency_matrix, signal_coords, tolerance=1e-3):
+    """
+    Estimate the subgraph centrality, diag(exp(A)), without diagonalising A.
+
+    Pixels are coloured by (x mod p, y mod p), so two pixels with the same
+    colour are at least p steps apart on the lattice.  For each colour we
+    take the indicator vector v, and compute exp(A)v with
+    scipy.sparse.linalg.expm_multiply.  Element i of that (for pixel i of
+    that colour) is the SC of pixel i plus contributions from pixels at
+    least p steps away.  All elements of exp(A) are non-negative, and
+    p is chosen so that these contributions sum to less than
+    tolerance, which (since every SC value is >= 1) is then an upper
+    bound on the relative error of each SC value.
+    """
+    adj_matrix = sparse.csr_matrix(adjacency_matrix, dtype=np.float64)
+    n = adj_matrix.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    coords = np.asarray(signal_coords, dtype=int).reshape(-1, 2)
+    coords = coords - coords.min(axis=0)
+
+    max_degree = int(adj_matrix.getnnz(axis=1).max())
+    p = get_probing_distance(max_degree, tolerance)
+    colours = (coords[:, 0] % p) * p + (coords[:, 1] % p)
+    # only need probe vectors for colours that are actually used
+    used_colours, colour_index = np.unique(colours, return_inverse=True)
+    probes = sparse.csr_matrix((np.ones(n), (np.arange(n), colour_index)),
+                               shape=(n, len(used_colours))).toarray()
+    exp_a_probes = expm_multiply(adj_matrix, probes)
+    sc_values = exp_a_probes[np.arange(n), colour_index]
+    return sc_values
+
+
+def calc_and_sort_sc_indices(adjacency_matrix,
+                             method="eigh",
+                             signal_coords=None,
+                             tolerance=1e-3,
+                             dtype=np.float64):
+    """
+    Given an input adjacency matrix, calculate the subgraph centrality
+    (Estrada et.al. - see top of file) of each pixel, then sort.
+
+    method can be "eigh" (exact, from eigenvalues and eigenvectors) or
+    "expm_multiply" (approximate, to within a relative error of tolerance,
+    which needs the signal_coords - see calc_sc_values_probing).
+    dtype sets the precision of the "eigh" eigen-solves.
+    """
+    if method == "eigh":
+        sc_values = calc_sc_values_eigh(adjacency_matrix, dtype=dtype)
+    elif method == "expm_multiply":
+        if signal_coords is None:
+            raise RuntimeError("Need signal_coords to use method 'expm_multiply'")
+        sc_values = calc_sc_values_probing(adjacency_matrix,
+                                           signal_coords,
+                                           tolerance)
+    else:
+        raise RuntimeError("Unknown subgraph centrality method {}".format(method))
 
     # order the pixels by subgraph centrality, then find their indices
     # (corresponding to their position in the 1D list of white pixels)
-    indices= np.argsort(phi2_explambda)[::-1]
-    return indices
+    return sort_sc_indices(sc_values, 2 * np.finfo(dtype).precision // 3)
+
+
+def sort_sc_indices(sc_values, rel_decimals=10):
+    """
+    Return the pixel indices in order of decreasing subgraph centrality.
+    Many pixels (e.g. all the isolated ones) have exactly the same SC, but
+    different ways of calculating it give them values differing by rounding
+    errors, so SC values are compared to rel_decimals significant figures,
+    and ties are broken by pixel index, lowest first.
+    """
+    sc_values = np.asarray(sc_values, dtype=np.float64)
+    if len(sc_values) == 0:
+        return np.zeros(0, dtype=int)
+    # SC values are all >= 1, so this is the power of 10 of each one
+    magnitudes = 10.**np.floor(np.log10(np.abs(sc_values)))
+    rounded_sc_values = np.round(sc_values / magnitudes, rel_decimals) * magnitudes
+    return np.lexsort((np.arange(len(sc_values)), -rounded_sc_values))
 
 
 
+def get_quantile_percentages(num_quantiles=20):
+    """
+    Return the list of percentages [0, step, 2*step, ..., 100]
+    marking the boundaries of the SC quantiles.
+    """
+    start = 0
+    end = 100
+    step = (end-start)/num_quantiles
+    return [i for i in range(start,end+1,int(step))]
+
+
 def fill_feature_vector(pix_indices, coords, adj_matrix, num_quantiles=20):
     """
     Given indices and coordinates of signal pixels ordered by SC value, put them into
@@ -237,42 +532,34 @@ def fill_feature_vector(pix_indices, coords, adj_matrix, num_quantiles=20):
 
     Will return:
         selected_pixels, feature_vector
-    where selected_pixels is a vector of the pixel coordinates in each quantile,
+    where selected_pixels is a dict of the (N,2) arrays of pixel coordinates in
+    each quantile (views into one array of coordinates ordered by SC value),
     and a feature_vector is either num-connected-components or Euler characteristic,
     for each quantile.
     """
     # adj_matrix will be square - take the length of a side
     n = max(adj_matrix.shape)
 
-    graph = make_graph(adj_matrix)
-    # set the diagonals of the adjacency matrix to 1 (previously
-    # zero by definition because a pixel can't be adjacent to itself)
-    for j in range(n):
-        adj_matrix[j][j] = 1
-
-
     # find the different quantiles
-    start = 0
-    end = 100
-    step = (end-start)/num_quantiles
-    x = [i for i in range(start,end+1,int(step))]
+    x = get_quantile_percentages(num_quantiles)
     # create feature vector of size num_quantiles
     feature_vector = np.zeros(num_quantiles)
     # create a dictionary of selected pixels for each quantile.
     selected_pixels = {}
-    # Loop through the quantiles to fill the feature vector
+    # how many pixels in each sub-region?
+    n_pix_values = [round(x[i] * n / 100) for i in range(1,len(feature_vector))]
+    # calculate the Euler characteristic for all the quantiles in one go
+    feature_vector[1:] = calc_euler_characteristics(pix_indices,
+                                                    adj_matrix,
+                                                    n_pix_values)
+    # the pixels in each quantile are the first n_pix of the coordinates
+    # sorted by SC value, so just store slices of that.
+    sorted_coords = np.asarray(coords).reshape(-1, 2)[pix_indices]
     for i in range(1,len(feature_vector)):
-        #print("calculating subregion {} of {}".format(i, num_quantiles))
-        # how many pixels in this sub-region?
-        n_pix = round(x[i] * n / 100)
-        sub_region = pix_indices[0:n_pix]
-        sel_pix = [coords[j] for j in sub_region]
-        selected_pixels[x[i]] = sel_pix
-        # now calculate the feature vector element using the selected method
-        feature_vector[i] = calc_euler_characteristic(sub_region, graph)
+        selected_pixels[x[i]] = sorted_coords[0:n_pix_values[i-1]]
 
     # fill in the last quantile (100%) of selected pixels
-    selected_pixels[100] = coords
+    selected_pixels[100] = sorted_coords
 
     return feature_vector, selected_pixels
 
@@ -282,12 +569,27 @@ def subgraph_centrality(image,
                         num_quantiles=20,
                         threshold=255, # what counts as a signal pixel?
                         lower_threshold=True,
-                        output_csv=None):
+                        output_csv=None,
+                        use_sparse_adjacency=True,
+                        sc_method="eigh",
+                        sc_tolerance=1e-3,
+                        precision="float64"):
     """
     Go through the whole calculation, from input image to output vector of
     pixels in each SC quantile, and feature vector (either connected-components
     or Euler characteristic).
-    """
+    If use_sparse_adjacency is True, the adjacency matrix is built directly
+    from the pixel grid as a sparse matrix, otherwise via the full
+    distance matrix (the original, slower, method).
+    sc_method and sc_tolerance select how the subgraph centrality is
+    calculated - see calc_and_sort_sc_indices.
+    precision can be "float64", or "float32" to use less memory: boolean
+    dense adjacency matrix, float32 sparse adjacency matrix and eigen-solves.
+    """
+    if precision not in PRECISION_DTYPES:
+        raise RuntimeError("Unknown precision {} - must be one of {}"\
+                           .format(precision, list(PRECISION_DTYPES.keys())))
+    dense_dtype, sparse_dtype, eigh_dtype = PRECISION_DTYPES[precision]
 
     feature_vec = [0 for i in range(0,num_quantiles)] # need the "+1" to include 100% quantile
     sel_pixels = {}
@@ -297,14 +599,25 @@ def subgraph_centrality(image,
 
         # get the coordinates of all the signal pixels
         signal_coords = get_signal_pixels(image, threshold, lower_threshold)
-        # get the distance matrix
-        dist_vec, dist_matrix = calc_distance_matrix(signal_coords)
-
-        # will use to fill our feature vector
-        adj_matrix = calc_adjacency_matrix(dist_matrix,
-                                       use_diagonal_neighbours)
+        if use_sparse_adjacency:
+            adj_matrix = calc_sparse_adjacency_matrix(signal_coords,
+                                                      use_diagonal_neighbours,
+                                                      sparse_dtype)
+        else:
+            # get the distance matrix
+            dist_vec, dist_matrix = calc_distance_matrix(signal_coords)
+
+            # will use to fill our feature vector
+            adj_matrix = calc_adjacency_matrix(dist_matrix,
+                                               use_diagonal_neighbours,
+                                               dense_dtype)
+            del dist_vec, dist_matrix
         # calculate the subgraph centrality and order our signal pixels accordingly
-        sorted_pix_indices = calc_and_sort_sc_indices(adj_matrix)
+        sorted_pix_indices = calc_and_sort_sc_indices(adj_matrix,
+                                                      sc_method,
+                                                      signal_coords,
+                                                      sc_tolerance,
+                                                      eigh_dtype)
         # calculate the feature vector and get the subsets of pixels in each quantile
         feature_vec, sel_pixels = fill_feature_vector(sorted_pix_indices,
                                                   signal_coords,
@@ -315,3 +628,68 @@ def subgraph_centrality(image,
         write_csv(feature_vec, output_csv)
 
     return feature_vec, sel_pixels
+
+
+def subgraph_centrality_batch(tiles,
+                              use_diagonal_neighbours=False,
+                              num_quantiles=20,
+                              threshold=255,
+                              sc_method="eigh",
+                              sc_tolerance=1e-3,
+                              precision="float64"):
+    """
+    Run the subgraph centrality calculation on a stack of sub-images
+    ("tiles") at once.  Equivalent to calling subgraph_centrality and
+    feature_vector_metrics on each tile, but without building the
+    selected-pixel lists, and sharing the thresholding, quantile
+    boundaries and metric calculations across all tiles.
+
+    Parameters
+    ==========
+    tiles: np.ndarray with shape (n_tiles, height, width)
+    other parameters as for subgraph_centrality.
+
+    Returns
+    =======
+    feature_vectors: np.ndarray with shape (n_tiles, num_quantiles)
+    metrics: structured np.ndarray with shape (n_tiles,) and fields
+             slope, offset, offset50, mean, std.
+    """
+    if precision not in PRECISION_DTYPES:
+        raise RuntimeError("Unknown precision {} - must be one of {}"\
+                           .format(precision, list(PRECISION_DTYPES.keys())))
+    _, sparse_dtype, eigh_dtype = PRECISION_DTYPES[precision]
+    tiles = np.asarray(tiles)
+    if tiles.ndim != 3:
+        raise RuntimeError("Expected a 3D array of tiles, got shape {}"\
+                           .format(tiles.shape))
+    n_tiles = tiles.shape[0]
+    feature_vectors = np.zeros((n_tiles, num_quantiles))
+
+    # find the signal pixels of all the tiles in one go - np.nonzero
+    # returns them ordered by tile, then in the same order as get_signal_pixels.
+    tile_index, pix_x, pix_y = np.nonzero(tiles >= threshold)
+    all_coords = np.stack([pix_x, pix_y], axis=1)
+    n_signal_pix = np.bincount(tile_index, minlength=n_tiles)
+    tile_coords = np.split(all_coords, np.cumsum(n_signal_pix)[:-1])
+
+    quantile_percentages = np.array(get_quantile_percentages(num_quantiles)[1:num_quantiles])
+    for i, signal_coords in enumerate(tile_coords):
+        n = len(signal_coords)
+        if n == 0:
+            continue
+        adj_matrix = calc_sparse_adjacency_matrix(signal_coords,
+                                                  use_diagonal_neighbours,
+                                                  sparse_dtype)
+        sorted_pix_indices = calc_and_sort_sc_indices(adj_matrix,
+                                                      sc_method,
+                                                      signal_coords,
+                                                      sc_tolerance,
+                                                      eigh_dtype)
+        # same rounding as fill_feature_vector (round half to even)
+        n_pix_values = np.round(quantile_percentages * n / 100).astype(np.int64)
+        feature_vectors[i, 1:] = calc_euler_characteristics(sorted_pix_indices,
+                                                            adj_matrix,
+                                                            n_pix_values)
+    metrics = feature_vector_metrics_batch(feature_vectors)
+    return feature_vectors, metrics
@@ -0,0 +1,256 @@
+"""
+Read windows (e.g. blocks of rows) of single-band GeoTIFF files, as
+downloaded from GEE, without loading the whole raster into memory.
+
+Uncompressed and deflate-compressed strips or tiles are read directly
+from a memory-map of the file, so only the strips/tiles overlapping the
+requested window are read and decoded.  For anything else (e.g. LZW
+compression, BigTIFF or multi-band files) we fall back to reading the
+whole image with openCV, so the results are always the same as
+cv.imread(filename, cv.IMREAD_ANYDEPTH), just not memory-bounded.
+"""
+
+import zlib
+import struct
+
+import numpy as np
+import cv2 as cv
+
+
+# number of rows to read at a time when streaming through an image
+DEFAULT_BLOCK_ROWS = 256
+
+# TIFF tag numbers that we need
+TAGS = {
+    256: "width",
+    257: "height",
+    258: "bits_per_sample",
+    259: "compression",
+    273: "strip_offsets",
+    277: "samples_per_pixel",
+    278: "rows_per_strip",
+    279: "strip_byte_counts",
+    284: "planar_config",
+    317: "predictor",
+    322: "tile_width",
+    323: "tile_length",
+    324: "tile_offsets",
+    325: "tile_byte_counts",
+    339: "sample_format"
+}
+
+# TIFF field types: (struct format character, size in bytes)
+FIELD_TYPES = {
+    1: ("B", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+    6: ("b", 1),
+    8: ("h", 2),
+    9: ("i", 4),
+    16: ("Q", 8)
+}
+
+# TIFF SampleFormat values to numpy dtype kinds
+SAMPLE_FORMATS = {1: "u", 2: "i", 3: "f"}
+
+# compression schemes we can read directly: none, and two codes for deflate
+UNCOMPRESSED = 1
+DEFLATE = (8, 32946)
+
+
+def read_ifd(data, byte_order):
+    """
+    Read the tags we need from the first image file directory (IFD)
+    of a TIFF file.
+
+    Parameters
+    ==========
+    data: numpy memmap (uint8) of the whole file
+    byte_order: str, "<" or ">"
+
+    Returns
+    =======
+    tags: dict, keyed by the names in TAGS, values are lists of ints.
+    """
+    ifd_offset = struct.unpack(byte_order+"I", data[4:8].tobytes())[0]
+    n_entries = struct.unpack(byte_order+"H",
+                              data[ifd_offset:ifd_offset+2].tobytes())[0]
+    tags = {}
+    for i in range(n_entries):
+        entry_start = ifd_offset + 2 + 12*i
+        tag, field_type, count = struct.unpack(
+            byte_order+"HHI", data[entry_start:entry_start+8].tobytes())
+        if tag not in TAGS or field_type not in FIELD_TYPES:
+            continue
+        fmt, size = FIELD_TYPES[field_type]
+        # values are stored in the entry itself if they fit in 4 bytes
+        if count * size <= 4:
+            value_start = entry_start + 8
+        else:
+            value_start = struct.unpack(byte_order+"I",
+                                        data[entry_start+8:entry_start+12].tobytes())[0]
+        value_bytes = data[value_start:value_start+count*size].tobytes()
+        tags[TAGS[tag]] = list(struct.unpack(byte_order+fmt*count, value_bytes))
+    return tags
+
+
+class WindowedTifReader(object):
+    """
+    Read windows of a single-band TIFF file.  Pixel values are the same
+    as from cv.imread(filename, cv.IMREAD_ANYDEPTH), i.e. an array of
+    shape (height, width).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.full_image = None
+        self.data = np.memmap(filename, dtype=np.uint8, mode="r")
+        self.tags = self.parse_header()
+        if self.tags is None:
+            # can't read windows of this file - read the whole thing instead
+            self.full_image = cv.imread(filename, cv.IMREAD_ANYDEPTH)
+            if self.full_image is None:
+                raise RuntimeError("Unable to read tif file {}".format(filename))
+            self.shape = self.full_image.shape
+            self.dtype = self.full_image.dtype
+            self.data = None
+
+
+    def parse_header(self):
+        """
+        Read the TIFF header and first IFD, and set the image shape and
+        dtype.  Return the tags if we can read windows from the file
+        directly, or None if we need to fall back to openCV.
+        """
+        byte_order = {b"II": "<", b"MM": ">"}.get(self.data[:2].tobytes())
+        if byte_order is None or len(self.data) < 8:
+            return None
+        # 42 is a classic TIFF, 43 would be BigTIFF
+        if struct.unpack(byte_order+"H", self.data[2:4].tobytes())[0] != 42:
+            return None
+        tags = read_ifd(self.data, byte_order)
+        if tags.get("samples_per_pixel", [1])[0] != 1 or \
+           tags.get("compression", [UNCOMPRESSED])[0] not in (UNCOMPRESSED,) + DEFLATE or \
+           tags.get("predictor", [1])[0] != 1:
+            return None
+        bits = tags.get("bits_per_sample", [1])[0]
+        kind = SAMPLE_FORMATS.get(tags.get("sample_format", [1])[0])
+        if not kind or bits % 8 != 0:
+            return None
+        self.shape = (tags["height"][0], tags["width"][0])
+        self.dtype = np.dtype(byte_order + kind + str(bits // 8))
+        self.is_tiled = "tile_offsets" in tags
+        if self.is_tiled:
+            self.block_shape = (tags["tile_length"][0], tags["tile_width"][0])
+            self.offsets = tags["tile_offsets"]
+            self.byte_counts = tags["tile_byte_counts"]
+        elif "strip_offsets" in tags:
+            rows_per_strip = min(tags.get("rows_per_strip", [self.shape[0]])[0],
+                                 self.shape[0])
+            self.block_shape = (rows_per_strip, self.shape[1])
+            self.offsets = tags["strip_offsets"]
+            self.byte_counts = tags["strip_byte_counts"]
+        else:
+            return None
+        self.compression = tags.get("compression", [UNCOMPRESSED])[0]
+        return tags
+
+
+    def read_block(self, index, n_rows):
+        """
+        Return strip or tile number index as a 2D array with n_rows rows
+        (the last strip in an image can be shorter than the others).
+        """
+        start = self.offsets[index]
+        block_bytes = self.data[start:start+self.byte_counts[index]]
+        if self.compression in DEFLATE:
+            block_bytes = np.frombuffer(zlib.decompress(block_bytes.tobytes()),
+                                        dtype=np.uint8)
+        n_values = n_rows * self.block_shape[1]
+        return block_bytes[:n_values*self.dtype.itemsize].view(self.dtype)\
+                          .reshape(n_rows, self.block_shape[1])
+
+
+    def read_window(self, row_start, row_stop, col_start=0, col_stop=None):
+        """
+        Read pixels [row_start:row_stop, col_start:col_stop] of the image.
+
+        Returns
+        =======
+        window: 2D numpy array in native byte order.
+        """
+        height, width = self.shape
+        row_stop = min(row_stop, height)
+        col_stop = width if col_stop is None else min(col_stop, width)
+        if self.full_image is not None:
+            return self.full_image[row_start:row_stop, col_start:col_stop].copy()
+
+        window = np.empty((max(0, row_stop-row_start), max(0, col_stop-col_start)),
+                          dtype=self.dtype.newbyteorder("="))
+        block_rows, block_cols = self.block_shape
+        blocks_across = -(-width // block_cols)
+        for block_row in range(row_start // block_rows,
+                               -(-row_stop // block_rows)):
+            block_row_start = block_row * block_rows
+            for block_col in range(col_start // block_cols,
+                                   -(-col_stop // block_cols)):
+                block_col_start = block_col * block_cols
+                # strips are cut short at the bottom of the image, tiles aren't
+                n_rows = block_rows if self.is_tiled \
+                         else min(block_rows, height - block_row_start)
+                block = self.read_block(block_row*blocks_across + block_col, n_rows)
+                r0 = max(row_start, block_row_start)
+                r1 = min(row_stop, block_row_start + n_rows)
+                c0 = max(col_start, block_col_start)
+                c1 = min(col_stop, block_col_start + block_cols)
+                window[r0-row_start:r1-row_start, c0-col_start:c1-col_start] = \
+                    block[r0-block_row_start:r1-block_row_start,
+                          c0-block_col_start:c1-block_col_start]
+        return window
+
+
+    def iter_row_blocks(self, block_rows=DEFAULT_BLOCK_ROWS):
+        """
+        Generator yielding (row_start, window) for blocks of block_rows
+        full-width rows, from the top to the bottom of the image.
+        """
+        for row_start in range(0, self.shape[0], block_rows):
+            yield row_start, self.read_window(row_start, row_start+block_rows)
+
+
+    def read(self):
+        """
+        Read the whole image.
+        """
+        return self.read_window(0, self.shape[0])
+
+
+    def close(self):
+        self.data = None
+        self.full_image = None
+
+
+def read_tif_window(filename, row_start, row_stop, col_start=0, col_stop=None):
+    """
+    Read pixels [row_start:row_stop, col_start:col_stop] of a single-band
+    tif file, without reading the rest of the image if possible.
+    """
+    reader = WindowedTifReader(filename)
+    window = reader.read_window(row_start, row_stop, col_start, col_stop)
+    reader.close()
+    return window
+
+
+def calc_tif_mean(filename, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Calculate the mean of all the pixel values in a single-band tif file,
+    reading block_rows rows at a time.
+    """
+    reader = WindowedTifReader(filename)
+    total = 0.
+    n_pix = 0
+    for _, block in reader.iter_row_blocks(block_rows):
+        total += block.sum(dtype=np.float64)
+        n_pix += block.size
+    reader.close()
+    return float(total / n_pix)
@@ -0,0 +1,147 @@
+"""
+Store all the sub-images (tiles) of one type for one date in a single
+array file, rather than hundreds of small png files.
+
+Each tile store is a pair of files:
+<filename_base>.npy : numpy array of shape (n_tiles, ny_pix, nx_pix[, c]),
+                      uncompressed so that it can be memory-mapped.
+<filename_base>.json : "sidecar" describing the tile grid, and the
+                       position and coordinates of every tile.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from .image_utils import iter_tiles
+
+
+def make_tile_stack(image_array, n_pix, region_size=None, coords=None):
+    """
+    Divide an image array into n_pix x n_pix tiles, and copy them
+    into one contiguous array, in the same order as iter_tiles.
+
+    Parameters
+    ==========
+    image_array: numpy array of shape (y, x[, c])
+    n_pix: int, size of the square tiles in pixels
+    region_size: float, size of the image in degrees long,lat
+    coords: list of floats, [long,lat] of the centre of the image
+
+    Returns
+    =======
+    tile_stack: numpy array of shape (n_tiles, n_pix, n_pix[, c])
+    tile_info: list of dicts {"ix": <int>, "iy": <int>, "coords": [long,lat]}
+    """
+    tiles = []
+    tile_info = []
+    for ix, iy, tile, tile_coords in iter_tiles(image_array, n_pix,
+                                                region_size=region_size,
+                                                coords=coords):
+        tiles.append(tile)
+        tile_info.append({"ix": ix,
+                          "iy": iy,
+                          "coords": list(tile_coords) if tile_coords else None})
+    if len(tiles) == 0:
+        tile_stack = np.empty((0, n_pix, n_pix) + image_array.shape[2:],
+                              dtype=image_array.dtype)
+    else:
+        tile_stack = np.stack(tiles)
+    return tile_stack, tile_info
+
+
+def save_tile_store(tile_stack, tile_info, output_dir, filename_base,
+                    metadata={}):
+    """
+    Write a stack of tiles to <output_dir>/<filename_base>.npy, along with
+    a json sidecar file.
+
+    Parameters
+    ==========
+    tile_stack: numpy array of shape (n_tiles, ny_pix, nx_pix[, c])
+    tile_info: list of dicts, one per tile, as from make_tile_stack
+    output_dir: str, directory to write to
+    filename_base: str, filename without extension
+    metadata: dict, any extra information (e.g. date, image_type) to put
+              in the sidecar.
+
+    Returns
+    =======
+    npy_path: str, full path to the .npy file
+    """
+    if len(tile_info) != len(tile_stack):
+        raise RuntimeError("Have {} tiles but information for {} tiles"\
+                           .format(len(tile_stack), len(tile_info)))
+    os.makedirs(output_dir, exist_ok=True)
+    npy_path = os.path.join(output_dir, filename_base+".npy")
+    np.save(npy_path, np.ascontiguousarray(tile_stack))
+    sidecar = dict(metadata)
+    sidecar["tile_shape"] = list(tile_stack.shape[1:])
+    sidecar["dtype"] = str(tile_stack.dtype)
+    sidecar["tiles"] = tile_info
+    with open(os.path.join(output_dir, filename_base+".json"), "w") as outfile:
+        json.dump(sidecar, outfile)
+    return npy_path
+
+
+class TileStore(object):
+    """
+    Read-only access to the tiles in a tile store, by index.
+    The array is memory-mapped, so only the tiles that are used
+    are read from disk.
+    """
+
+    def __init__(self, npy_path, json_path=None):
+        if not json_path:
+            json_path = os.path.splitext(npy_path)[0] + ".json"
+        self.npy_path = npy_path
+        with open(json_path) as infile:
+            self.metadata = json.load(infile)
+        self.tiles = np.load(npy_path, mmap_mode="r")
+        if len(self.tiles) != len(self.metadata["tiles"]):
+            raise RuntimeError("{} has {} tiles but sidecar describes {}"\
+                               .format(npy_path, len(self.tiles),
+                                       len(self.metadata["tiles"])))
+
+
+    def __len__(self):
+        return len(self.tiles)
+
+
+    def __getitem__(self, index):
+        # plain ndarray view of the memory-mapped data
+        return np.asarray(self.tiles[index])
+
+
+    def get_coords(self, index):
+        """
+        Return the [long,lat] coordinates of the tile.
+        """
+        return self.metadata["tiles"][index]["coords"]
+
+
+    def get_coords_string(self, index):
+        """
+        Return the coordinates of the tile formatted as in the sub-image
+        png filenames, i.e. 'long_lat' with 3 decimal places.
+        """
+        coords = self.get_coords(index)
+        return "{0:.3f}_{1:.3f}".format(coords[0], coords[1])
+
+
+# keep tile stores open for each process, so that e.g. multiprocessing
+# workers only open the file once per date.
+_open_stores = {}
+
+
+def get_tile_store(npy_path, json_path=None):
+    """
+    Return the TileStore for this file, opening it if this process
+    doesn't already have it open.
+    """
+    # include the modification time, in case the file has been rewritten
+    key = (npy_path, os.path.getmtime(npy_path))
+    if key not in _open_stores:
+        _open_stores[key] = TileStore(npy_path, json_path)
+    return _open_stores[key]
@@ -0,0 +1,105 @@
+"""
+Test running pipelines for several locations with batch_runner.py
+"""
+
+import os
+import json
+import time
+import threading
+import pytest
+
+from pyveg.src.batch_runner import *
+from pyveg.src.pyveg_pipeline import Pipeline, Sequence, BaseModule
+
+
+def test_read_sites_from_ids():
+    sites = read_sites(["00", "03"])
+    assert sites == [("00", (27.94, 11.58)), ("03", (2.59, 13.12))]
+    assert len(read_sites()) > 2
+    with pytest.raises(RuntimeError):
+        read_sites(["nonexistent"])
+
+
+def test_read_sites_from_csv(tmp_path):
+    csv_path = os.path.join(tmp_path, "sites.csv")
+    with open(csv_path, "w") as outfile:
+        outfile.write("id,latitude,longitude\n007,11.5,27.5\n008,12.5,28.5\n")
+    assert read_sites(coordinates_csv=csv_path) == [("007", (27.5, 11.5)),
+                                                    ("008", (28.5, 12.5))]
+    with open(csv_path, "w") as outfile:
+        outfile.write("latitude,longitude\n11.5,27.5\n")
+    assert read_sites(coordinates_csv=csv_path) == [("00", (27.5, 11.5))]
+
+
+class DownloadLikeModule(BaseModule):
+    """
+    Module that keeps track of how many instances are processing a
+    date at once, and optionally fails.
+    """
+    def __init__(self, counts, fail=False):
+        super().__init__()
+        self.counts = counts
+        self.fail = fail
+        self.concurrency_group = "download"
+
+    def process(self, date_string):
+        if self.fail:
+            raise ValueError("failed")
+        with self.counts["lock"]:
+            self.counts["running"] += 1
+            self.counts["max_running"] = max(self.counts["running"],
+                                             self.counts["max_running"])
+        time.sleep(0.02)
+        with self.counts["lock"]:
+            self.counts["running"] -= 1
+            self.counts["done"] += 1
+        return True
+
+    def run(self):
+        super().run()
+        for date_string in ["2001-01-01", "2001-02-01"]:
+            self.run_date(date_string)
+
+
+def make_site_pipeline(batch, site_id, counts, fail=False):
+    p = Pipeline("testpipe_{}".format(site_id))
+    p.coords = [1.0 + len(batch.pipelines), 2.0]
+    p.date_range = ["2001-01-01","2002-01-01"]
+    p.output_location = batch.get_site_output_location(site_id)
+    p.output_location_type = "local"
+    for name in ["veg", "weather"]:
+        sequence = Sequence(name)
+        sequence += DownloadLikeModule(counts, fail and name == "veg")
+        p += sequence
+    p += Sequence("combine")
+    p.combine += DownloadLikeModule(counts)
+    p.combine.depends_on = ["veg", "weather"]
+    return p
+
+
+def test_batch_runner(tmp_path):
+    counts = {"lock": threading.Lock(), "running": 0, "max_running": 0, "done": 0}
+    batch = BatchRunner("testbatch", str(tmp_path))
+    batch.max_parallel_sequences = -1
+    batch.max_parallel_downloads = 2
+    batch.n_worker_processes = 1
+    for site_id in ["00", "01", "02"]:
+        batch.add_site(site_id, make_site_pipeline(batch, site_id, counts,
+                                                   fail=(site_id == "01")))
+    batch.configure()
+    summary = batch.run()
+    # the other locations carry on when one fails
+    assert summary["n_succeeded"] == 2
+    assert summary["n_failed"] == 1
+    failed_site = summary["sites"][1]
+    assert failed_site["status"] == "failed"
+    assert list(failed_site["failed_sequences"].keys()) == ["veg"]
+    assert failed_site["sequences_not_run"] == ["combine"]
+    # 2 dates for 3 sequences at 2 sites, and the weather sequence at the failed one
+    assert counts["done"] == 14
+    assert counts["max_running"] <= 2
+    # each location has the same output layout as a single pipeline
+    assert os.path.exists(os.path.join(tmp_path, "00", "run_report.json"))
+    assert os.path.exists(os.path.join(tmp_path, "00", "run_manifest.sqlite"))
+    saved_summary = json.load(open(os.path.join(tmp_path, "batch_summary.json")))
+    assert saved_summary["sites"][0]["output_location"] == os.path.join(tmp_path, "00")
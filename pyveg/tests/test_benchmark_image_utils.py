@@ -0,0 +1,69 @@
+"""
+Test that the numpy versions of the pixel-level image functions give the
+same results as the pixel-by-pixel reference versions in the benchmark script.
+"""
+
+import numpy as np
+from PIL import Image
+
+from pyveg.src.image_utils import (
+    image_from_array,
+    invert_binary_image,
+    convert_to_bw,
+    image_all_same_colour,
+    compare_binary_images
+)
+from pyveg.scripts.benchmark_image_utils import *
+
+
+RAND = np.random.RandomState(1)
+GREY = RAND.randint(0, 256, (23, 17)).astype(np.uint8)
+RGB = RAND.randint(0, 256, (23, 17, 3)).astype(np.uint8)
+RGB[:5] = 0
+IMAGES = [Image.fromarray(RGB, "RGB"),
+          Image.fromarray(GREY, "L"),
+          Image.fromarray(GREY > 128).convert("1"),
+          Image.fromarray(GREY.astype(np.float32) / 10, "F")]
+
+
+def test_image_from_array():
+    arrays = [GREY, GREY.astype(float) * 1.3 - 20, np.where(GREY > 128, 200, 0)]
+    for array in arrays:
+        assert(image_from_array(array) == image_from_array_loop(array))
+    assert(image_from_array(arrays[2], 40) == image_from_array_loop(arrays[2], 40))
+
+
+def test_invert_binary_image():
+    image = IMAGES[0]
+    assert(invert_binary_image(image) == invert_binary_image_loop(image))
+
+
+def test_convert_to_bw():
+    for image in IMAGES:
+        for threshold, invert in [(100, False), (300, True), (12.5, False)]:
+            assert(convert_to_bw(image, threshold, invert) == \
+                   convert_to_bw_loop(image, threshold, invert))
+
+
+def test_image_all_same_colour():
+    black = Image.fromarray(np.zeros((20, 20, 3), dtype=np.uint8), "RGB")
+    for image in IMAGES + [black]:
+        for colour in [(0, 0, 0), 0, (255, 255, 255, 255)]:
+            for threshold in [0.2, 0.99]:
+                assert(image_all_same_colour(image, colour, threshold) == \
+                       image_all_same_colour_loop(image, colour, threshold))
+
+
+def test_compare_binary_images():
+    for image1 in IMAGES:
+        for image2 in IMAGES:
+            assert(compare_binary_images(image1, image2) == \
+                   compare_binary_images_loop(image1, image2))
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(size=20, repeats=1)
+    assert(len(results) == 5)
+    for result in results.values():
+        assert(result["numpy_s"] >= 0)
+        assert(result["loop_s"] >= 0)
@@ -0,0 +1,38 @@
+"""
+Test the subgraph centrality benchmark script runs, and produces json output.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from pyveg.scripts.benchmark_subgraph_centrality import run_benchmarks, resize_image
+
+FIXTURE = os.path.join(os.path.dirname(__file__),"..","testdata","binary_labyrinths_50.csv")
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(sizes=[20, 30], rainfalls=[1.0], steps=10,
+                             fixtures=[FIXTURE], max_dense_pixels=300)
+    # 2 sizes x 2 images x 2 neighbour options
+    assert(len(results["results"]) == 8)
+    for result in results["results"]:
+        assert(result["size"] in [20, 30])
+        stages = result["stages"]
+        for stage in ["signal_pixels", "adjacency_sparse", "eigen_solve",
+                      "euler_characteristic", "total"]:
+            assert(stages[stage]["time_s"] >= 0)
+            assert(stages[stage]["peak_memory_bytes"] > 0)
+        if result["n_signal_pixels"] > 300:
+            assert(stages["distance_matrix"] is None)
+    # check the output can be written as json
+    assert(isinstance(json.dumps(results), str))
+
+
+def test_resize_image():
+    image = np.arange(6).reshape(2, 3)
+    assert((resize_image(image, 2) == image[:2, :2]).all())
+    resized = resize_image(image, 5)
+    assert(resized.shape == (5, 5))
+    assert((resized[2:4, 3:5] == image[:, :2]).all())
@@ -0,0 +1,97 @@
+"""
+Test the subgraph centrality cache in cache_utils.py
+"""
+
+import os
+import numpy as np
+
+from pyveg.src.cache_utils import *
+from pyveg.src.subgraph_centrality import (
+    text_file_to_array,
+    crop_image_array,
+    subgraph_centrality
+)
+
+IMG_FILE = os.path.join(os.path.dirname(__file__),"..","testdata","binary_image.txt")
+IMG = crop_image_array(text_file_to_array(IMG_FILE),(0,20),(0,20))
+
+
+def test_make_key():
+    key = FeatureVectorCache.make_key(IMG, 255, num_quantiles=20)
+    # same binary image, different grey levels below threshold
+    img2 = np.where(IMG == 255, 255, 100)
+    assert(FeatureVectorCache.make_key(img2, 255, num_quantiles=20) == key)
+    assert(FeatureVectorCache.make_key(IMG, 255, num_quantiles=10) != key)
+    assert(FeatureVectorCache.make_key(255-IMG, 255, num_quantiles=20) != key)
+
+
+def test_cached_subgraph_centrality(tmp_path):
+    cache = FeatureVectorCache(os.path.join(tmp_path, "cache.sqlite"))
+    feature_vec, hit = cached_subgraph_centrality(IMG, cache)
+    assert(not hit)
+    cached_feature_vec, hit = cached_subgraph_centrality(IMG, cache)
+    assert(hit)
+    assert((cached_feature_vec == feature_vec).all())
+    expected_feature_vec, _ = subgraph_centrality(IMG)
+    assert((cached_feature_vec == np.array(expected_feature_vec)).all())
+    # different parameters should not use the same entry
+    _, hit = cached_subgraph_centrality(IMG, cache, use_diagonal_neighbours=True)
+    assert(not hit)
+    assert(cache.hits == 1)
+    assert(cache.misses == 2)
+    cache.close()
+
+
+def test_cache_lru_eviction(tmp_path):
+    cache = FeatureVectorCache(os.path.join(tmp_path, "cache.sqlite"), max_entries=2,
+                               touch_interval=0)
+    cache.put("a", np.zeros(3))
+    cache.put("b", np.ones(3))
+    # use "a", so that "b" is the least recently used
+    assert(cache.get("a") is not None)
+    cache.put("c", np.ones(3))
+    assert(len(cache) == 2)
+    assert(cache.get("b") is None)
+    assert(cache.get("a") is not None)
+    assert(cache.get("c") is not None)
+    cache.close()
+
+
+def test_cache_batched_updates(tmp_path):
+    db_path = os.path.join(tmp_path, "cache.sqlite")
+    cache = FeatureVectorCache(db_path, max_entries=10, touch_interval=0,
+                               touch_batch_size=3, evict_fraction=0.5)
+    for i in range(10):
+        cache.put(str(i), np.zeros(3))
+    assert(cache.n_entries == 10)
+    # going over max_entries evicts the oldest, plus half of max_entries
+    cache.put("10", np.zeros(3))
+    assert(len(cache) == cache.n_entries == 5)
+    assert(cache.get("5") is None)
+    assert(cache.get("6") is not None)
+    # last_used times aren't written until there are touch_batch_size of them
+    last_used = lambda key: cache.connection.execute(
+        "SELECT last_used FROM feature_vectors WHERE key = ?", (key,)).fetchone()[0]
+    time_before = last_used("7")
+    # "6" was used above, so this is the second of the batch
+    cache.get("7")
+    assert(last_used("7") == time_before)
+    cache.get("8")
+    assert(last_used("7") > time_before)
+    assert(not cache.pending_touches)
+    # entries used recently enough aren't updated at all
+    cache.touch_interval = 60.
+    cache.get("10")
+    assert(not cache.pending_touches)
+    cache.close()
+    # the running count starts from the real count when reopened
+    assert(FeatureVectorCache(db_path).n_entries == 5)
+
+
+def test_get_cache(tmp_path):
+    db_path = os.path.join(tmp_path, "cache.sqlite")
+    cache = get_cache(db_path)
+    assert(get_cache(db_path) is cache)
+    cache.close()
+    assert(get_cache(db_path) is not cache)
+    get_cache(db_path).close()
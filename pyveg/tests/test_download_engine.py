@@ -0,0 +1,144 @@
+"""
+Test the download engine against a local HTTP server serving zipfiles.
+"""
+
+import io
+import os
+import time
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pyveg.src.download_engine import DownloadEngine, DownloadError
+
+
+def make_zipfile(filebase="download"):
+    zip_bytes = io.BytesIO()
+    with zipfile.ZipFile(zip_bytes, "w") as zip_obj:
+        for band in ["B2", "B3", "B4"]:
+            zip_obj.writestr("{}.{}.tif".format(filebase, band), b"tif data")
+    return zip_bytes.getvalue()
+
+
+class GEEStandIn(BaseHTTPRequestHandler):
+    """
+    Serves zipfiles, failing the first few requests for some paths:
+    /ok, /flaky (503 twice), /busy (429 once), /corrupt (truncated once),
+    /missing (404), /down (always 500), /slow (takes 0.1s),
+    /badzip (always truncated), /flakybadzip (503 then truncated).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0].strip("/")
+        with server.lock:
+            server.requests[path] = server.requests.get(path, 0) + 1
+            n_requests = server.requests[path]
+            server.client_ports.add(self.client_address[1])
+            server.running += 1
+            server.max_running = max(server.running, server.max_running)
+        try:
+            if path == "slow":
+                time.sleep(0.1)
+            if path == "missing":
+                self.send_body(404, b"not found")
+            elif path == "down" or (path == "flaky" and n_requests <= 2):
+                self.send_body(503 if path == "flaky" else 500, b"error")
+            elif path == "busy" and n_requests == 1:
+                self.send_body(429, b"slow down", {"Retry-After": "0"})
+            elif path == "flakybadzip" and n_requests % 2 == 1:
+                self.send_body(503, b"error")
+            elif path == "badzip" or path == "flakybadzip" or \
+                 (path == "corrupt" and n_requests == 1):
+                self.send_body(200, make_zipfile()[:20])
+            else:
+                self.send_body(200, make_zipfile(path))
+        finally:
+            with server.lock:
+                server.running -= 1
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GEEStandIn)
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.client_ports = set()
+    server.running = 0
+    server.max_running = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_and_unzip(server, tmp_path):
+    with DownloadEngine() as engine:
+        tif_filenames = engine.download_and_unzip(server.url+"ok?name=x", str(tmp_path))
+    assert tif_filenames == [os.path.join(tmp_path, "ok")]
+    assert sorted(os.listdir(tmp_path)) == ["gee.zip", "ok.B2.tif", "ok.B3.tif", "ok.B4.tif"]
+
+
+def test_retries(server, tmp_path):
+    with DownloadEngine(backoff_factor=0.01) as engine:
+        for path in ["flaky", "busy", "corrupt"]:
+            engine.download_and_unzip(server.url+path, os.path.join(tmp_path, path))
+            assert os.path.exists(os.path.join(tmp_path, path, path+".B4.tif"))
+    assert server.requests == {"flaky": 3, "busy": 2, "corrupt": 2}
+
+
+def test_failures(server, tmp_path):
+    with DownloadEngine(max_retries=2, backoff_factor=0.01) as engine:
+        # not worth retrying
+        with pytest.raises(DownloadError):
+            engine.get(server.url+"missing")
+        with pytest.raises(DownloadError):
+            engine.get(server.url+"down")
+    assert server.requests == {"missing": 1, "down": 3}
+    # errors and corrupt zipfiles count towards the same retries
+    with DownloadEngine(max_retries=2, backoff_factor=0.01) as engine:
+        for path in ["badzip", "flakybadzip"]:
+            with pytest.raises(DownloadError):
+                engine.download_and_unzip(server.url+path, os.path.join(tmp_path, path))
+    assert server.requests["badzip"] == 3
+    assert server.requests["flakybadzip"] == 3
+    # nothing listening here
+    with DownloadEngine(max_retries=1, backoff_factor=0.01, timeout=1) as engine:
+        with pytest.raises(DownloadError):
+            engine.get("http://127.0.0.1:1/")
+
+
+def test_backoff():
+    engine = DownloadEngine(backoff_factor=1., max_backoff=10.)
+    for attempt in range(8):
+        assert 0 <= engine.get_backoff(attempt) <= min(10., 2**attempt)
+    assert engine.get_backoff(0, retry_after="5") >= 5
+    assert engine.get_backoff(0, retry_after="100") <= 10.
+
+
+def test_download_all(server, tmp_path):
+    urls = [server.url+"slow" for _ in range(6)]
+    with DownloadEngine(max_parallel_downloads=2) as engine:
+        tif_filenames = engine.download_all(urls, str(tmp_path))
+        # connections are reused, so only as many as downloads at once
+        assert len(server.client_ports) <= 2
+    assert server.max_running <= 2
+    assert len(tif_filenames) == 6
+    for i in range(6):
+        assert os.path.exists(os.path.join(tmp_path, str(i), "slow.B4.tif"))
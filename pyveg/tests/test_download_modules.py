@@ -119,3 +119,33 @@ def test_weather_downloader_run_era5():
     tif_files = [filename for filename in os.listdir(tif_dir) if filename.endswith(".tif")]
     assert len(tif_files) == 2 # temp, precipitation
     shutil.rmtree(tif_dir, ignore_errors=True)
+
+
+@unittest.skipIf(os.environ.get('TRAVIS') == 'true','Skipping this test on Travis CI.')
+def test_download_data_keeps_last_url(tmp_path, monkeypatch):
+    """
+    GEE zipfiles all contain the same filenames, so with several URLs
+    for a date, the files from the last URL should be the ones kept.
+    """
+    from pyveg.src.download_engine import DownloadEngine
+
+    class FakeDownloadEngine(DownloadEngine):
+        def download_all(self, urls, output_dir):
+            # write the directories in reverse, so filesystem order can't help
+            for url, url_dir in reversed(list(zip(urls, self.get_url_dirs(len(urls),
+                                                                          output_dir)))):
+                os.makedirs(url_dir)
+                for band in ["B2", "B3", "B4"]:
+                    with open(os.path.join(url_dir, "download.{}.tif".format(band)),
+                              "w") as outfile:
+                        outfile.write(url)
+
+    veg_downloader = VegetationDownloader("Sentinel2")
+    veg_downloader.output_location_type = "local"
+    monkeypatch.setattr(veg_downloader, "get_download_engine", FakeDownloadEngine)
+    raw_dir = os.path.join(tmp_path, "RAW")
+    assert veg_downloader.download_data(["url0", "url1", "url2"], raw_dir)
+    assert sorted(os.listdir(raw_dir)) == ["download.B2.tif", "download.B3.tif",
+                                           "download.B4.tif"]
+    for filename in os.listdir(raw_dir):
+        assert open(os.path.join(raw_dir, filename)).read() == "url2"
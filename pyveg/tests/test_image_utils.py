@@ -77,3 +77,116 @@ def test_adaptive_threshold():
         for j in range(cols):
             is_binary = img[i,j] == 0 or img[i,j] == 255
             assert(is_binary)
+
+
+def write_test_tif(tmp_path, filename, pix):
+    filepath = os.path.join(tmp_path, filename)
+    cv.imwrite(filepath, pix)
+    return filepath
+
+
+def test_scale_tif(tmp_path):
+    # non-square, with values outside [-1, 1] to check clipping
+    pix = np.linspace(-1.2, 1.2, 15*8, dtype=np.float32).reshape(15, 8)
+    img = scale_tif(write_test_tif(tmp_path, "ndvi.tif", pix))
+    assert(img.size == (15, 8))
+    # compare with setting each pixel individually
+    for ix in range(pix.shape[0]):
+        for iy in range(pix.shape[1]):
+            val = min(255, max(0, int((pix[ix, iy] + 1) / 2 * 255)))
+            assert(img.getpixel((ix, iy)) == (val, val, val))
+
+
+def test_combine_tif(tmp_path):
+    band_dict = {}
+    for i, col in enumerate(["r", "g", "b"]):
+        pix = np.random.RandomState(i).uniform(-0.1, 0.5, (12, 7)).astype(np.float32)
+        band_dict[col] = {"band": "B{}".format(i),
+                          "filename": write_test_tif(tmp_path, col+".tif", pix)}
+    # read a few rows at a time, to check the blocks are put together properly
+    img = combine_tif(band_dict, block_rows=5)
+    assert(img.size == (12, 7))
+    overall_max = max(band_dict[col]["max_val"] for col in ["r", "g", "b"])
+    pix_vals = {col: cv.imread(band_dict[col]["filename"], cv.IMREAD_ANYDEPTH) \
+                for col in ["r", "g", "b"]}
+    # compare with setting each pixel individually
+    for ix in range(12):
+        for iy in range(7):
+            expected = tuple(max(0, int(pix_vals[col][ix, iy] * 255 / \
+                                        (overall_max+1)))
+                             for col in ["r", "g", "b"])
+            assert(img.getpixel((ix, iy)) == expected)
+
+
+def test_scale_tif_to_array(tmp_path):
+    pix = np.random.RandomState(0).uniform(-1, 1, (60, 40)).astype(np.float32)
+    filename = write_test_tif(tmp_path, "ndvi.tif", pix)
+    grey_array = scale_tif_to_array(filename)
+    assert(grey_array.dtype == np.uint8)
+    assert((Image.fromarray(grey_array).convert("RGB") == scale_tif(filename)))
+
+
+def test_process_and_threshold_array(tmp_path):
+    pix = np.random.RandomState(1).uniform(-1, 1, (120, 110)).astype(np.float32)
+    filename = write_test_tif(tmp_path, "ndvi.tif", pix)
+    processed_array = process_and_threshold(scale_tif_to_array(filename))
+    processed_image = process_and_threshold(scale_tif(filename))
+    assert((processed_array == np.array(processed_image)).all())
+
+
+def test_crop_image_npix_array():
+    img_array = np.arange(100*150, dtype=np.uint8).reshape(100, 150)
+    sub_arrays = crop_image_npix(img_array, 50, region_size=0.08, coords=[0., 0.])
+    sub_images = crop_image_npix(Image.fromarray(img_array), 50,
+                                 region_size=0.08, coords=[0., 0.])
+    assert(len(sub_arrays) == len(sub_images) == 6)
+    for (sub_array, array_coords), (sub_image, image_coords) in zip(sub_arrays, sub_images):
+        assert(array_coords == image_coords)
+        assert((sub_array == np.array(sub_image)).all())
+        # sub-images should be views, not copies
+        assert(np.shares_memory(sub_array, img_array))
+
+
+def test_get_tile_view():
+    img_array = np.arange(100*150*3, dtype=np.int32).reshape(100, 150, 3)
+    tiles = get_tile_view(img_array, 50)
+    assert(tiles.shape == (2, 3, 50, 50, 3))
+    assert((tiles[1, 2] == img_array[50:100, 100:150]).all())
+    assert(np.shares_memory(tiles, img_array))
+    # overlapping tiles, with a stride of 25 pixels
+    tiles = get_tile_view(img_array, 50, 40, stride_x=25, stride_y=30)
+    assert(tiles.shape == (3, 5, 40, 50, 3))
+    assert((tiles[2, 4] == img_array[60:100, 100:150]).all())
+
+
+def test_iter_tiles():
+    img_array = np.arange(100*100, dtype=np.uint8).reshape(100, 100)
+    tiles = list(iter_tiles(img_array, 25, region_size=0.08, coords=[10., 20.]))
+    assert(len(tiles) == 16)
+    sub_images = crop_image_npix(Image.fromarray(img_array), 25,
+                                 region_size=0.08, coords=[10., 20.])
+    for (ix, iy, tile, tile_coords), (sub_image, sub_coords) in zip(tiles, sub_images):
+        assert(tile_coords == sub_coords)
+        assert((tile == img_array[iy*25:(iy+1)*25, ix*25:(ix+1)*25]).all())
+    # overlapping tiles should be centred on their central pixel
+    tiles = list(iter_tiles(img_array, 50, region_size=0.08, coords=[10., 20.],
+                            stride_x=25, stride_y=25))
+    assert(len(tiles) == 9)
+    _, _, _, centre_coords = tiles[4]
+    assert(np.allclose(centre_coords, (10., 20.)))
+
+
+def test_screen_tiles():
+    rand = np.random.RandomState(0)
+    rgb_array = rand.randint(1, 255, (30, 20, 3)).astype(np.uint8)
+    # tile ix=0,iy=1 has too many black pixels, tile ix=1,iy=2 has a few
+    rgb_array[10:12, :10] = 0
+    rgb_array[20, 10:13] = 0
+    accept, fractions = screen_tiles(rgb_array, 10)
+    tiles = [tile for _, _, tile, _ in iter_tiles(rgb_array, 10)]
+    assert(list(accept) == [check_image_ok(Image.fromarray(tile), 0.05) for tile in tiles])
+    assert(list(accept) == [True, False, True, True, True, True])
+    assert(np.allclose(fractions, [0., 0.2, 0., 0., 0., 0.03]))
+    stack_accept, stack_fractions = screen_tile_stack(np.stack(tiles))
+    assert((stack_accept == accept).all())
+    assert(np.allclose(stack_fractions, fractions))
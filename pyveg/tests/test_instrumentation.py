@@ -0,0 +1,69 @@
+"""
+Test the run metrics and profiling in instrumentation.py
+"""
+
+import os
+import threading
+
+from pyveg.src.instrumentation import *
+
+
+def test_measure_counters():
+    metrics = RunMetrics("testpipe")
+    increment("tiles_processed", 5) # no measurement running - ignored
+    with metrics.measure("veg", "processor"):
+        increment("gee_calls")
+        with metrics.measure("veg", "processor", "2018-03-01") as measurement:
+            increment("tiles_processed", 10)
+            increment("cache_hits", 4)
+        with metrics.measure("veg", "processor", "2018-04-01") as measurement:
+            measurement.skipped = True
+        # other threads have their own measurements
+        thread = threading.Thread(target=increment, args=("gee_calls", 100))
+        thread.start()
+        thread.join()
+    report = metrics.get_report()
+    assert len(report["modules"]) == 1
+    assert len(report["dates"]) == 2
+    assert report["dates"][0]["counters"] == {"tiles_processed": 10, "cache_hits": 4}
+    summary = report["modules"][0]
+    assert summary["counters"] == {"gee_calls": 1, "tiles_processed": 10, "cache_hits": 4}
+    assert summary["n_dates"] == 2
+    assert summary["n_dates_skipped"] == 1
+    assert summary["wall_time_s"] >= 0
+    assert summary["cpu_time_s"] >= 0
+
+
+def test_text_report():
+    metrics = RunMetrics("testpipe")
+    with metrics.measure("veg", "processor"):
+        increment("tiles_processed", 10)
+    text_report = metrics.get_text_report()
+    lines = text_report.splitlines()
+    assert lines[0].startswith("Run report for pipeline testpipe")
+    assert "tiles_processed" in lines[2]
+    assert lines[3].startswith("veg/processor")
+    assert lines[3].split()[-4] == "10"
+
+
+def test_module_profiler(tmp_path):
+    profiler = ModuleProfiler()
+    profiler.start()
+    sorted(range(1000), key=lambda x: -x)
+    profiler.stop()
+    assert "function calls" in profiler.get_text()
+    profile_path = profiler.save(os.path.join(tmp_path, "module"))
+    assert profile_path.endswith(".prof")
+    assert os.path.exists(profile_path)
+
+
+def test_one_profiler_at_once():
+    profiler = ModuleProfiler()
+    assert profiler.start()
+    # a second module running at the same time isn't profiled
+    other_profiler = ModuleProfiler()
+    assert not other_profiler.start()
+    other_profiler.stop()
+    profiler.stop()
+    assert other_profiler.start()
+    other_profiler.stop()
@@ -0,0 +1,52 @@
+"""
+Test the run manifest in manifest.py
+"""
+
+import os
+
+from pyveg.src.manifest import *
+
+
+def test_mark_complete(tmp_path):
+    manifest = RunManifest(os.path.join(tmp_path, "manifest.sqlite"))
+    assert(manifest.get("veg", "downloader", "2018-03-01") is None)
+    manifest.mark_complete("veg", "downloader", "2018-03-01", "abc", True,
+                           [{"path": "a.tif", "size": 10, "sha1": "123"}])
+    manifest.mark_complete("veg", "downloader", "2018-04-01", "abc", False)
+    assert(len(manifest) == 2)
+    entry = manifest.get("veg", "downloader", "2018-03-01")
+    assert(entry["has_output"])
+    assert(entry["artefacts"][0]["path"] == "a.tif")
+    assert(not manifest.get("veg", "downloader", "2018-04-01")["has_output"])
+    assert(manifest.is_complete("veg", "downloader", "2018-03-01", "abc"))
+    assert(not manifest.is_complete("veg", "downloader", "2018-03-01", "def"))
+    assert(not manifest.is_complete("weather", "downloader", "2018-03-01", "abc"))
+    manifest.close()
+    # entries should still be there when the manifest is reopened
+    manifest = RunManifest(os.path.join(tmp_path, "manifest.sqlite"))
+    assert(manifest.is_complete("veg", "downloader", "2018-03-01", "abc"))
+    manifest.close()
+
+
+def test_describe_artefacts(tmp_path):
+    os.makedirs(os.path.join(tmp_path, "RAW"))
+    with open(os.path.join(tmp_path, "RAW", "download.B4.tif"), "wb") as outfile:
+        outfile.write(b"abc")
+    artefacts = describe_artefacts([os.path.join(tmp_path, "RAW"),
+                                    os.path.join(tmp_path, "MISSING")])
+    assert(len(artefacts) == 1)
+    assert(artefacts[0]["size"] == 3)
+    assert(artefacts[0]["mtime"] > 0)
+    assert("sha1" not in artefacts[0])
+    artefacts = describe_artefacts([os.path.join(tmp_path, "RAW")], checksums=True)
+    assert(artefacts[0]["sha1"] == "a9993e364706816aba3e25717850c26c9cd0d89d")
+
+
+def test_copy_to(tmp_path):
+    manifest = RunManifest(os.path.join(tmp_path, "manifest.sqlite"))
+    manifest.mark_complete("veg", "downloader", "2018-03-01", "abc")
+    manifest.copy_to(os.path.join(tmp_path, "copy.sqlite"))
+    manifest.close()
+    copy = RunManifest(os.path.join(tmp_path, "copy.sqlite"))
+    assert(copy.is_complete("veg", "downloader", "2018-03-01", "abc"))
+    copy.close()
@@ -2,7 +2,53 @@
 Tests of the core functionality of pipelines, sequences, and modules.
 """
 
+import os
+import json
+import threading
+import pytest
+
 from pyveg.src.pyveg_pipeline import Pipeline, Sequence, BaseModule
+from pyveg.src.instrumentation import increment
+
+
+class RecordingModule(BaseModule):
+    """
+    Module that appends its sequence name to a list when it runs,
+    optionally waiting at a barrier first, or raising an exception.
+    """
+    def __init__(self, events, barrier=None, fail=False):
+        super().__init__()
+        self.events = events
+        self.barrier = barrier
+        self.fail = fail
+
+    def run(self):
+        super().run()
+        if self.barrier:
+            self.barrier.wait()
+        if self.fail:
+            raise ValueError("{} failed".format(self.parent.name))
+        self.events.append(self.parent.name)
+
+
+def make_dag_pipeline(events, barrier=None, fail_veg=False):
+    """
+    Pipeline with two independent sequences, and a third that depends on both.
+    """
+    p = Pipeline("testpipe")
+    p.coords = [1.23, 4.56]
+    p.date_range = ["2001-01-01","2020-01-01"]
+    p.output_location = "/tmp"
+    p.output_location_type = "local"
+    p += Sequence("combine")
+    p.combine.depends_on = ["veg", "weather"]
+    p.combine += RecordingModule(events)
+    p += Sequence("veg")
+    p.veg += RecordingModule(events, barrier, fail_veg)
+    p += Sequence("weather")
+    p.weather += RecordingModule(events, barrier)
+    p.configure()
+    return p
 
 def test_instantiate_pipeline():
     p = Pipeline("testpipe")
@@ -77,3 +123,292 @@ def test_configure_pipeline():
     p.testseq += BaseModule()
     p.configure()
     assert p.testseq.testseq_BaseModule.is_configured
+
+
+def test_pipeline_run_order():
+    events = []
+    p = make_dag_pipeline(events)
+    assert [s.name for s in p.get_run_order()] == ["veg", "weather", "combine"]
+    p.run()
+    assert events == ["veg", "weather", "combine"]
+
+
+def test_pipeline_run_concurrently():
+    events = []
+    # both independent sequences have to be running at once to pass the barrier
+    p = make_dag_pipeline(events, threading.Barrier(2, timeout=10))
+    p.max_parallel_sequences = -1
+    p.run()
+    assert sorted(events[:2]) == ["veg", "weather"]
+    assert events[2] == "combine"
+
+
+def test_pipeline_failure_propagates():
+    events = []
+    p = make_dag_pipeline(events, fail_veg=True)
+    p.max_parallel_sequences = 2
+    with pytest.raises(ValueError):
+        p.run()
+    assert events == ["weather"]
+
+
+def test_pipeline_bad_dependencies():
+    p = Pipeline("testpipe")
+    p += Sequence("a")
+    p += Sequence("b")
+    p.a.depends_on = ["b"]
+    p.b.depends_on = ["a"]
+    with pytest.raises(RuntimeError):
+        p.get_dependency_graph()
+    p.b.depends_on = ["c"]
+    with pytest.raises(RuntimeError):
+        p.get_dependency_graph()
+
+
+class StreamingModule(BaseModule):
+    """
+    Module that records (name, date) when it processes each date.
+    """
+    def __init__(self, name, events, dates=None, fail_on=None, wait_for=None):
+        super().__init__(name)
+        self.events = events
+        self.dates = dates
+        self.fail_on = fail_on
+        self.wait_for = wait_for
+
+    def list_dates(self):
+        return self.dates
+
+    def process(self, date_string):
+        if self.wait_for and date_string == self.wait_for[0]:
+            # wait until the next module has started on an earlier date
+            assert self.wait_for[1].wait(timeout=10)
+        if date_string == self.fail_on:
+            raise ValueError("failed on {}".format(date_string))
+        self.events.append((self.name, date_string))
+        increment("tiles_processed", 3)
+        return date_string != "2001-02-01"
+
+    def run(self):
+        super().run()
+        for date_string in self.dates:
+            self.run_date(date_string)
+
+
+class EventModule(StreamingModule):
+    """
+    Sets an event when it has processed a date.
+    """
+    def __init__(self, name, events, event):
+        super().__init__(name, events)
+        self.event = event
+
+    def process(self, date_string):
+        result = super().process(date_string)
+        self.event.set()
+        return result
+
+
+def make_streaming_sequence(modules):
+    s = Sequence("testseq")
+    s.coords = [1.23, 4.56]
+    s.date_range = ["2001-01-01","2020-01-01"]
+    s.streaming = True
+    s.stream_queue_size = 1
+    for module in modules:
+        s += module
+    s.configure()
+    return s
+
+
+def test_sequence_streaming():
+    events = []
+    dates = ["2001-01-01", "2001-02-01", "2001-03-01"]
+    processed_first_date = threading.Event()
+    s = make_streaming_sequence([
+        StreamingModule("download", events, dates,
+                        wait_for=("2001-03-01", processed_first_date)),
+        EventModule("process", events, processed_first_date)
+    ])
+    assert s.can_stream()
+    s.run()
+    # the second module started before the first had done every date
+    assert events.index(("process", "2001-01-01")) < events.index(("download", "2001-03-01"))
+    # dates where process() returns False aren't passed on
+    assert [e for e in events if e[0] == "process"] == [("process", "2001-01-01"),
+                                                      ("process", "2001-03-01")]
+
+
+def test_sequence_streaming_failure():
+    events = []
+    dates = ["2001-{:02d}-01".format(month) for month in range(3, 13)]
+    analysed = threading.Event()
+    s = make_streaming_sequence([
+        StreamingModule("download", events, dates),
+        # fail only once the last module has had the previous date
+        StreamingModule("process", events, fail_on="2001-04-01",
+                        wait_for=("2001-04-01", analysed)),
+        EventModule("analyse", events, analysed)
+    ])
+    with pytest.raises(ValueError):
+        s.run()
+    assert ("analyse", "2001-03-01") in events
+    assert ("process", "2001-04-01") not in events
+    # the first module stops soon after the failure
+    assert ("download", "2001-12-01") not in events
+
+
+def test_sequence_streaming_not_supported():
+    events = []
+    s = make_streaming_sequence([
+        StreamingModule("download", events, ["2001-01-01"]),
+        RecordingModule(events)
+    ])
+    assert not s.can_stream()
+    s.run()
+    assert events == [("download", "2001-01-01"), "testseq"]
+
+
+class ConfigurableModule(StreamingModule):
+    """
+    Module with a parameter that goes into its config hash.
+    """
+    def __init__(self, name, events, dates=None):
+        super().__init__(name, events, dates)
+        self.params += [("threshold", [int])]
+
+    def set_default_parameters(self):
+        if not "threshold" in vars(self):
+            self.threshold = 1
+
+
+def make_manifest_pipeline(tmp_path, events, threshold=1):
+    p = Pipeline("testpipe")
+    p.coords = [1.23, 4.56]
+    p.date_range = ["2001-01-01","2020-01-01"]
+    p.output_location = str(tmp_path)
+    p.output_location_type = "local"
+    p += Sequence("veg")
+    p.veg += ConfigurableModule("download", events, ["2001-01-01", "2001-03-01"])
+    p.veg += ConfigurableModule("process", events, ["2001-01-01", "2001-03-01"])
+    p.veg += ConfigurableModule("analyse", events, ["2001-01-01", "2001-03-01"])
+    p.veg.process.threshold = threshold
+    p.configure()
+    return p
+
+
+def test_pipeline_manifest(tmp_path):
+    events = []
+    p = make_manifest_pipeline(tmp_path, events)
+    p.run()
+    assert len(events) == 6
+    assert len(p.get_manifest()) == 6
+    assert os.path.exists(os.path.join(tmp_path, "run_manifest.sqlite"))
+    # running again with the same config shouldn't redo anything
+    events = []
+    make_manifest_pipeline(tmp_path, events).run()
+    assert events == []
+    # changing the config of one module should redo it and the ones after it
+    make_manifest_pipeline(tmp_path, events, threshold=2).run()
+    assert sorted(set(name for name, _ in events)) == ["analyse", "process"]
+    assert len(events) == 4
+
+
+def test_pipeline_manifest_dates_without_output(tmp_path):
+    def make_pipeline(events):
+        p = Pipeline("testpipe")
+        p.coords = [1.23, 4.56]
+        p.date_range = ["2001-01-01","2020-01-01"]
+        p.output_location = str(tmp_path)
+        p.output_location_type = "local"
+        p += Sequence("veg")
+        p.veg += ConfigurableModule("download", events, ["2001-01-01", "2001-02-01"])
+        p.configure()
+        return p
+
+    events = []
+    make_pipeline(events).run()
+    assert len(events) == 2
+    # the date that had no output should be tried again
+    events = []
+    make_pipeline(events).run()
+    assert events == [("download", "2001-02-01")]
+    # unless asked not to
+    events = []
+    p = make_pipeline(events)
+    p.retry_dates_without_output = False
+    p.run()
+    assert events == []
+
+
+def test_run_report(tmp_path):
+    events = []
+    p = make_manifest_pipeline(tmp_path, events)
+    p.veg.analyse.profile = True
+    p.run()
+    text_report = p.write_run_report()
+    assert "veg/process" in text_report
+    assert "Profile of veg/analyse" in text_report
+    report = json.load(open(os.path.join(tmp_path, "run_report.json")))
+    assert os.path.exists(os.path.join(tmp_path, "run_report.txt"))
+    assert [m["module"] for m in report["modules"]] == ["download", "process", "analyse"]
+    assert all(m["counters"]["tiles_processed"] == 6 for m in report["modules"])
+    assert len(report["dates"]) == 6
+    assert os.path.exists(os.path.join(p.veg.output_location, "profiles", "analyse.prof"))
+    # dates done in an earlier run are reported as skipped
+    p = make_manifest_pipeline(tmp_path, events)
+    p.veg.streaming = True
+    p.run()
+    report = p.run_metrics.get_report()
+    assert all(m["n_dates_skipped"] == m["n_dates"] for m in report["modules"])
+
+
+def test_pipeline_manifest_azure(tmp_path, monkeypatch):
+    """
+    With Azure output, the manifest should be kept in the container, so a
+    run can be resumed on another machine, with a fresh temp directory.
+    """
+    import shutil
+    from pyveg.src import azure_utils
+    container_dir = os.path.join(tmp_path, "container")
+    os.makedirs(container_dir)
+
+    def retrieve_blob(blob_name, container_name, destination="/tmp/"):
+        if not os.path.exists(os.path.join(container_dir, blob_name)):
+            return False, "not found"
+        shutil.copy(os.path.join(container_dir, blob_name), destination)
+        return True, "OK"
+
+    def write_file_to_blob(file_path, blob_name, container_name):
+        shutil.copy(file_path, os.path.join(container_dir, blob_name))
+
+    monkeypatch.setattr(azure_utils, "sanitize_container_name", lambda name: name)
+    monkeypatch.setattr(azure_utils, "create_container", lambda name: None)
+    monkeypatch.setattr(azure_utils, "retrieve_blob", retrieve_blob)
+    monkeypatch.setattr(azure_utils, "write_file_to_blob", write_file_to_blob)
+
+    def make_azure_pipeline(events):
+        p = Pipeline("testpipe")
+        p.coords = [1.23, 4.56]
+        p.date_range = ["2001-01-01","2020-01-01"]
+        p.output_location = "testcontainer"
+        p.output_location_type = "azure"
+        p += Sequence("veg")
+        p.veg += ConfigurableModule("download", events, ["2001-01-01", "2001-03-01"])
+        p.veg += ConfigurableModule("process", events, ["2001-01-01", "2001-03-01"])
+        p.configure()
+        return p
+
+    events = []
+    p = make_azure_pipeline(events)
+    p.run()
+    assert len(events) == 4
+    assert os.path.exists(os.path.join(container_dir, "run_manifest.sqlite"))
+    # lose the local copy, as if on a new machine
+    p.get_manifest().close()
+    shutil.rmtree(p.manifest_dir)
+    events = []
+    p = make_azure_pipeline(events)
+    p.run()
+    assert events == []
+    assert len(p.get_manifest()) == 4
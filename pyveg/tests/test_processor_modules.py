@@ -6,12 +6,22 @@ import os
 import pytest
 import json
 import shutil
+import numpy as np
 
 from pyveg.src.processor_modules import (
     VegetationImageProcessor,
     NetworkCentralityCalculator,
     NDVICalculator,
-    WeatherImageToJSON
+    WeatherImageToJSON,
+    make_worker_pool,
+    get_shared_array,
+    MAX_ATTACHED_MEMORY
+)
+from pyveg.src import processor_modules
+from pyveg.src.pyveg_pipeline import Pipeline, Sequence
+from pyveg.src.subgraph_centrality import (
+    subgraph_centrality,
+    feature_vector_metrics
 )
 
 
@@ -31,8 +41,9 @@ def test_Sentinel2_image_processor():
     vip.run()
     assert os.path.exists(os.path.join(tmp_png_path, "2018-03-01", "PROCESSED"))
     assert len(os.listdir(os.path.join(tmp_png_path, "2018-03-01", "PROCESSED"))) == 3
-    assert os.path.exists(os.path.join(tmp_png_path, "2018-03-01", "SPLIT"))
-    assert len(os.listdir(os.path.join(tmp_png_path, "2018-03-01", "SPLIT"))) == 1452
+    # sub-images are in tile stores (.npy and .json for RGB, NDVI, BWNDVI)
+    assert os.path.exists(os.path.join(tmp_png_path, "2018-03-01", "TILES"))
+    assert len(os.listdir(os.path.join(tmp_png_path, "2018-03-01", "TILES"))) == 6
     shutil.rmtree(tmp_png_path, ignore_errors=True)
 
 
@@ -109,4 +120,274 @@ def test_NDVICalculator():
         assert nc_json[0][key] != 0.
     assert "date" in nc_json[0].keys()
     assert isinstance(nc_json[0]["date"], str)
-    shutil.rmtree(tmp_json_path)
\ No newline at end of file
+    shutil.rmtree(tmp_json_path)
+
+
+def make_test_tile_stores(output_location, date_string="2018-03-01"):
+    """
+    Use the VegetationImageProcessor to save tile stores, and png
+    sub-images, for random 100x100 RGB, NDVI and BWNDVI images, along
+    with the full-size RGB image.
+    """
+    vip = VegetationImageProcessor()
+    vip.input_location = output_location
+    vip.output_location = output_location
+    vip.save_sub_image_pngs = True
+    vip.configure()
+    rand = np.random.RandomState(0)
+    ndvi_array = rand.randint(0, 255, (100, 100)).astype(np.uint8)
+    bwndvi_array = np.where(ndvi_array > 128, 255, 0).astype(np.uint8)
+    rgb_array = rand.randint(1, 255, (100, 100, 3)).astype(np.uint8)
+    # one sub-image with too many masked pixels
+    rgb_array[50:60, :50] = 0
+    rgb_filepath = vip.construct_image_savepath(date_string, "11.58_27.95", "RGB")
+    vip.save_image(rgb_array, os.path.dirname(rgb_filepath),
+                   os.path.basename(rgb_filepath), verbose=False)
+    for image_type, image_array in [("RGB", rgb_array),
+                                    ("NDVI", ndvi_array),
+                                    ("BWNDVI", bwndvi_array)]:
+        vip.split_and_save_sub_images(image_array, date_string,
+                                      "11.58_27.95", image_type)
+
+
+def test_NDVICalculator_tile_store(tmp_path):
+    """
+    Results from the tile stores should be the same as from png sub-images.
+    """
+    make_test_tile_stores(str(tmp_path))
+    assert len(os.listdir(os.path.join(tmp_path, "2018-03-01", "TILES"))) == 6
+
+    ndvic = NDVICalculator()
+    ndvic.input_location = str(tmp_path)
+    ndvic.output_location = str(tmp_path)
+    ndvic.configure()
+    tile_results = ndvic.process_tiles("2018-03-01")
+    png_results = ndvic.process_png_files("2018-03-01")
+    assert len(tile_results) == 3
+    key = lambda result: (result["longitude"], result["latitude"])
+    for tile_result, png_result in zip(sorted(tile_results, key=key),
+                                       sorted(png_results, key=key)):
+        assert tile_result == png_result
+
+
+def test_screen_sub_images(tmp_path):
+    """
+    Screening the full-size RGB image should give the same results as
+    screening the RGB sub-images, from tile stores or png files.
+    """
+    make_test_tile_stores(str(tmp_path))
+    ndvic = NDVICalculator()
+    ndvic.input_location = str(tmp_path)
+    ndvic.output_location = str(tmp_path)
+    ndvic.configure()
+    accept, fractions = ndvic.screen_sub_images("2018-03-01", (50, 50), 4,
+                                                lambda: None)
+    assert list(accept) == [True, False, True, True]
+    assert np.allclose(fractions, [0., 0.2, 0., 0.])
+    png_files = ndvic.screen_png_sub_images("2018-03-01", "BWNDVI")
+    shutil.rmtree(os.path.join(tmp_path, "2018-03-01", "PROCESSED"))
+    rgb_store = np.load(os.path.join(tmp_path, "2018-03-01", "TILES",
+                                     "2018-03-01_11.58_27.95_RGB.npy"))
+    stack_accept, stack_fractions = ndvic.screen_sub_images("2018-03-01", (50, 50), 4,
+                                                            lambda: rgb_store)
+    assert (stack_accept == accept).all()
+    assert np.allclose(stack_fractions, fractions)
+    assert ndvic.screen_png_sub_images("2018-03-01", "BWNDVI") == png_files
+    assert len(png_files) == 3
+    # with no RGB images at all, accept everything
+    accept, fractions = ndvic.screen_sub_images("2018-03-01", (50, 50), 4,
+                                                lambda: None)
+    assert accept.all() and fractions is None
+
+
+def test_NDVICalculator_tile_stacks():
+    ndvic = NDVICalculator()
+    rand = np.random.RandomState(1)
+    ndvi_stack = rand.randint(0, 255, (5, 20, 20)).astype(np.uint8)
+    bwndvi_stack = np.where(ndvi_stack > 128, 255, 0).astype(np.uint8)
+    # one tile with no vegetation pixels
+    bwndvi_stack[2] = 255
+    coords_strings = ["11.{}00_27.950".format(i) for i in range(5)]
+    results = ndvic.process_tile_stacks(ndvi_stack, bwndvi_stack,
+                                        "2018-03-01", coords_strings)
+    assert len(results) == 5
+    for i, result in enumerate(results):
+        assert result["ndvi"] == round(ndvi_stack[i].mean(), 4)
+        assert result["longitude"] == float("11.{}".format(i))
+        if i == 2:
+            assert np.isnan(result["ndvi_veg"])
+        else:
+            assert result["ndvi_veg"] == ndvi_stack[i][bwndvi_stack[i] == 0].mean()
+
+
+def test_NDVICalculator_parallel_dates(tmp_path):
+    for date_string in ["2018-03-01", "2018-04-01", "2018-05-01"]:
+        make_test_tile_stores(str(tmp_path), date_string)
+    ndvic = NDVICalculator()
+    ndvic.input_location = str(tmp_path)
+    ndvic.output_location = str(tmp_path)
+    ndvic.n_threads = 3
+    ndvic.configure()
+    ndvic.run()
+    for date_string in ["2018-03-01", "2018-04-01", "2018-05-01"]:
+        ndvi_json = json.load(open(os.path.join(tmp_path, date_string, "JSON", "NDVI",
+                                                "ndvi_values.json")))
+        assert len(ndvi_json) == 3
+        assert all(result["date"] == date_string for result in ndvi_json)
+
+
+def test_NetworkCentralityCalculator_tile_store(tmp_path):
+    make_test_tile_stores(str(tmp_path))
+    ncc = NetworkCentralityCalculator()
+    ncc.input_location = str(tmp_path)
+    ncc.output_location = str(tmp_path)
+    ncc.configure()
+    ncc.run()
+    nc_json = json.load(open(os.path.join(tmp_path, "2018-03-01","JSON","NC","network_centralities.json")))
+    assert len(nc_json) == 3
+    assert sorted(result["longitude"] for result in nc_json) == [11.56, 11.6, 11.6]
+
+
+def test_NetworkCentralityCalculator_shared_memory(tmp_path):
+    make_test_tile_stores(str(tmp_path))
+    ncc = NetworkCentralityCalculator()
+    ncc.input_location = str(tmp_path)
+    ncc.output_location = str(tmp_path)
+    ncc.n_threads = 2
+    ncc.configure()
+    tiles, coords_strings = ncc.load_tile_store_tiles("2018-03-01")
+    feature_vecs, n_hits = ncc.calc_feature_vectors(tiles, None)
+    assert n_hits == 0
+    # results should come back in the same order as the tiles
+    for tile, feature_vec in zip(tiles, feature_vecs):
+        expected_feature_vec, _ = subgraph_centrality(tile)
+        assert np.allclose(feature_vec, expected_feature_vec)
+    ncc.run()
+    nc_json = json.load(open(os.path.join(tmp_path, "2018-03-01","JSON","NC","network_centralities.json")))
+    for result, feature_vec in zip(nc_json, feature_vecs):
+        expected_metrics = feature_vector_metrics(feature_vec)
+        for name in expected_metrics.keys():
+            assert result[name] == pytest.approx(expected_metrics[name])
+    # png sub-images should give the same results as the tile store
+    png_tiles, png_coords_strings = ncc.load_png_tiles("2018-03-01")
+    png_order = [png_coords_strings.index(coords) for coords in coords_strings]
+    for tile, i in zip(tiles, png_order):
+        assert (png_tiles[i] == tile).all()
+
+
+def test_NetworkCentralityCalculator_mixed_png_tiles(tmp_path):
+    """
+    An all-black BWNDVI sub-image saved as RGB is read as a 3D array,
+    while the others are 2D - they should all be read as 2D tiles.
+    """
+    from PIL import Image
+    make_test_tile_stores(str(tmp_path))
+    split_dir = os.path.join(tmp_path, "2018-03-01", "SPLIT")
+    bwndvi_files = sorted(f for f in os.listdir(split_dir) if f.endswith("_BWNDVI.png"))
+    Image.new("RGB", (50, 50)).save(os.path.join(split_dir, bwndvi_files[0]))
+    ncc = NetworkCentralityCalculator()
+    ncc.input_location = str(tmp_path)
+    ncc.output_location = str(tmp_path)
+    ncc.configure()
+    tiles, coords_strings = ncc.load_png_tiles("2018-03-01")
+    assert len(tiles) == 3
+    assert all(tile.shape == (50, 50) for tile in tiles)
+
+
+def test_get_shared_array_lru():
+    from multiprocessing import shared_memory
+    blocks = [shared_memory.SharedMemory(create=True, size=8) \
+              for _ in range(MAX_ATTACHED_MEMORY + 2)]
+    try:
+        for block in blocks:
+            get_shared_array(block.name, (8,), "u1")
+            # keep using the first block, so it isn't the least recently used
+            get_shared_array(blocks[0].name, (8,), "u1")
+        attached = list(processor_modules._attached_memory.keys())
+        assert len(attached) == MAX_ATTACHED_MEMORY
+        assert blocks[0].name in attached
+        assert blocks[1].name not in attached
+    finally:
+        while processor_modules._attached_memory:
+            processor_modules._attached_memory.popitem()[1].close()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def test_NetworkCentralityCalculator_shared_worker_pool(tmp_path):
+    make_test_tile_stores(str(tmp_path))
+    p = Pipeline("testpipe")
+    p.coords = [11.58, 27.94]
+    p.date_range = ["2018-01-01", "2018-06-01"]
+    p.output_location = str(tmp_path)
+    p.output_location_type = "local"
+    p += Sequence("veg")
+    p.veg.output_location = str(tmp_path)
+    p.veg.output_location_type = "local"
+    p.veg += NetworkCentralityCalculator()
+    ncc = p.veg.veg_NetworkCentralityCalculator
+    ncc.input_location = str(tmp_path)
+    p.configure()
+    with make_worker_pool(2) as pool:
+        p.worker_pool = pool
+        ncc.run()
+        # the pipeline's pool is still usable afterwards
+        assert pool.apply(abs, (-1,)) == 1
+    nc_json = json.load(open(os.path.join(tmp_path, "2018-03-01","JSON","NC","network_centralities.json")))
+    assert len(nc_json) == 3
+
+
+def test_NetworkCentralityCalculator_workers(tmp_path):
+    ncc = NetworkCentralityCalculator()
+    ncc.input_location = str(tmp_path)
+    ncc.output_location = str(tmp_path)
+    ncc.n_threads = 8
+    ncc.configure()
+    # config values shouldn't be overridden by the defaults
+    assert ncc.get_n_workers() == 8
+    assert ncc.get_chunksize(400) == 12
+    ncc.configure({"n_threads": -1, "pool_chunksize": 5})
+    assert ncc.get_n_workers() == os.cpu_count()
+    assert ncc.get_chunksize(400) == 5
+
+
+def test_NetworkCentralityCalculator_several_dates(tmp_path):
+    date_strings = ["2018-03-01", "2018-04-01"]
+    for date_string in date_strings:
+        make_test_tile_stores(str(tmp_path), date_string)
+    ncc = NetworkCentralityCalculator()
+    ncc.input_location = str(tmp_path)
+    ncc.output_location = str(tmp_path)
+    ncc.n_threads = 2
+    ncc.configure()
+    ncc.run()
+    assert ncc.pool is None
+    for date_string in date_strings:
+        nc_json = json.load(open(os.path.join(tmp_path, date_string, "JSON", "NC",
+                                              "network_centralities.json")))
+        assert len(nc_json) == 3
+        assert all(result["date"] == date_string for result in nc_json)
+
+
+def test_streaming_sequence(tmp_path):
+    for date_string in ["2018-03-01", "2018-04-01"]:
+        make_test_tile_stores(str(tmp_path), date_string)
+    s = Sequence("testseq")
+    s.coords = [11.58, 27.95]
+    s.date_range = ["2018-01-01", "2018-06-01"]
+    s.output_location = str(tmp_path)
+    s.output_location_type = "local"
+    s.streaming = True
+    s += NetworkCentralityCalculator()
+    s += NDVICalculator()
+    s.testseq_NetworkCentralityCalculator.input_location = str(tmp_path)
+    s.testseq_NetworkCentralityCalculator.n_threads = 2
+    s.configure()
+    assert s.can_stream()
+    s.run()
+    for date_string in ["2018-03-01", "2018-04-01"]:
+        assert os.path.exists(os.path.join(tmp_path, date_string, "JSON", "NC",
+                                           "network_centralities.json"))
+        assert os.path.exists(os.path.join(tmp_path, date_string, "JSON", "NDVI",
+                                           "ndvi_values.json"))
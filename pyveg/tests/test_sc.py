@@ -4,12 +4,14 @@ Test the functions in subgraph_centrality.py
 
 import os
 import numpy as np
+import pytest
 from pyveg.src.subgraph_centrality import *
 import igraph
 
 IMG_FILE = os.path.join(os.path.dirname(__file__),"..","testdata","binary_image.txt")
 FULL_IMG = text_file_to_array(IMG_FILE)
 IMG = crop_image_array(FULL_IMG,(0,5),(0,5))
+IMG_50 = crop_image_array(FULL_IMG,(0,50),(0,50))
 
 
 def test_load_image():
@@ -70,6 +72,29 @@ def test_calc_adjacency_matrix_no_diagonals():
     assert(adj_matrix.sum() == 16)
 
 
+def test_calc_sparse_adjacency_matrix_matches_dense():
+    for img in [IMG, IMG_50]:
+        sig_pix = get_signal_pixels(img)
+        d, dsq = calc_distance_matrix(sig_pix)
+        for use_diagonals in [False, True]:
+            adj_matrix = calc_adjacency_matrix(dsq, use_diagonals)
+            sparse_adj_matrix = calc_sparse_adjacency_matrix(sig_pix,
+                                                             use_diagonals)
+            assert(sparse_adj_matrix.format == "csr")
+            assert(sparse_adj_matrix.shape == adj_matrix.shape)
+            assert((sparse_adj_matrix.toarray() == adj_matrix).all())
+
+
+def test_full_calculation_sparse_matches_dense():
+    for use_diagonals in [False, True]:
+        feat_vec_dense, sel_pix_dense = subgraph_centrality(IMG_50, use_diagonals,
+                                                            use_sparse_adjacency=False)
+        feat_vec_sparse, sel_pix_sparse = subgraph_centrality(IMG_50, use_diagonals,
+                                                              use_sparse_adjacency=True)
+        assert((np.array(feat_vec_dense) == np.array(feat_vec_sparse)).all())
+        assert(sel_pix_dense.keys() == sel_pix_sparse.keys())
+
+
 def test_calc_and_sort_indices():
     sig_pix = get_signal_pixels(IMG)
     d,dsq = calc_distance_matrix(sig_pix)
@@ -79,6 +104,81 @@ def test_calc_and_sort_indices():
     assert(indices[0]==1)
 
 
+def test_calc_path_sc_values():
+    for n in range(1, 8):
+        # a horizontal line of n pixels
+        line_coords = [(0, i) for i in range(n)]
+        adj_matrix = calc_sparse_adjacency_matrix(line_coords)
+        sc_exact = calc_sc_values_dense(adj_matrix)
+        assert(np.allclose(calc_path_sc_values(n), sc_exact))
+
+
+def test_calc_sc_values_per_component():
+    # many small components, including isolated pixels, pairs and bends
+    rng = np.random.RandomState(1)
+    sparse_img = (rng.rand(30, 30) < 0.35) * 255
+    for img in [IMG_50, sparse_img]:
+        sig_pix = get_signal_pixels(img)
+        for use_diagonals in [False, True]:
+            adj_matrix = calc_sparse_adjacency_matrix(sig_pix, use_diagonals)
+            sc_exact = calc_sc_values_eigh(adj_matrix, per_component=False)
+            sc_per_component = calc_sc_values_eigh(adj_matrix)
+            assert(np.allclose(sc_per_component, sc_exact))
+
+
+def test_per_component_feature_vectors():
+    # speckled tiles have many pixels with exactly equal SC, so the order
+    # of tied pixels has to be the same however the SC was calculated
+    rng = np.random.RandomState(0)
+    for i in range(20):
+        img = (rng.rand(25, 25) < [0.3, 0.4, 0.5, 0.6][i % 4]) * 255
+        sig_pix = get_signal_pixels(img)
+        adj_matrix = calc_sparse_adjacency_matrix(sig_pix)
+        feature_vecs = []
+        for per_component in [False, True]:
+            sc_values = calc_sc_values_eigh(adj_matrix, per_component=per_component)
+            feature_vec, _ = fill_feature_vector(sort_sc_indices(sc_values),
+                                                 sig_pix, adj_matrix)
+            feature_vecs.append(feature_vec)
+        assert(np.array_equal(feature_vecs[0], feature_vecs[1]))
+
+
+def test_sort_sc_indices():
+    # ties (to within rounding errors) are in order of pixel index
+    sc_values = np.array([1.5, 3., 1.5 + 1e-14, 3. - 1e-14, 2.])
+    assert(list(sort_sc_indices(sc_values)) == [1, 3, 4, 0, 2])
+    assert(len(sort_sc_indices(np.zeros(0))) == 0)
+
+
+def test_calc_sc_values_probing():
+    sig_pix = get_signal_pixels(IMG_50)
+    for use_diagonals in [False, True]:
+        adj_matrix = calc_sparse_adjacency_matrix(sig_pix, use_diagonals)
+        sc_exact = calc_sc_values_eigh(adj_matrix)
+        for tolerance in [1e-1, 1e-3]:
+            sc_approx = calc_sc_values_probing(adj_matrix, sig_pix, tolerance)
+            assert(len(sc_approx) == len(sc_exact))
+            assert((np.abs(sc_approx - sc_exact) / sc_exact <= tolerance).all())
+
+
+def test_calc_and_sort_indices_expm_multiply():
+    sig_pix = get_signal_pixels(IMG)
+    adj_matrix = calc_sparse_adjacency_matrix(sig_pix)
+    indices = calc_and_sort_sc_indices(adj_matrix, "expm_multiply", sig_pix)
+    assert(len(indices)==9)
+    assert(indices[0]==1)
+    with pytest.raises(RuntimeError):
+        calc_and_sort_sc_indices(adj_matrix, "expm_multiply")
+    with pytest.raises(RuntimeError):
+        calc_and_sort_sc_indices(adj_matrix, "not_a_method")
+
+
+def test_full_calculation_expm_multiply():
+    feat_vec, sel_pix = subgraph_centrality(IMG_50, sc_method="expm_multiply")
+    assert(len(feat_vec)==20)
+    assert(len(sel_pix)==20)
+
+
 def test_calc_ec():
     sig_pix = get_signal_pixels(IMG)
     d,dsq = calc_distance_matrix(sig_pix)
@@ -87,10 +187,26 @@ def test_calc_ec():
     indices = calc_and_sort_sc_indices(adj_matrix)
     # look at the top half of ordered list
     sub_region = indices[0: len(indices)//2]
-    sel_pix = [sig_pix[j] for j in sub_region]
     graph = make_graph(adj_matrix)
-    ec = calc_euler_characteristic(sel_pix, graph)
-    assert(ec==4)
+    # the top 4 pixels form a 2x2 square: 4 vertices, 4 edges
+    ec = calc_euler_characteristic(sub_region, graph)
+    assert(ec==0)
+
+
+def test_calc_euler_characteristics_matches_graph_method():
+    # compare against the original igraph-based calculation on the full image
+    sig_pix = get_signal_pixels(FULL_IMG)
+    for use_diagonals in [False, True]:
+        adj_matrix = calc_sparse_adjacency_matrix(sig_pix, use_diagonals)
+        indices = calc_and_sort_sc_indices(adj_matrix)
+        graph = make_graph(adj_matrix)
+        n_pix_values = [round(q * len(sig_pix) / 100) for q in range(5, 100, 5)]
+        ec_values = calc_euler_characteristics(indices, adj_matrix, n_pix_values)
+        for n_pix, ec in zip(n_pix_values, ec_values):
+            # use a set for the membership test, otherwise this is very slow
+            assert(ec == calc_euler_characteristic(set(indices[:n_pix]), graph))
+        feature_vec, sel_pix = fill_feature_vector(indices, sig_pix, adj_matrix)
+        assert((feature_vec[1:] == ec_values).all())
 
 
 def test_fill_feature_vector_connected_components():
@@ -141,6 +257,25 @@ def test_fill_sc_pixels():
     sig_pix = get_signal_pixels(IMG)
     new_img = fill_sc_pixels(sig_pix, IMG)
     assert((IMG==255).sum() == (new_img==200).sum())
+    new_img = fill_sc_pixels(sig_pix[:3], IMG, 123)
+    assert((new_img==123).sum() == 3)
+
+
+def test_get_signal_pixels_array():
+    sig_pix = get_signal_pixels(IMG)
+    assert(isinstance(sig_pix, np.ndarray))
+    assert(sig_pix.shape == (9, 2))
+    assert((IMG[sig_pix[:, 0], sig_pix[:, 1]] == 255).all())
+    inv_sig_pix = get_signal_pixels(IMG, invert_y=True)
+    assert((inv_sig_pix[:, 1] == -sig_pix[:, 1]).all())
+
+
+def test_sel_pixels_share_coords():
+    feat_vec, sel_pix = subgraph_centrality(IMG_50)
+    for k, v in sel_pix.items():
+        assert(v.ndim == 2 and v.shape[1] == 2)
+        # each quantile is a view into the same array of sorted coordinates
+        assert(np.shares_memory(v, sel_pix[100]))
 
 
 
@@ -161,3 +296,66 @@ def test_feature_vector_metrics():
     assert(('mean' in feature_vec_metrics) == True)
     assert(('std' in feature_vec_metrics) == True)
     assert(('slope' in feature_vec_metrics) == True)
+
+
+def test_subgraph_centrality_batch():
+    tiles = np.stack([crop_image_array(FULL_IMG, (0, 50), (0, 50)),
+                      crop_image_array(FULL_IMG, (50, 100), (0, 50)),
+                      crop_image_array(FULL_IMG, (0, 50), (50, 100)),
+                      np.zeros((50, 50), dtype=FULL_IMG.dtype)])
+    for use_diagonals in [False, True]:
+        feature_vecs, metrics = subgraph_centrality_batch(tiles, use_diagonals)
+        assert(feature_vecs.shape == (4, 20))
+        assert(metrics.shape == (4,))
+        for i, tile in enumerate(tiles):
+            feat_vec, _ = subgraph_centrality(tile, use_diagonals)
+            assert((feature_vecs[i] == np.array(feat_vec)).all())
+            if i < 3:
+                feat_vec_metrics = feature_vector_metrics(feat_vec)
+                for k, v in feat_vec_metrics.items():
+                    assert(np.isclose(metrics[k][i], v))
+        # the empty tile should give an all-zero feature vector
+        assert((feature_vecs[3] == 0).all())
+
+
+def test_calc_adjacency_matrix_bool():
+    sig_pix = get_signal_pixels(IMG)
+    d, dsq = calc_distance_matrix(sig_pix)
+    adj_matrix = calc_adjacency_matrix(dsq, True)
+    bool_adj_matrix = calc_adjacency_matrix(dsq, True, np.bool_)
+    assert(bool_adj_matrix.dtype == np.bool_)
+    assert((bool_adj_matrix == adj_matrix).all())
+    # the input matrix should not be modified by the SC calculation
+    adj_matrix_copy = adj_matrix.copy()
+    calc_and_sort_sc_indices(adj_matrix)
+    calc_sc_values_dense(adj_matrix, np.float32)
+    assert((adj_matrix == adj_matrix_copy).all())
+
+
+def test_float32_ranking_stability():
+    """
+    float32 eigen-solves give SC values within ~1e-6 of float64, so only
+    pixels with (nearly) tied SC values can swap places.  Check that no pixel
+    moves by more than one quantile, few pixels move at all, and the
+    feature vector is unchanged.
+    """
+    sig_pix = get_signal_pixels(IMG_50)
+    n = len(sig_pix)
+    for use_diagonals in [False, True]:
+        sc_64 = calc_sc_values_eigh(calc_sparse_adjacency_matrix(sig_pix, use_diagonals))
+        sc_32 = calc_sc_values_eigh(calc_sparse_adjacency_matrix(sig_pix, use_diagonals,
+                                                                 np.float32),
+                                    dtype=np.float32)
+        assert((np.abs(sc_32 - sc_64) / sc_64 < 1e-5).all())
+        quantiles_64 = np.empty(n, dtype=int)
+        quantiles_64[np.argsort(sc_64)[::-1]] = np.arange(n) * 20 // n
+        quantiles_32 = np.empty(n, dtype=int)
+        quantiles_32[np.argsort(sc_32)[::-1]] = np.arange(n) * 20 // n
+        assert(np.abs(quantiles_64 - quantiles_32).max() <= 1)
+        assert((quantiles_64 != quantiles_32).mean() < 0.01)
+
+        feat_vec_64, _ = subgraph_centrality(IMG_50, use_diagonals)
+        feat_vec_32, _ = subgraph_centrality(IMG_50, use_diagonals, precision="float32")
+        assert((np.array(feat_vec_64) == feat_vec_32).all())
+    with pytest.raises(RuntimeError):
+        subgraph_centrality(IMG_50, precision="float16")
@@ -0,0 +1,96 @@
+"""
+Test the windowed tif reader in tif_utils.py
+"""
+
+import os
+import struct
+import numpy as np
+import cv2 as cv
+from PIL import Image
+
+from pyveg.src.tif_utils import *
+
+
+PIX = np.random.RandomState(0).uniform(-1, 1, (123, 77)).astype(np.float32)
+
+
+def write_tiled_tif(filename, pix, tile_size=32):
+    """
+    Write an uncompressed, little-endian float32 tif file made of
+    tile_size x tile_size tiles.
+    """
+    tiles_down = -(-pix.shape[0] // tile_size)
+    tiles_across = -(-pix.shape[1] // tile_size)
+    padded = np.zeros((tiles_down*tile_size, tiles_across*tile_size), dtype="<f4")
+    padded[:pix.shape[0], :pix.shape[1]] = pix
+    tiles = [padded[iy*tile_size:(iy+1)*tile_size, ix*tile_size:(ix+1)*tile_size].tobytes() \
+             for iy in range(tiles_down) for ix in range(tiles_across)]
+    n_tiles = len(tiles)
+    # (tag, type, count, value), type 3 is SHORT, 4 is LONG
+    entries = [(256, 4, 1, pix.shape[1]), (257, 4, 1, pix.shape[0]),
+               (258, 3, 1, 32), (259, 3, 1, 1), (262, 3, 1, 1), (277, 3, 1, 1),
+               (322, 3, 1, tile_size), (323, 3, 1, tile_size),
+               (324, 4, n_tiles, None), (325, 4, n_tiles, None), (339, 3, 1, 3)]
+    offsets_start = 8 + 2 + 12*len(entries) + 4
+    counts_start = offsets_start + 4*n_tiles
+    data_start = counts_start + 4*n_tiles
+    tile_offsets = [data_start + i*len(tiles[0]) for i in range(n_tiles)]
+    with open(filename, "wb") as outfile:
+        outfile.write(b"II" + struct.pack("<HI", 42, 8))
+        outfile.write(struct.pack("<H", len(entries)))
+        for tag, field_type, count, value in entries:
+            if tag == 324:
+                value = offsets_start
+            elif tag == 325:
+                value = counts_start
+            value_fmt = "HH" if field_type == 3 else "I"
+            outfile.write(struct.pack("<HHI"+value_fmt, tag, field_type, count,
+                                      value, *([0] if field_type == 3 else [])))
+        outfile.write(struct.pack("<I", 0))
+        outfile.write(struct.pack("<{}I".format(n_tiles), *tile_offsets))
+        outfile.write(struct.pack("<{}I".format(n_tiles), *[len(t) for t in tiles]))
+        for tile in tiles:
+            outfile.write(tile)
+
+
+def check_reader(filename, expect_windowed=True):
+    reader = WindowedTifReader(filename)
+    assert((reader.full_image is None) == expect_windowed)
+    assert(reader.shape == PIX.shape)
+    assert((reader.read() == cv.imread(filename, cv.IMREAD_ANYDEPTH)).all())
+    assert((reader.read_window(10, 50, 5, 60) == PIX[10:50, 5:60]).all())
+    blocks = [block for _, block in reader.iter_row_blocks(20)]
+    assert(len(blocks) == 7)
+    assert((np.concatenate(blocks) == PIX).all())
+
+
+def test_read_uncompressed_strips(tmp_path):
+    filename = os.path.join(tmp_path, "strips.tif")
+    # openCV writes several rows per strip
+    cv.imwrite(filename, PIX, [cv.IMWRITE_TIFF_COMPRESSION, 1])
+    check_reader(filename)
+
+
+def test_read_deflate_strips(tmp_path):
+    filename = os.path.join(tmp_path, "deflate.tif")
+    Image.fromarray(PIX, "F").save(filename, compression="tiff_deflate")
+    check_reader(filename)
+
+
+def test_read_tiles(tmp_path):
+    filename = os.path.join(tmp_path, "tiles.tif")
+    write_tiled_tif(filename, PIX)
+    check_reader(filename)
+
+
+def test_read_fallback(tmp_path):
+    # LZW compression isn't supported, so the file is read in one go
+    filename = os.path.join(tmp_path, "lzw.tif")
+    cv.imwrite(filename, PIX, [cv.IMWRITE_TIFF_COMPRESSION, 5])
+    check_reader(filename, expect_windowed=False)
+
+
+def test_calc_tif_mean(tmp_path):
+    filename = os.path.join(tmp_path, "deflate.tif")
+    Image.fromarray(PIX, "F").save(filename, compression="tiff_deflate")
+    assert(np.isclose(calc_tif_mean(filename, 10), PIX.mean()))
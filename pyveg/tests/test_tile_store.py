@@ -0,0 +1,39 @@
+"""
+Test the functions in tile_store.py
+"""
+
+import os
+import json
+import numpy as np
+
+from pyveg.src.tile_store import *
+from pyveg.src.image_utils import crop_image_npix
+
+
+def test_make_tile_stack():
+    img_array = np.arange(100*150*3, dtype=np.int32).reshape(100, 150, 3)
+    tile_stack, tile_info = make_tile_stack(img_array, 50,
+                                            region_size=0.08, coords=[10., 20.])
+    assert(tile_stack.shape == (6, 50, 50, 3))
+    assert(tile_stack.flags["C_CONTIGUOUS"])
+    sub_images = crop_image_npix(img_array, 50, region_size=0.08, coords=[10., 20.])
+    for tile, info, (sub_image, sub_coords) in zip(tile_stack, tile_info, sub_images):
+        assert((tile == sub_image).all())
+        assert(tuple(info["coords"]) == sub_coords)
+
+
+def test_tile_store_round_trip(tmp_path):
+    img_array = np.random.RandomState(0).randint(0, 255, (100, 100)).astype(np.uint8)
+    tile_stack, tile_info = make_tile_stack(img_array, 25,
+                                            region_size=0.08, coords=[10., 20.])
+    npy_path = save_tile_store(tile_stack, tile_info, str(tmp_path), "test_BWNDVI",
+                               metadata={"image_type": "BWNDVI"})
+    sidecar = json.load(open(os.path.join(tmp_path, "test_BWNDVI.json")))
+    assert(sidecar["image_type"] == "BWNDVI")
+    assert(sidecar["tile_shape"] == [25, 25])
+    tile_store = TileStore(npy_path)
+    assert(len(tile_store) == 16)
+    assert(isinstance(tile_store.tiles, np.memmap))
+    assert((tile_store[5] == tile_stack[5]).all())
+    assert(tile_store.get_coords_string(0) == "9.970_20.030")
+    assert(get_tile_store(npy_path) is get_tile_store(npy_path))
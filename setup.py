@@ -21,6 +21,9 @@ setup(
         "pyveg_gen_pattern=pyveg.scripts.generate_pattern:main",
         "pyveg_gee_download=pyveg.scripts.download_gee_data:main",
         "pyveg_gee_analysis=pyveg.scripts.analyse_gee_data:main",
-        "pyveg_run_pipeline=pyveg.scripts.run_pyveg_pipeline:main"
+        "pyveg_run_pipeline=pyveg.scripts.run_pyveg_pipeline:main",
+        "pyveg_run_batch=pyveg.scripts.run_pyveg_batch:main",
+        "pyveg_benchmark_sc=pyveg.scripts.benchmark_subgraph_centrality:main",
+        "pyveg_benchmark_image_utils=pyveg.scripts.benchmark_image_utils:main"
     ]},
 )
\ No newline at end of file